@@ -0,0 +1,90 @@
+"""
+Benchmark of the extraction of the longest articles of a dump: the CPU time
+per article of Extractor.extract(), with the templates of the dump expanded.
+
+    python benchmarks/bench_extract.py [dump] [--templates FILE] [--pages N]
+
+Without a dump, long articles are made of the pages of the test dump, each
+repeated --copies times.
+"""
+
+import argparse
+import fileinput
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from poiolib import WikiExtractor  # noqa: E402
+
+TEST_DUMP = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "tests",
+    "test_data",
+    "xxwiki-20200101-pages-articles.xml",
+)
+
+
+def read_pages(file_name):
+    input = fileinput.FileInput(file_name, openhook=fileinput.hook_compressed)
+    try:
+        return list(WikiExtractor.pages_from(input))
+    finally:
+        input.close()
+
+
+def load_articles(dump_file, template_file=None):
+    """Load the templates and return the articles of the dump."""
+    WikiExtractor.options = WikiExtractor.extraction_options()
+    for file_name in (template_file, dump_file):
+        if file_name:
+            input = fileinput.FileInput(file_name, openhook=fileinput.hook_compressed)
+            WikiExtractor.load_templates(input)
+            input.close()
+    return [page for page in read_pages(dump_file) if page[3] == "0"]
+
+
+def bench(articles, count):
+    articles = sorted(articles, key=lambda page: -sum(map(len, page[5])))[:count]
+    times = []
+    for id, revid, title, ns, catSet, page in articles:
+        start = time.process_time()
+        WikiExtractor.Extractor(id, revid, title, page).extract(io.StringIO())
+        times.append((time.process_time() - start, title, sum(map(len, page))))
+    total = sum(elapsed for elapsed, _, _ in times)
+    print(
+        "%d articles in %.2fs CPU (%.1f ms per article)"
+        % (len(times), total, 1000 * total / len(times))
+    )
+    for elapsed, title, size in sorted(times, reverse=True)[:5]:
+        print("%8.1f ms  %8d chars  %s" % (1000 * elapsed, size, title))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("dump", nargs="?", help="XML wiki dump file")
+    parser.add_argument("--templates", help="file with the templates of the dump")
+    parser.add_argument(
+        "--pages", type=int, default=100, help="number of the longest articles"
+    )
+    parser.add_argument(
+        "--copies",
+        type=int,
+        default=200,
+        help="copies of the text of the pages of the test dump, without a dump",
+    )
+    args = parser.parse_args()
+    if args.dump:
+        articles = load_articles(args.dump, args.templates)
+    else:
+        articles = [
+            page[:5] + (page[5] * args.copies,) for page in load_articles(TEST_DUMP)
+        ]
+    bench(articles, args.pages)
+
+
+if __name__ == "__main__":
+    main()
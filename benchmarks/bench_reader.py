@@ -0,0 +1,92 @@
+"""
+Benchmark of the readers of the pages of a dump: pages_from(), which parses
+each line, and buffer_pages_from(), which searches for the tags in large
+buffers, selected with --reader.
+
+    python benchmarks/bench_reader.py [dump] [--copies N]
+
+Without a dump, the one of the tests is repeated --copies times.
+"""
+
+import argparse
+import fileinput
+import os
+import sys
+import tempfile
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from poiolib import WikiExtractor  # noqa: E402
+
+TEST_DUMP = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "tests",
+    "test_data",
+    "xxwiki-20200101-pages-articles.xml",
+)
+
+
+def make_dump(path, copies):
+    """Write a dump with the pages of the test dump repeated, with new ids."""
+    with open(TEST_DUMP) as f:
+        text = f.read()
+    start = text.index("  <page>")
+    end = text.rindex("</page>") + len("</page>\n")
+    pages = text[start:end]
+    with open(path, "w") as out:
+        out.write(text[:start])
+        for i in range(copies):
+            out.write(pages.replace("<id>", "<id>%06d" % i))
+        out.write(text[end:])
+
+
+def lines_reader(dump_file):
+    input = fileinput.FileInput(dump_file, openhook=fileinput.hook_compressed)
+    try:
+        return list(WikiExtractor.pages_from(input))
+    finally:
+        input.close()
+
+
+def buffers_reader(dump_file):
+    return list(WikiExtractor.buffer_pages_from(WikiExtractor.file_blocks(dump_file)))
+
+
+def bench(dump_file):
+    size = os.path.getsize(dump_file) / 1024 / 1024
+    results = {}
+    for name, reader in (("lines", lines_reader), ("buffers", buffers_reader)):
+        start = default_timer()
+        results[name] = reader(dump_file)
+        elapsed = default_timer() - start
+        print(
+            "%-8s %d pages in %.2fs (%.1f MB/s)"
+            % (name, len(results[name]), elapsed, size / elapsed)
+        )
+    if results["lines"] != results["buffers"]:
+        sys.exit("The readers returned different pages")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("dump", nargs="?", help="XML wiki dump file")
+    parser.add_argument(
+        "--copies",
+        type=int,
+        default=2000,
+        help="copies of the pages of the test dump, without a dump",
+    )
+    args = parser.parse_args()
+    if args.dump:
+        bench(args.dump)
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dump_file = os.path.join(tmp_dir, "xxwiki-20200101-pages-articles.xml")
+        make_dump(dump_file, args.copies)
+        bench(dump_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -60,15 +60,31 @@ import sys
 import argparse
 import bz2
 import codecs
-import cgi
+try:
+    from html import escape as html_escape
+except ImportError:
+    from cgi import escape as html_escape
 import fileinput
+import gzip
+import hashlib
+import heapq
 import logging
+import mmap
 import os.path
 import re  # TODO use regex when it will be standard
+import signal
+import struct
+import tempfile
+import threading
 import time
 import json
+from contextlib import contextmanager
 from io import StringIO
-from multiprocessing import Queue, Process, Value, cpu_count
+from bisect import bisect_left, bisect_right
+from multiprocessing import Queue, Process, Value, Array, Condition, Pool, cpu_count, \
+    active_children
+from collections import OrderedDict, deque
+from itertools import chain, tee
 from timeit import default_timer
 
 
@@ -106,103 +122,318 @@ version = '2.75'
 
 ## PARAMS ####################################################################
 
-options = SimpleNamespace(
-
-    ##
-    # Defined in <siteinfo>
-    # We include as default Template, when loading external template file.
-    knownNamespaces = {'Template': 10},
-
-    ##
-    # The namespace used for template definitions
-    # It is the name associated with namespace key=10 in the siteinfo header.
-    templateNamespace = '',
-    templatePrefix = '',
-
-    ##
-    # The namespace used for module definitions
-    # It is the name associated with namespace key=828 in the siteinfo header.
-    moduleNamespace = '',
-
-    ##
-    # Recognize only these namespaces in links
-    # w: Internal links to the Wikipedia
-    # wiktionary: Wiki dictionary
-    # wikt: shortcut for Wiktionary
-    #
-    acceptedNamespaces = ['w', 'wiktionary', 'wikt'],
-
-    # This is obtained from <siteinfo>
-    urlbase = '',
-
-    ##
-    # Filter disambiguation pages
-    filter_disambig_pages = False,
-
-    ##
-    # Drop tables from the article
-    keep_tables = False,
-
-    ##
-    # Whether to preserve links in output
-    keepLinks = False,
-
-    ##
-    # Whether to preserve section titles
-    keepSections = True,
-
-    ##
-    # Whether to preserve lists
-    keepLists = False,
-
-    ##
-    # Whether to output HTML instead of text
-    toHTML = False,
-
-    ##
-    # Whether to write json instead of the xml-like default output format
-    write_json = False,
-
-    ##
-    # Whether to expand templates
-    expand_templates = True,
-
-    ##
-    ## Whether to escape doc content
-    escape_doc = False,
-
-    ##
-    # Print the wikipedia article revision
-    print_revision = False,
-
-    ##
-    # Minimum expanded text length required to print document
-    min_text_length = 0,
-
-    # Shared objects holding templates, redirects and cache
-    templates = {},
-    redirects = {},
-    # cache of parser templates
-    # FIXME: sharing this with a Manager slows down.
-    templateCache = {},
-
-    # Elements to ignore/discard
-
-    ignored_tag_patterns = [],
-    filter_category_include = set(),
-    filter_category_exclude = set(),
-
-    log_file = None,
-
-    discardElements = [
-        'gallery', 'timeline', 'noinclude', 'pre',
-        'table', 'tr', 'td', 'th', 'caption', 'div',
-        'form', 'input', 'select', 'option', 'textarea',
-        'ul', 'li', 'ol', 'dl', 'dt', 'dd', 'menu', 'dir',
-        'ref', 'references', 'img', 'imagemap', 'source', 'small',
-        'sub', 'sup', 'indicator'
-    ],
-)
+def default_options(**kwargs):
+    """
+    :return: a new options object with the default values, updated with
+    :param kwargs:.
+    Each object has its own templates, redirects and template cache, so that
+    extractions with different options objects do not share any state.
+    """
+    opts = SimpleNamespace(
+
+        ##
+        # Defined in <siteinfo>
+        # We include as default Template, when loading external template file.
+        knownNamespaces = {'Template': 10},
+
+        ##
+        # The namespace used for template definitions
+        # It is the name associated with namespace key=10 in the siteinfo header.
+        templateNamespace = '',
+        templatePrefix = '',
+
+        ##
+        # The namespace used for module definitions
+        # It is the name associated with namespace key=828 in the siteinfo header.
+        moduleNamespace = '',
+
+        ##
+        # The database name of the wiki, from the siteinfo header
+        dbname = '',
+
+        ##
+        # Directory of template snapshots, to use or create
+        template_snapshots = None,
+
+        ##
+        # Recognize only these namespaces in links
+        # w: Internal links to the Wikipedia
+        # wiktionary: Wiki dictionary
+        # wikt: shortcut for Wiktionary
+        #
+        acceptedNamespaces = ['w', 'wiktionary', 'wikt'],
+
+        # This is obtained from <siteinfo>
+        urlbase = '',
+
+        ##
+        # Filter disambiguation pages
+        filter_disambig_pages = False,
+
+        ##
+        # Drop tables from the article
+        keep_tables = False,
+
+        ##
+        # Whether to preserve links in output
+        keepLinks = False,
+
+        ##
+        # Whether to preserve section titles
+        keepSections = True,
+
+        ##
+        # Whether to preserve lists
+        keepLists = False,
+
+        ##
+        # Whether to output HTML instead of text
+        toHTML = False,
+
+        ##
+        # Whether to write json instead of the xml-like default output format
+        write_json = False,
+
+        ##
+        # Whether to expand templates
+        expand_templates = True,
+        ##
+        # Expansion policy: the names of the only templates expanded in the
+        # text of the articles (None for all), as returned by
+        # expansionNames(), with the templates and parser functions they use
+        allowed_templates = None,
+        # names of the templates and parser functions never expanded
+        denied_templates = set(),
+        # maximum number of expansions of templates and parser functions, and
+        # maximum seconds of expansion, per article (0 for no limit), after
+        # which the remaining ones are dropped
+        expansion_budget = 0,
+        expansion_time_budget = 0,
+
+        ##
+        ## Whether to escape doc content
+        escape_doc = False,
+
+        ##
+        # Print the wikipedia article revision
+        print_revision = False,
+
+        ##
+        # Minimum expanded text length required to print document
+        min_text_length = 0,
+
+        ##
+        # Whether to decompress the blocks of .bz2 dumps in parallel
+        parallel_bz2 = True,
+
+        ##
+        # Number of processes that decompress a .bz2 dump, or the streams of a
+        # multistream dump, in addition to the extract processes; 0 for as
+        # many as the extract processes
+        decompress_processes = 0,
+
+        ##
+        # How to read the pages of the dump: 'lines', parsing each line, or
+        # 'buffers', searching for the tags in large buffers of bytes
+        reader = 'lines',
+
+        ##
+        # Number of processes that read the byte ranges of an uncompressed
+        # dump, each dispatching its pages to its own extract processes
+        range_readers = 1,
+
+        ##
+        # Whether to output the articles in the order of the dump, or as soon
+        # as they are extracted
+        ordered = True,
+
+        ##
+        # Maximum number of pages, and of their characters, that are read
+        # but not output yet
+        max_in_flight_pages = 10000,
+        max_in_flight_size = 100 * 1024 * 1024,
+
+        # Shared objects holding templates, redirects and cache
+        templates = {},
+        redirects = {},
+        ##
+        # Maximum characters of the templates whose parse is kept in the cache
+        template_cache_size = 32 * 1024 * 1024,
+        # cache of parser templates, one per process
+        # FIXME: sharing this with a Manager slows down.
+        templateCache = None,
+        ##
+        # Whether to memoize the expansions of templates and parser functions
+        # that do not depend on the page, and the maximum characters of the
+        # memoized expansions and of their arguments
+        memoize_expansions = True,
+        expansion_cache_size = 16 * 1024 * 1024,
+        # cache of expansions, one per process
+        expansionCache = None,
+
+        # Elements to ignore/discard
+
+        ignored_tag_patterns = [],
+        # names of the ignored tags, for the fused cleaner
+        ignored_tag_names = set(),
+        ##
+        # Whether to remove comments, tags and discarded elements in a single
+        # scan of the text
+        fused_cleaner = False,
+        ##
+        # Whether to time the stages of the extraction of each article
+        profile_stages = False,
+        # the StageProfile of the timings, one per process
+        stageProfile = None,
+        ##
+        # Whether to count the calls, time, recursion limit hits and cache
+        # hits of each template and parser function, and the file where to
+        # write them as JSON, if any
+        profile_templates = False,
+        template_profile_file = None,
+        # the TemplateProfile of the counts, one per process
+        templateProfile = None,
+        filter_category_include = set(),
+        filter_category_exclude = set(),
+
+        log_file = None,
+
+        discardElements = [
+            'gallery', 'timeline', 'noinclude', 'pre',
+            'table', 'tr', 'td', 'th', 'caption', 'div',
+            'form', 'input', 'select', 'option', 'textarea',
+            'ul', 'li', 'ol', 'dl', 'dt', 'dd', 'menu', 'dir',
+            'ref', 'references', 'img', 'imagemap', 'source', 'small',
+            'sub', 'sup', 'indicator'
+        ],
+
+        ##
+        # Logging
+        quiet = False,
+        debug = False,
+    )
+    for key, value in kwargs.items():
+        setattr(opts, key, value)
+    if opts.templateCache is None:
+        opts.templateCache = TemplateCache(opts.template_cache_size)
+    if opts.expansionCache is None:
+        opts.expansionCache = TemplateCache(opts.expansion_cache_size)
+    return opts
+
+
+def extraction_options(ignored_tags=None, allowed_templates=None,
+                       denied_templates=(), **kwargs):
+    """
+    :return: new options as set up by main(), for running an extraction from
+    another program.
+    :param ignored_tags: tags that are dropped, keeping their content.
+    :param allowed_templates: names of the only templates expanded in the
+    text of the articles, or None for all.
+    :param denied_templates: names of the templates and parser functions
+    that are never expanded.
+    :param kwargs: values of options, e.g. write_json=True.
+    """
+    opts = default_options(**kwargs)
+    if allowed_templates is not None:
+        opts.allowed_templates = expansionNames(allowed_templates)
+    opts.denied_templates = expansionNames(denied_templates)
+    if opts.toHTML:
+        opts.keepLinks = True
+    if ignored_tags is None:
+        ignored_tags = defaultIgnoredTags
+    for tag in ignored_tags:
+        ignoreTag(tag, opts)
+    if not opts.keepLinks:
+        ignoreTag('a', opts)
+    return opts
+
+
+class TemplateCache(object):
+    """
+    Cache of parsed templates, which evicts the least recently used ones
+    when the size of their source text exceeds max_size characters.
+    The sources stay in options.templates, so evicted templates are
+    parsed again when needed.
+    It also holds the memoized expansions, sized by their characters.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: maximum characters of the cached templates.
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()  # title -> (template, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, title):
+        """
+        :return: the cached template with :param title:, or None.
+        """
+        entry = self.entries.get(title)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(title)
+        return entry[0]
+
+    def put(self, title, template, size):
+        """
+        Add a parsed template, evicting the least recently used ones as needed.
+        The latest template is kept even if it exceeds max_size alone.
+        :param size: characters of the source of the template.
+        """
+        old = self.entries.pop(title, None)
+        if old:
+            self.size -= old[1]
+        self.entries[title] = (template, size)
+        self.size += size
+        while self.size > self.max_size and len(self.entries) > 1:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+            self.evictions += 1
+
+    def counts(self):
+        """
+        :return: (hits, misses, evictions)
+        """
+        return self.hits, self.misses, self.evictions
+
+    def __contains__(self, title):
+        return title in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def log_template_cache(cache_counts):
+    """
+    Log the totals of the template and expansion caches of the extract
+    processes.
+    :param cache_counts: shared array of hits, misses and evictions of the
+    template caches, followed by those of the expansion caches.
+    """
+    for k, name in enumerate(('Template', 'Expansion')):
+        hits, misses, evictions = cache_counts[3 * k:3 * k + 3]
+        lookups = hits + misses
+        logging.info("%s cache: %d hits, %d misses (%.1f%% hits), %d evictions",
+                     name, hits, misses,
+                     100.0 * hits / lookups if lookups else 0.0, evictions)
+
+
+options = default_options()
+
+##
+# Tags that are dropped by default, keeping their content.
+defaultIgnoredTags = [
+    'abbr', 'b', 'big', 'blockquote', 'center', 'cite', 'em',
+    'font', 'h1', 'h2', 'h3', 'h4', 'hiero', 'i', 'kbd',
+    'p', 'plaintext', 's', 'span', 'strike', 'strong',
+    'tt', 'u', 'var'
+]
 
 ##
 # Keys for Template and Module namespaces
@@ -355,10 +586,14 @@ comment = re.compile(r'<!--.*?-->', re.DOTALL)
 nowiki = re.compile(r'<nowiki>.*?</nowiki>')
 
 
-def ignoreTag(tag):
+def ignoreTag(tag, opts=None):
+    """
+    :param opts: the options to update, by default the global options.
+    """
     left = re.compile(r'<%s\b.*?>' % tag, re.IGNORECASE | re.DOTALL)  # both <ref> and <reference>
     right = re.compile(r'</\s*%s>' % tag, re.IGNORECASE)
-    options.ignored_tag_patterns.append((left, right))
+    (opts or options).ignored_tag_patterns.append((left, right))
+    (opts or options).ignored_tag_names.add(tag.lower())
 
 # Match selfClosing HTML tags
 selfClosing_tag_patterns = [
@@ -436,6 +671,7 @@ class Template(list):
 
         if depth > extractor.maxParameterRecursionLevels:
             extractor.recursion_exceeded_3_errs += 1
+            extractor.profile_recursion()
             return ''
 
         return ''.join([tpl.subst(params, extractor, depth) for tpl in self])
@@ -555,6 +791,21 @@ class Extractor(object):
         self.recursion_exceeded_2_errs = 0  # template recursion within expandTemplate()
         self.recursion_exceeded_3_errs = 0  # parameter recursion
         self.template_title_errs = 0
+        # whether the expansion in progress depends on the page or on the
+        # frame, so that it cannot be memoized
+        self.impure = False
+        # depth of the deepest frame of the expansion in progress
+        self.deepest = 0
+        # whether the options set an expansion policy
+        self.expansionPolicy = bool(options.allowed_templates is not None
+                                    or options.denied_templates
+                                    or options.expansion_budget
+                                    or options.expansion_time_budget)
+        # expansions done, and those dropped by the expansion budget
+        self.expansions = 0
+        self.expansions_dropped = 0
+        # time at which the expansion budget ends, if any
+        self.expansion_deadline = None
 
     def write_output(self, out, text):
         """
@@ -598,6 +849,15 @@ class Extractor(object):
         """
         :param out: a memory file.
         """
+        text = self.extract_text()
+        if text is not None:
+            self.write_output(out, text)
+
+    def extract_text(self):
+        """
+        :return: the list of lines of the extracted article, or None if it is
+        shorter than options.min_text_length.
+        """
         logging.info('%s\t%s', self.id, self.title)
 
         # Separate header from text with a newline.
@@ -636,6 +896,8 @@ class Extractor(object):
         self.magicWords['CURRENTTIME'] = time.strftime('%H:%M:%S')
         text = self.text
         self.text = ''          # save memory
+        if options.expansion_time_budget:
+            self.expansion_deadline = default_timer() + options.expansion_time_budget
         #
         # @see https://doc.wikimedia.org/mediawiki-core/master/php/classParser.html
         # This does the equivalent of internalParse():
@@ -643,16 +905,23 @@ class Extractor(object):
         # $dom = $this->preprocessToDom( $text, $flag );
         # $text = $frame->expand( $dom );
         #
-        text = self.transform(text)
-        text = self.wiki2text(text)
-        text = compact(self.clean(text))
+        if options.stageProfile is None:
+            text = self.transform(text)
+            text = self.wiki2text(text)
+            text = compact(self.clean(text))
+        else:
+            for name, stage in (('transform', self.transform),
+                                ('wiki2text', self.wiki2text),
+                                ('clean', self.clean),
+                                ('compact', compact)):
+                start = default_timer()
+                text = stage(text)
+                options.stageProfile.add(name, default_timer() - start, self.id)
         # from zwChan
         text = [title_str] + text
 
         if sum(len(line) for line in text) < options.min_text_length:
-            return
-
-        self.write_output(out, text)
+            return None
 
         errs = (self.template_title_errs,
                 self.recursion_exceeded_1_errs,
@@ -661,7 +930,10 @@ class Extractor(object):
         if any(errs):
             logging.warn("Template errors in article '%s' (%s): title(%d) recursion(%d, %d, %d)",
                          self.title, self.id, *errs)
-
+        if self.expansions_dropped:
+            logging.debug("Expansion budget exceeded in article '%s' (%s): %d dropped",
+                          self.title, self.id, self.expansions_dropped)
+        return text
 
     def transform(self, wikitext):
         """
@@ -669,14 +941,15 @@ class Extractor(object):
         @see https://www.mediawiki.org/wiki/Help:Formatting
         """
         # look for matching <nowiki>...</nowiki>
-        res = ''
+        res = []
         cur = 0
         for m in nowiki.finditer(wikitext, cur):
-            res += self.transform1(wikitext[cur:m.start()]) + wikitext[m.start():m.end()]
+            res.append(self.transform1(wikitext[cur:m.start()]))
+            res.append(m.group())
             cur = m.end()
         # leftover
-        res += self.transform1(wikitext[cur:])
-        return res
+        res.append(self.transform1(wikitext[cur:]))
+        return ''.join(res)
 
 
     def transform1(self, text):
@@ -737,13 +1010,14 @@ class Extractor(object):
         # ############### Process HTML ###############
 
         # turn into HTML, except for the content of <syntaxhighlight>
-        res = ''
+        res = []
         cur = 0
         for m in syntaxhighlight.finditer(text):
-            res += unescape(text[cur:m.start()]) + m.group(1)
+            res.append(unescape(text[cur:m.start()]))
+            res.append(m.group(1))
             cur = m.end()
-        text = res + unescape(text[cur:])
-        return text
+        res.append(unescape(text[cur:]))
+        return ''.join(res)
 
 
     def clean(self, text):
@@ -751,30 +1025,33 @@ class Extractor(object):
         Removes irrelevant parts from :param: text.
         """
 
-        # Collect spans
-        spans = []
-        # Drop HTML comments
-        for m in comment.finditer(text):
-            spans.append((m.start(), m.end()))
-
-        # Drop self-closing tags
-        for pattern in selfClosing_tag_patterns:
-            for m in pattern.finditer(text):
+        if options.fused_cleaner:
+            text = dropTags(text)
+        else:
+            # Collect spans
+            spans = []
+            # Drop HTML comments
+            for m in comment.finditer(text):
                 spans.append((m.start(), m.end()))
 
-        # Drop ignored tags
-        for left, right in options.ignored_tag_patterns:
-            for m in left.finditer(text):
-                spans.append((m.start(), m.end()))
-            for m in right.finditer(text):
-                spans.append((m.start(), m.end()))
+            # Drop self-closing tags
+            for pattern in selfClosing_tag_patterns:
+                for m in pattern.finditer(text):
+                    spans.append((m.start(), m.end()))
 
-        # Bulk remove all spans
-        text = dropSpans(spans, text)
+            # Drop ignored tags
+            for left, right in options.ignored_tag_patterns:
+                for m in left.finditer(text):
+                    spans.append((m.start(), m.end()))
+                for m in right.finditer(text):
+                    spans.append((m.start(), m.end()))
 
-        # Drop discarded elements
-        for tag in options.discardElements:
-            text = dropNested(text, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
+            # Bulk remove all spans
+            text = dropSpans(spans, text)
+
+            # Drop discarded elements
+            for tag in options.discardElements:
+                text = dropNested(text, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
 
         if not options.toHTML:
             # Turn into text what is left (&amp;nbsp;) and <syntaxhighlight>
@@ -808,7 +1085,7 @@ class Extractor(object):
             text = text.replace('|-', '')
             text = text.replace('|', '')
         if options.toHTML:
-            text = cgi.escape(text)
+            text = html_escape(text, quote=False)
         return text
 
 
@@ -845,22 +1122,27 @@ class Extractor(object):
         # https://en.wikipedia.org/wiki/Special:ExpandTemplates
         # https://it.wikipedia.org/wiki/Speciale:EspandiTemplate
 
-        res = ''
         if self.frame.depth >= self.maxTemplateRecursionLevels:
             self.recursion_exceeded_1_errs += 1
-            return res
+            self.profile_recursion()
+            self.impure = True
+            return ''
 
         # logging.debug('%*s<expand', self.frame.depth, '')
 
+        if '{{' not in wikitext:
+            return wikitext
+        res = []
         cur = 0
         # look for matching {{...}}
         for s, e in findMatchingBraces(wikitext, 2):
-            res += wikitext[cur:s] + self.expandTemplate(wikitext[s + 2:e - 2])
+            res.append(wikitext[cur:s])
+            res.append(self.expandTemplate(wikitext[s + 2:e - 2]))
             cur = e
         # leftover
-        res += wikitext[cur:]
+        res.append(wikitext[cur:])
         # logging.debug('%*sexpand> %s', self.frame.depth, '', res)
-        return res
+        return ''.join(res)
 
 
     def templateParams(self, parameters):
@@ -979,6 +1261,8 @@ class Extractor(object):
 
         if self.frame.depth >= self.maxTemplateRecursionLevels:
             self.recursion_exceeded_2_errs += 1
+            self.profile_recursion()
+            self.impure = True
             # logging.debug('%*sEXPAND> %s', self.frame.depth, '', body)
             return ''
 
@@ -1000,6 +1284,8 @@ class Extractor(object):
 
         if title in self.magicWords.values:
             ret = self.magicWords[title]
+            if title != '!':
+                self.impure = True
             logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, ret)
             return ret
 
@@ -1021,7 +1307,15 @@ class Extractor(object):
             funct = title[:colon]
             parts[0] = title[colon + 1:].strip()  # side-effect (parts[0] not used later)
             # arguments after first are not evaluated
-            ret = callParserFunction(funct, parts, self)
+            key = None
+            if funct.lower() in memoizedParserFunctions:
+                key = ('#', funct.lower()) + tuple(parts)
+            name = funct.lower()
+            if self.expansionPolicy and not self.expansionAllowed(name):
+                return ''
+            if name == '#invoke':
+                name += ':' + parts[0]
+            ret = self.profiled(name, key, lambda: callParserFunction(funct, parts, self))
             logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', funct, ret)
             return ret
 
@@ -1034,18 +1328,20 @@ class Extractor(object):
         if redirected:
             title = redirected
 
+        if self.expansionPolicy and not self.expansionAllowed(title, template=True):
+            return ''
+
         # get the template
-        if title in options.templateCache:
-            template = options.templateCache[title]
-        elif title in options.templates:
-            template = Template.parse(options.templates[title])
+        template = options.templateCache.get(title)
+        if template is None:
+            body = options.templates.get(title)
+            if body is None:
+                # The page being included could not be identified
+                logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, '')
+                return ''
+            template = Template.parse(body)
             # add it to cache
-            options.templateCache[title] = template
-            del options.templates[title]
-        else:
-            # The page being included could not be identified
-            logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, '')
-            return ''
+            options.templateCache.put(title, template, len(body))
 
         logging.debug('%*sTEMPLATE %s: %s', self.frame.depth, '', title, template)
 
@@ -1095,14 +1391,101 @@ class Extractor(object):
         # Extend frame before subst, since there may be recursion in default
         # parameter value, e.g. {{OTRS|celebrative|date=April 2015}} in article
         # 21637542 in enwiki.
-        self.frame = self.frame.push(title, params)
-        instantiated = template.subst(params, self)
-        value = self.transform(instantiated)
-        self.frame = self.frame.pop()
+        def instantiate():
+            self.frame = self.frame.push(title, params)
+            self.deepest = max(self.deepest, self.frame.depth)
+            instantiated = template.subst(params, self)
+            value = self.transform(instantiated)
+            self.frame = self.frame.pop()
+            return value
+
+        key = (('{', title, 'subst' if subst else '')
+               + tuple(chain.from_iterable(sorted(params.items()))))
+        value = self.profiled(title, key, instantiate)
         logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, value)
         return value
 
 
+    def expansionAllowed(self, name, template=False):
+        """
+        Apply the expansion policy of the options, counting the expansion
+        against the budget of the article.
+        :param name: the name of a parser function, or the title of a template.
+        :param template: whether name is the title of a template.
+        :return: whether to expand it, or to drop it.
+        """
+        if options.denied_templates and inTemplateNames(name, options.denied_templates):
+            return False
+        # the templates used by the allowed ones are expanded
+        if (template and options.allowed_templates is not None and self.frame.depth == 0
+                and not inTemplateNames(name, options.allowed_templates)):
+            return False
+        self.expansions += 1
+        if ((options.expansion_budget and self.expansions > options.expansion_budget)
+                or (self.expansion_deadline is not None
+                    and default_timer() > self.expansion_deadline)):
+            self.expansions_dropped += 1
+            # the expansions in progress are cut short
+            self.impure = True
+            return False
+        return True
+
+    def profiled(self, name, key, expand):
+        """
+        Expand with memoized(), recording the call in options.templateProfile,
+        if any.
+        :param name: title of the template or name of the parser function.
+        """
+        profile = options.templateProfile
+        if profile is None:
+            return self.memoized(key, expand)
+        profile.enter(name)
+        start = default_timer()
+        try:
+            return self.memoized(key, expand, name)
+        finally:
+            profile.exit(name, default_timer() - start)
+
+    def profile_recursion(self):
+        """
+        Record a hit of a recursion limit in options.templateProfile, if any,
+        against the template being expanded.
+        """
+        if options.templateProfile is not None:
+            options.templateProfile.recursion(self.frame.title)
+
+    def memoized(self, key, expand, name=None):
+        """
+        Memoize the expansion of templates and parser functions that depends
+        only on their arguments, not on the page or on the frame.
+        :param key: tuple of strings identifying the expansion, or None if it
+        cannot be memoized.
+        :param expand: function performing the expansion.
+        :param name: name of the expansion, under which to record the cache
+        hits in options.templateProfile.
+        :return: the expansion.
+        """
+        if key is None or not options.memoize_expansions:
+            return expand()
+        depth = self.frame.depth
+        entry = options.expansionCache.get(key)
+        # reuse it only if it would not exceed the recursion limit here
+        if entry is not None and depth + entry[1] < self.maxTemplateRecursionLevels:
+            self.deepest = max(self.deepest, depth + entry[1])
+            if name is not None:
+                options.templateProfile.hit(name)
+            return entry[0]
+        impure, deepest = self.impure, self.deepest
+        self.impure, self.deepest = False, depth
+        value = expand()
+        if not self.impure:
+            options.expansionCache.put(key, (value, self.deepest - depth),
+                                       len(value) + sum(len(k) for k in key))
+        self.impure = self.impure or impure
+        self.deepest = max(self.deepest, deepest)
+        return value
+
+
 # ----------------------------------------------------------------------
 # parameter handling
 
@@ -1180,6 +1563,12 @@ def splitParts(paramsList):
     return parameters
 
 
+# Runs of two or more braces, and of brackets
+braceRunsRE = re.compile(r'{{2,}|}{2,}')
+delimiterRunsRE = re.compile(r'{{2,}|}{2,}|\[{2,}|]{2,}')
+bracketRunsRE = re.compile(r'\[{2,}|]{2,}')
+
+
 def findMatchingBraces(text, ldelim=0):
     """
     :param ldelim: number of braces to match. 0 means match [[]], {{}} and {{{}}}.
@@ -1219,31 +1608,25 @@ def findMatchingBraces(text, ldelim=0):
     # as well as expressions with stray }:
     #   {{{link|{{ucfirst:{{{1}}}}}} interchange}}}
 
-    if ldelim:  # 2-3
-        reOpen = re.compile('[{]{%d,}' % ldelim)  # at least ldelim
-        reNext = re.compile('[{]{2,}|}{2,}')  # at least 2
-    else:
-        reOpen = re.compile('{{2,}|\[{2,}')
-        reNext = re.compile('{{2,}|}{2,}|\[{2,}|]{2,}')  # at least 2
-
-    cur = 0
-    while True:
-        m1 = reOpen.search(text, cur)
-        if not m1:
-            return
-        lmatch = m1.end() - m1.start()
-        if m1.group()[0] == '{':
+    # The runs of delimiters are scanned once, in a single pass over text.
+    runs = (braceRunsRE if ldelim else delimiterRunsRE).finditer(text)
+    for m1 in runs:
+        start, end = m1.span()
+        brac = text[start]
+        lmatch = end - start
+        # opening run of at least ldelim braces, or of brackets
+        if brac == '{':
+            if lmatch < ldelim:
+                continue
             stack = [lmatch]  # stack of opening braces lengths
-        else:
+        elif brac == '[':
             stack = [-lmatch]  # negative means [
-        end = m1.end()
-        while True:
-            m2 = reNext.search(text, end)
-            if not m2:
-                return  # unbalanced
-            end = m2.end()
-            brac = m2.group()[0]
-            lmatch = m2.end() - m2.start()
+        else:
+            continue
+        for m2 in runs:
+            s, end = m2.span()
+            brac = text[s]
+            lmatch = end - s
 
             if brac == '{':
                 stack.append(lmatch)
@@ -1261,13 +1644,11 @@ def findMatchingBraces(text, ldelim=0):
                         stack.append(openCount - lmatch)
                         break
                 if not stack:
-                    yield m1.start(), end - lmatch
-                    cur = end
+                    yield start, end - lmatch
                     break
                 elif len(stack) == 1 and 0 < stack[0] < ldelim:
                     # ambiguous {{{{{ }}} }}
-                    #yield m1.start() + stack[0], end
-                    cur = end
+                    #yield start + stack[0], end
                     break
             elif brac == '[':  # [[
                 stack.append(-lmatch)
@@ -1283,53 +1664,37 @@ def findMatchingBraces(text, ldelim=0):
                         stack.append(lmatch - openCount)
                         break
                 if not stack:
-                    yield m1.start(), end - lmatch
-                    cur = end
+                    yield start, end - lmatch
                     break
                 # unmatched ]] are discarded
-                cur = end
+        else:
+            return  # unbalanced
 
 
-def findBalanced(text, openDelim=['[['], closeDelim=[']]']):
+def findBalancedLinks(text):
     """
-    Assuming that text contains a properly balanced expression using
-    :param openDelim: as opening delimiters and
-    :param closeDelim: as closing delimiters.
+    Assuming that :param text: contains properly balanced links, find them
+    in a single scan of the runs of brackets.
     :return: an iterator producing pairs (start, end) of start and end
-    positions in text containing a balanced expression.
+    positions in text of the outermost [[...]], with any nested links.
     """
-    openPat = '|'.join([re.escape(x) for x in openDelim])
-    # pattern for delimiters expected after each opening delimiter
-    afterPat = {o: re.compile(openPat + '|' + c, re.DOTALL) for o, c in zip(openDelim, closeDelim)}
-    stack = []
+    depth = 0
     start = 0
-    cur = 0
-    # end = len(text)
-    startSet = False
-    startPat = re.compile(openPat)
-    nextPat = startPat
-    while True:
-        next = nextPat.search(text, cur)
-        if not next:
-            return
-        if not startSet:
-            start = next.start()
-            startSet = True
-        delim = next.group(0)
-        if delim in openDelim:
-            stack.append(delim)
-            nextPat = afterPat[delim]
-        else:
-            opening = stack.pop()
-            # assert opening == openDelim[closeDelim.index(next.group(0))]
-            if stack:
-                nextPat = afterPat[stack[-1]]
+    for m in bracketRunsRE.finditer(text):
+        s, e = m.span()
+        # a run of n brackets holds n // 2 delimiters
+        count = (e - s) // 2
+        if text[s] == '[':
+            if not depth:
+                start = s
+            depth += count
+        elif depth:
+            # closing delimiters after the balancing one are ignored
+            if count >= depth:
+                yield start, s + 2 * depth
+                depth = 0
             else:
-                yield start, next.end()
-                nextPat = startPat
-                start = next.end()
-                startSet = False
-        cur = next.end()
+                depth -= count
 
 
 # ----------------------------------------------------------------------
@@ -1724,6 +2089,32 @@ def normalizeNamespace(ns):
     return ucfirst(ns)
 
 
+def expansionNames(names):
+    """
+    :param names: names of templates, with or without their namespace, or of
+    parser functions.
+    :return: the set of the names, with spaces for underscores, both as given
+    and with the first letter uppercase as in the titles of templates.
+    """
+    expanded = set()
+    for name in names:
+        name = name.strip().replace('_', ' ')
+        expanded.add(name)
+        expanded.add(ucfirst(name))
+    return expanded
+
+
+def inTemplateNames(title, names):
+    """
+    :return: whether title, possibly in the template namespace, is in the set
+    names returned by expansionNames().
+    """
+    if title in names:
+        return True
+    prefix = options.templatePrefix
+    return bool(prefix) and title.startswith(prefix) and title[len(prefix):] in names
+
+
 # ----------------------------------------------------------------------
 # Parser functions
 # see http://www.mediawiki.org/wiki/Help:Extension:ParserFunctions
@@ -1869,6 +2260,14 @@ def sharp_invoke(module, function, args):
     return ''
 
 
+# The parser functions whose result depends only on their arguments: their
+# invocations are memoized, unless they expand magic words.
+memoizedParserFunctions = frozenset([
+    '#expr', '#if', '#ifeq', '#iferror', '#switch', '#invoke',
+    'urlencode', 'lc', 'lcfirst', 'uc', 'ucfirst', 'int',
+])
+
+
 parserFunctions = {
 
     '#expr': sharp_expr,
@@ -1936,6 +2335,8 @@ def callParserFunction(functionName, args, extractor):
                 if not templateTitle:
                     logging.warn("Template with empty title")
                 params = None
+                # the result depends on the frame
+                extractor.impure = True
                 frame = extractor.frame
                 while frame:
                     if frame.title == templateTitle:
@@ -2032,12 +2433,26 @@ def dropNested(text, openDelim, closeDelim):
     """
     openRE = re.compile(openDelim, re.IGNORECASE)
     closeRE = re.compile(closeDelim, re.IGNORECASE)
+    spans = nestedSpans(text, openRE, closeRE)
+    if not spans:
+        return text
+    return dropSpans(spans, text)
+
+
+def nestedSpans(text, openRE, closeRE):
+    """
+    :param openRE: matcher of the opening delimiters, with the search() method
+    of regular expressions.
+    :param closeRE: matcher of the closing delimiters.
+    :return: the list of pairs (start, end) of the nested expressions in
+    :param text:, as removed by dropNested().
+    """
     # partition text in separate blocks { } { }
     spans = []                  # pairs (s, e) for each partition
     nest = 0                    # nesting level
     start = openRE.search(text, 0)
     if not start:
-        return text
+        return spans
     end = closeRE.search(text, start.end())
     next = start
     while end:
@@ -2075,8 +2490,7 @@ def dropNested(text, openDelim, closeDelim):
         if next != start:
             # { { }
             nest += 1
-    # collect text outside partitions
-    return dropSpans(spans, text)
+    return spans
 
 
 def dropSpans(spans, text):
@@ -2084,15 +2498,136 @@ def dropSpans(spans, text):
     Drop from text the blocks identified in :param spans:, possibly nested.
     """
     spans.sort()
-    res = ''
+    res = []
     offset = 0
     for s, e in spans:
         if offset <= s:         # handle nesting
             if offset < s:
-                res += text[offset:s]
+                res.append(text[offset:s])
             offset = e
-    res += text[offset:]
-    return res
+    res.append(text[offset:])
+    return ''.join(res)
+
+
+# Match a comment, or a tag with its leading spaces, slash, name and attributes
+fusedTagRE = re.compile(r'<!--.*?-->|<(\s*)(/?)\s*(\w+)([^>]*)>', re.DOTALL)
+
+
+class TagMatch(object):
+    """
+    A tag found by dropTags(), with the start() and end() of a match.
+    """
+    __slots__ = ('s', 'e')
+
+    def __init__(self, s, e):
+        self.s = s
+        self.e = e
+
+    def start(self):
+        return self.s
+
+    def end(self):
+        return self.e
+
+
+class TagMatcher(object):
+    """
+    The opening or closing tags of an element found by dropTags(), searched
+    as with a regular expression by nestedSpans().
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, s, e):
+        self.starts.append(s)
+        self.ends.append(e)
+
+    def search(self, text, pos):
+        i = bisect_left(self.starts, pos)
+        if i < len(self.starts):
+            return TagMatch(self.starts[i], self.ends[i])
+        return None
+
+    def outside(self, spans):
+        """
+        :return: the matcher of the tags that do not start inside the sorted
+        disjoint :param spans:.
+        """
+        if not spans:
+            return self
+        matcher = TagMatcher()
+        ends = [e for s, e in spans]
+        for s, e in zip(self.starts, self.ends):
+            i = bisect_right(ends, s)
+            if i == len(spans) or s < spans[i][0]:
+                matcher.add(s, e)
+        return matcher
+
+
+def dropTags(text):
+    """
+    Removes from :param text: the comments, the self-closing and the ignored
+    tags, and the discarded elements, like the separate passes of
+    Extractor.clean() do, with a single scan of its tags.
+    """
+    spans = []
+    opening = {tag.lower(): TagMatcher() for tag in options.discardElements}
+    closing = {tag: TagMatcher() for tag in opening}
+    ignored = options.ignored_tag_names
+    m = fusedTagRE.search(text)
+    while m:
+        name = m.group(3)
+        if name is None:        # comment
+            spans.append(m.span())
+            m = fusedTagRE.search(text, m.end())
+            continue
+        name = name.lower()
+        lead, slash, attrs = m.group(1, 2, 4)
+        if slash:
+            if not lead and not attrs and name in ignored:
+                # </tag>
+                spans.append(m.span())
+                m = fusedTagRE.search(text, m.end())
+                continue
+            if not attrs and name in closing:
+                closing[name].add(m.start(), m.end())
+        elif (name in selfClosingTags and attrs.rstrip().endswith('/')) or \
+                (not lead and name in ignored):
+            spans.append(m.span())
+            m = fusedTagRE.search(text, m.end())
+            continue
+        elif '/' not in attrs and name in opening:
+            opening[name].add(m.start(), m.end())
+        # tags may start within the attributes of this one
+        m = fusedTagRE.search(text, m.start() + 1)
+
+    # elements are removed in turn, each from what is left by the ones before
+    dropped = spans[:]
+    for tag in opening:
+        if not opening[tag].starts:
+            continue
+        nested = nestedSpans(text, opening[tag].outside(dropped),
+                             closing[tag].outside(dropped))
+        if nested:
+            spans.extend(nested)
+            dropped = mergeSpans(dropped + nested)
+    return dropSpans(spans, text)
+
+
+def mergeSpans(spans):
+    """
+    :return: the sorted disjoint spans covering :param spans:.
+    """
+    merged = []
+    for s, e in sorted(spans):
+        if merged and s <= merged[-1][1]:
+            if e > merged[-1][1]:
+                merged[-1] = (merged[-1][0], e)
+        else:
+            merged.append((s, e))
+    return merged
 
 
 # ----------------------------------------------------------------------
@@ -2114,8 +2649,8 @@ def replaceInternalLinks(text):
     # call this after removal of external links, so we need not worry about
     # triple closing ]]].
     cur = 0
-    res = ''
-    for s, e in findBalanced(text):
+    res = []
+    for s, e in findBalancedLinks(text):
         m = tailRE.match(text, e)
         if m:
             trail = m.group(0)
@@ -2133,15 +2668,18 @@ def replaceInternalLinks(text):
             title = inner[:pipe].rstrip()
             # find last |
             curp = pipe + 1
-            for s1, e1 in findBalanced(inner):
+            for s1, e1 in findBalancedLinks(inner):
                 last = inner.rfind('|', curp, s1)
                 if last >= 0:
                     pipe = last  # advance
                 curp = e1
             label = inner[pipe + 1:].strip()
-        res += text[cur:s] + makeInternalLink(title, label) + trail
+        res.append(text[cur:s])
+        res.append(makeInternalLink(title, label))
+        res.append(trail)
         cur = end
-    return res + text[cur:]
+    res.append(text[cur:])
+    return ''.join(res)
 
 
 # the official version is a method in class Parser, similar to this:
@@ -2445,16 +2983,16 @@ wgUrlProtocols = [
 EXT_LINK_URL_CLASS = r'[^][<>"\x00-\x20\x7F\s]'
 ANCHOR_CLASS = r'[^][\x00-\x08\x0a-\x1F]'
 ExtLinkBracketedRegex = re.compile(
-    '\[(((?i)' + '|'.join(wgUrlProtocols) + ')' + EXT_LINK_URL_CLASS + r'+)' +
+    '\[((' + '|'.join(wgUrlProtocols) + ')' + EXT_LINK_URL_CLASS + r'+)' +
     r'\s*((?:' + ANCHOR_CLASS + r'|\[\[' + ANCHOR_CLASS + r'+\]\])' + r'*?)\]',
-    re.S | re.U)
+    re.S | re.U | re.I)
 # A simpler alternative:
 # ExtLinkBracketedRegex = re.compile(r'\[(.*?)\](?!])')
 
 EXT_IMAGE_REGEX = re.compile(
     r"""^(http://|https://)([^][<>"\x00-\x20\x7F\s]+)
-    /([A-Za-z0-9_.,~%\-+&;#*?!=()@\x80-\xFF]+)\.((?i)gif|png|jpg|jpeg)$""",
-    re.X | re.S | re.U)
+    /([A-Za-z0-9_.,~%\-+&;#*?!=()@\x80-\xFF]+)\.(gif|png|jpg|jpeg)$""",
+    re.X | re.S | re.U | re.I)
 
 
 def replaceExternalLinks(text):
@@ -2462,10 +3000,10 @@ def replaceExternalLinks(text):
     https://www.mediawiki.org/wiki/Help:Links#External_links
     [URL anchor text]
     """
-    s = ''
+    res = []
     cur = 0
     for m in ExtLinkBracketedRegex.finditer(text):
-        s += text[cur:m.start()]
+        res.append(text[cur:m.start()])
         cur = m.end()
 
         url = m.group(1)
@@ -2489,9 +3027,10 @@ def replaceExternalLinks(text):
         # This means that users can paste URLs directly into the text
         # Funny characters like ö aren't valid in URLs anyway
         # This was changed in August 2004
-        s += makeExternalLink(url, label)  # + trail
+        res.append(makeExternalLink(url, label))  # + trail
 
-    return s + text[cur:]
+    res.append(text[cur:])
+    return ''.join(res)
 
 
 def makeExternalLink(url, anchor):
@@ -2749,7 +3288,7 @@ def load_templates(file, output_file=None):
 
     if output_file:
         output = codecs.open(output_file, 'wb', 'utf-8')
-    for page_count, page_data in enumerate(pages_from(file)):
+    for page_count, page_data in enumerate(read_pages(file)):
         id, revid, title, ns,catSet, page = page_data
         if not output_file and (not options.templateNamespace or
                                 not options.moduleNamespace):  # do not know it yet
@@ -2854,23 +3393,207 @@ def pages_from(input):
             page = []
 
 
-def process_dump(input_file, template_file, out_file, file_size, file_compress,
-                 process_count):
+# Size of the blocks read by the buffer reader
+readBlockSize = 1024 * 1024
+
+
+def buffer_pages_from(input):
+    """
+    Scans input extracting pages, like pages_from(), but searching for the
+    tags of the pages in large buffers of bytes, and decoding only their
+    title and text.
+    :param input: an iterator over bytes or strings of any size, e.g. the
+    blocks of the dump.
+    :return: (id, revid, title, namespace key, page), page is a list of lines.
+    """
+    pieces = []
+    size = 0
+    # scan once this many bytes are pending: it is doubled while a page is
+    # incomplete, so that the pieces of a large page are not joined too often
+    wanted = readBlockSize
+    last_id = None
+    for data in chain(input, [None]):
+        if data is not None:
+            if not isinstance(data, bytes): data = data.encode('utf-8')
+            pieces.append(data)
+            size += len(data)
+            if size < wanted:
+                continue
+        buffer = b''.join(pieces)
+        start = 0
+        for start, page_data in buffer_pages(buffer):
+            if page_data and page_data[0] != last_id:
+                yield page_data
+                last_id = page_data[0]
+        pieces = [buffer[start:]]
+        size = len(pieces[0])
+        wanted = max(readBlockSize, 2 * size)
+
+
+def buffer_pages(buffer):
+    """
+    Scans the complete pages in buffer.
+    :return: an iterator over (offset of the end of the page, page data),
+    where the page data is as from pages_from(), or None for a redirect.
+    """
+    start = 0
+    while True:
+        end = buffer.find(b'</page>', start)
+        if end < 0:
+            return
+        begin = buffer.find(b'<page>', start, end)
+        start = end + len(b'</page>')
+        if begin < 0:
+            continue
+        text = buffer.find(b'<text', begin, end)
+        header = end if text < 0 else text
+        if buffer.find(b'<redirect', begin, header) >= 0:
+            yield start, None
+            continue
+        id = buffer_tag(buffer, b'<id>', begin, header)
+        revid = None
+        last = buffer.rfind(b'<id>', begin, header)
+        if last != buffer.find(b'<id>', begin, header):
+            revid = buffer_tag(buffer, b'<id>', last, header)
+        title = buffer_tag(buffer, b'<title>', begin, header)
+        ns = buffer_tag(buffer, b'<ns>', begin, header) or '0'
+        catSet = set()
+        page = []
+        if text >= 0:
+            text = buffer.find(b'>', text, end) + 1
+            if buffer[text - 2:text - 1] != b'/': # not self closing
+                text_end = buffer.find(b'</text>', text, end)
+                if text_end < 0:
+                    text_end = end
+                text = buffer[text:text_end].decode('utf-8')
+                # the same lines as pages_from()
+                page = text.split('\n')
+                rest = page.pop()
+                page = [line + '\n' for line in page]
+                if rest or not page:
+                    page.append(rest)
+                if '[[Category:' in text:
+                    # extract categories, as pages_from() does, from the
+                    # lines after the one of the <text> tag, whole
+                    for line in page[1:]:
+                        if line[-1:] == '\n' and line.lstrip().startswith('[[Category:'):
+                            mCat = catRE.search(line)
+                            if mCat:
+                                catSet.add(mCat.group(1))
+        yield start, (id, revid, title, ns, catSet, page)
+
+
+def buffer_tag(buffer, tag, start, end):
+    """
+    :return: the decoded text following the first :param tag: in buffer
+    between start and end, up to the next tag, or None.
+    """
+    i = buffer.find(tag, start, end)
+    if i < 0:
+        return None
+    i += len(tag)
+    return buffer[i:buffer.find(b'<', i)].decode('utf-8')
+
+
+def read_pages(input, reader=None):
+    """
+    :param input: the lines of the dump, or its blocks for the buffer reader.
+    :param reader: the reader to use, options.reader by default.
+    :return: the pages of input, as from pages_from().
+    """
+    if (reader or options.reader) == 'buffers':
+        return buffer_pages_from(input)
+    return pages_from(input)
+
+
+def dump_blocks(input_file, process_count=1):
     """
     :param input_file: name of the wikipedia dump file; '-' to read from stdin
-    :param template_file: optional file with template definitions.
-    :param out_file: directory where to store extracted data, or '-' for stdout
-    :param file_size: max size of each extracted file, or None for no max (one file)
-    :param file_compress: whether to compress files with bzip.
-    :param process_count: number of extraction processes to spawn.
+    :param process_count: number of processes that decompress the blocks of
+    a .bz2 dump, if options.parallel_bz2.
+    :return: an iterator over blocks of bytes of the dump, for the buffer
+    reader.
     """
+    if input_file.endswith('.bz2') and options.parallel_bz2 and process_count > 1:
+        return bz2_blocks(input_file, process_count)
+    return file_blocks(input_file)
 
+
+def file_blocks(input_file):
+    """
+    :return: an iterator over blocks of bytes of a dump file, decompressed
+    if it is a .bz2 or .gz file; '-' to read from stdin.
+    """
     if input_file == '-':
-        input = sys.stdin
+        file = sys.stdin.buffer
+    elif input_file.endswith('.bz2'):
+        file = bz2.open(input_file)
+    elif input_file.endswith('.gz'):
+        file = gzip.open(input_file)
+    else:
+        file = open(input_file, 'rb')
+    try:
+        while True:
+            data = file.read(readBlockSize)
+            if not data:
+                break
+            yield data
+    finally:
+        if file is not sys.stdin.buffer:
+            file.close()
+
+
+def split_header(blocks):
+    """
+    Split the <siteinfo> header from the blocks of a dump.
+    :return: the lines of the header, and an iterator over the rest of the
+    blocks.
+    """
+    pieces = []
+    for data in blocks:
+        pieces.append(data)
+        if b'</siteinfo>' in b''.join(pieces[-2:]):
+            break
+    header = b''.join(pieces)
+    end = header.find(b'</siteinfo>')
+    if end < 0:
+        end = len(header)
     else:
-        input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+        end += len(b'</siteinfo>')
+    return header[:end].decode('utf-8').splitlines(True), blocks_after(header[end:], blocks)
+
+
+def blocks_after(data, blocks):
+    """
+    :return: an iterator over data followed by blocks, closing them at the end.
+    """
+    try:
+        yield data
+        for data in blocks:
+            yield data
+    finally:
+        blocks.close()
+
+
+def open_dump(input_file, process_count=1):
+    """
+    :param input_file: name of the wikipedia dump file; '-' to read from stdin
+    :param process_count: number of processes that decompress the blocks of
+    a .bz2 dump, if options.parallel_bz2.
+    :return: an iterator over the lines of the dump.
+    """
+    if input_file == '-':
+        return sys.stdin
+    if input_file.endswith('.bz2') and options.parallel_bz2 and process_count > 1:
+        return bz2_lines(input_file, process_count)
+    return fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+
 
-    # collect siteinfo
+def collect_siteinfo(input):
+    """
+    Read the <siteinfo> header of the dump into options.
+    :param input: the lines of the dump, left after the header.
+    """
     for line in input:
         # When an input file is .bz2 or .gz, line can be a bytes even in Python 3.
         if not isinstance(line, text_type): line = line.decode('utf-8')
@@ -2878,7 +3601,9 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
         if not m:
             continue
         tag = m.group(2)
-        if tag == 'base':
+        if tag == 'dbname':
+            options.dbname = m.group(3)
+        elif tag == 'base':
             # discover urlbase from the xml dump file
             # /mediawiki/siteinfo/base
             base = m.group(3)
@@ -2899,90 +3624,133 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
         elif tag == '/siteinfo':
             break
 
-    if options.expand_templates:
-        # preprocess
-        template_load_start = default_timer()
-        if template_file:
-            if os.path.exists(template_file):
-                logging.info("Loading template definitions from: %s", template_file)
-                # can't use with here:
-                file = fileinput.FileInput(template_file,
-                                           openhook=fileinput.hook_compressed)
-                load_templates(file)
-                file.close()
-            else:
-                if input_file == '-':
-                    # can't scan then reset stdin; must error w/ suggestion to specify template_file
-                    raise ValueError("to use templates with stdin dump, must supply explicit template-file")
-                logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", input_file)
-                load_templates(input, template_file)
-                input.close()
-                input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
-        template_load_elapsed = default_timer() - template_load_start
-        logging.info("Loaded %d templates in %.1fs", len(options.templates), template_load_elapsed)
-
-    # process pages
-    logging.info("Starting page extraction from %s.", input_file)
-    extract_start = default_timer()
-
-    # Parallel Map/Reduce:
-    # - pages to be processed are dispatched to workers
-    # - a reduce process collects the results, sort them and print them.
 
-    process_count = max(1, process_count)
-    maxsize = 10 * process_count
-    # output queue
-    output_queue = Queue(maxsize=maxsize)
+def preload_templates(input, input_file, template_file):
+    """
+    Load the template definitions, from the snapshot of the dump in
+    options.template_snapshots if it exists, otherwise from
+    :param template_file: if it exists, otherwise by scanning the dump and
+    saving them to :param template_file:. A missing snapshot, or one saved
+    by another version or with other namespaces, is created.
+    :param input: the lines of the dump, after the <siteinfo> header.
+    :param input_file: name of the wikipedia dump file.
+    :return: whether the input was scanned.
+    """
+    scanned = False
+    if not options.expand_templates:
+        return scanned
+    # preprocess
+    template_load_start = default_timer()
+    snapshot = template_snapshot(input_file)
+    if snapshot and os.path.exists(snapshot) and template_snapshot_current(snapshot):
+        logging.info("Loading template snapshot: %s", snapshot)
+        options.templates, options.redirects = open_template_store(snapshot)
+    elif template_file or snapshot:
+        if template_file and os.path.exists(template_file):
+            logging.info("Loading template definitions from: %s", template_file)
+            # can't use with here:
+            file = fileinput.FileInput(template_file,
+                                       openhook=fileinput.hook_compressed)
+            load_templates(file)
+            file.close()
+        else:
+            if input_file == '-':
+                # can't scan then reset stdin; must error w/ suggestion to specify template_file
+                raise ValueError("to use templates with stdin dump, "
+                                 "must supply explicit template-file")
+            logging.info("Preprocessing '%s' to collect template definitions: "
+                         "this may take some time.", input_file)
+            load_templates(input, template_file)
+            scanned = True
+        if snapshot:
+            save_template_snapshot(snapshot)
+            logging.info("Saved template snapshot: %s", snapshot)
+    template_load_elapsed = default_timer() - template_load_start
+    logging.info("Loaded %d templates in %.1fs", len(options.templates), template_load_elapsed)
+    return scanned
+
+
+def dump_pages(input_file, template_file, process_count, index_file=None):
+    """
+    Read the <siteinfo> header of a dump into options and load the templates.
+    :param input_file: name of the wikipedia dump file; '-' to read from stdin
+    :param template_file: optional file with template definitions.
+    :param process_count: number of processes that decompress and parse the
+    streams of a multistream dump, unless options.decompress_processes.
+    :param index_file: the index of a multistream dump, or None.
+    :return: an iterator over the pages of the dump, as from pages_from().
+    """
+    process_count = options.decompress_processes or process_count
+    if index_file:
+        streams = multistream_ranges(input_file, index_file)
+        logging.info("Reading %d streams of %s.", len(streams) - 1, input_file)
+        collect_siteinfo(read_stream(input_file, *streams[0]))
+        if options.reader == 'buffers':
+            input = multistream_blocks(input_file, streams[1:], process_count)
+        else:
+            input = multistream_lines(input_file, streams[1:], process_count)
+        preload_templates(input, input_file, template_file)
+        return multistream_pages(input_file, streams[1:], process_count)
+    input = open_pages(input_file, process_count)
+    if preload_templates(input, input_file, template_file):
+        input.close()
+        if options.reader == 'buffers':
+            input = dump_blocks(input_file, process_count)
+        else:
+            input = open_dump(input_file, process_count)
+    return closing_pages(input)
 
-    if out_file == '-':
-        out_file = None
 
-    worker_count = process_count
+def open_pages(input_file, process_count=1):
+    """
+    Open a dump and read its <siteinfo> header into options.
+    :return: the input after the header: its lines, or its blocks for the
+    buffer reader.
+    """
+    if options.reader == 'buffers':
+        header, input = split_header(dump_blocks(input_file, process_count))
+        collect_siteinfo(header)
+    else:
+        input = open_dump(input_file, process_count)
+        collect_siteinfo(input)
+    return input
 
-    # load balancing
-    max_spool_length = 10000
-    spool_length = Value('i', 0, lock=False)
 
-    # reduce job that sorts and prints output
-    reduce = Process(target=reduce_process,
-                     args=(options, output_queue, spool_length,
-                           out_file, file_size, file_compress))
-    reduce.start()
+def closing_pages(input):
+    """
+    :return: the pages of input, as from pages_from(), closing it at the end.
+    """
+    try:
+        for page_data in read_pages(input):
+            yield page_data
+    finally:
+        input.close()
 
-    # initialize jobs queue
-    jobs_queue = Queue(maxsize=maxsize)
 
-    # start worker processes
-    logging.info("Using %d extract processes.", worker_count)
+def start_workers(process_count, jobs_queue, output_queue, records=False,
+                  stats=None, cache_counts=None, first=0):
+    """
+    :param process_count: number of extraction processes to spawn.
+    :param records: whether the workers output (id, revid, title, text) records.
+    :param stats: the PipelineStats to update, or None.
+    :param cache_counts: shared array where the workers add the hits, misses
+    and evictions of their template and expansion caches, or None.
+    :param first: index of the first worker, in the counters of stats.
+    :return: the list of started worker processes.
+    """
+    logging.info("Using %d extract processes.", process_count)
     workers = []
-    for i in range(worker_count):
+    for i in range(first, first + process_count):
         extractor = Process(target=extract_process,
-                            args=(options, i, jobs_queue, output_queue))
+                            args=(options, i, jobs_queue, output_queue, records,
+                                  stats, cache_counts))
         extractor.daemon = True  # only live while parent process lives
         extractor.start()
         workers.append(extractor)
+    return workers
 
-    # Mapper process
-    page_num = 0
-    for page_data in pages_from(input):
-        id, revid, title, ns, catSet, page = page_data
-        if keepPage(ns, catSet, page):
-            # slow down
-            delay = 0
-            if spool_length.value > max_spool_length:
-                # reduce to 10%
-                while spool_length.value > max_spool_length/10:
-                    time.sleep(10)
-                    delay += 10
-            if delay:
-                logging.info('Delay %ds', delay)
-            job = (id, revid, title, page, page_num)
-            jobs_queue.put(job) # goes to any available extract_process
-            page_num += 1
-        page = None             # free memory
-
-    input.close()
 
+def stop_workers(workers, jobs_queue):
     # signal termination
     for _ in workers:
         jobs_queue.put(None)
@@ -2990,69 +3758,1603 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
     for w in workers:
         w.join()
 
-    # signal end of work to reduce process
-    output_queue.put(None)
-    # wait for it to finish
-    reduce.join()
-
-    extract_duration = default_timer() - extract_start
-    extract_rate = page_num / extract_duration
-    logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)",
-                 process_count, page_num, extract_duration, extract_rate)
-    logging.info("total of page: %d, total of articl page: %d; total of used articl page: %d" % (g_page_total, g_page_articl_total,g_page_articl_used_total))
-
-
-# ----------------------------------------------------------------------
-# Multiprocess support
 
+# load balancing
 
-def extract_process(opts, i, jobs_queue, output_queue):
-    """Pull tuples of raw page content, do CPU/regex-heavy fixup, push finished text
-    :param i: process id.
-    :param jobs_queue: where to get jobs.
-    :param output_queue: where to queue extracted text for output.
+class FlowControl(object):
+    """
+    Bounds the pages in flight, i.e. dispatched to the extract processes but
+    not output yet, and their characters, so that the mapper does not run
+    ahead of the output. The mapper blocks in acquire() until the output
+    releases enough pages.
+    With readers of byte ranges and ordered output, the pages of the range
+    that the output is waiting for are always dispatched: the pages in flight
+    could all be waiting for them.
+    Also shares the length and size of the reorder spool of the output, for
+    reporting.
     """
 
-    global options
-    options = opts
-
-    createLogger(options.quiet, options.debug, options.log_file)
+    def __init__(self, max_pages, max_size):
+        """
+        :param max_pages: maximum number of pages in flight.
+        :param max_size: maximum number of characters of the pages in flight.
+        """
+        self.max_pages = max_pages
+        self.max_size = max_size
+        self.condition = Condition()
+        self.pages = Value('l', 0, lock=False)
+        self.size = Value('l', 0, lock=False)
+        self.spool_length = Value('l', 0, lock=False)
+        self.spool_size = Value('l', 0, lock=False)
+        self.output_range = Value('l', 0, lock=False)
+
+    def has_room(self, size, range_index=None):
+        # a page larger than max_size goes alone
+        return self.pages.value == 0 or range_index == self.output_range.value or \
+            (self.pages.value < self.max_pages and
+             self.size.value + size <= self.max_size)
+
+    def try_acquire(self, size, range_index=None):
+        """
+        Count a page of size characters as in flight, if there is room.
+        :param range_index: the byte range of the page, with ordered output.
+        :return: whether there was room.
+        """
+        with self.condition:
+            if not self.has_room(size, range_index):
+                return False
+            self.pages.value += 1
+            self.size.value += size
+        return True
 
-    out = StringIO()                 # memory buffer
+    def acquire(self, size, range_index=None):
+        """
+        Wait until a page of size characters can be dispatched.
+        :param range_index: the byte range of the page, with ordered output.
+        :return: the seconds waited.
+        """
+        with self.condition:
+            if self.has_room(size, range_index):
+                wait = 0
+            else:
+                wait_start = default_timer()
+                self.condition.wait_for(lambda: self.has_room(size, range_index))
+                wait = default_timer() - wait_start
+            self.pages.value += 1
+            self.size.value += size
+        return wait
+
+    def release(self, size):
+        """Release a page of size characters, once it is output."""
+        with self.condition:
+            self.pages.value -= 1
+            self.size.value -= size
+            # there may be several readers
+            self.condition.notify_all()
+
+    def update_spool(self, spool):
+        self.spool_length.value = len(spool)
+        self.spool_size.value = spool.size
+        output_range = spool.next_page >> rangeShift
+        if output_range != self.output_range.value:
+            with self.condition:
+                self.output_range.value = output_range
+                self.condition.notify_all()
+
+    def queues(self):
+        """:return: the counters to report, by name."""
+        return dict(in_flight=self.pages, in_flight_size=self.size,
+                    spool=self.spool_length, spool_size=self.spool_size)
+
+
+def flow_control(opts):
+    return FlowControl(opts.max_in_flight_pages, opts.max_in_flight_size)
+
+
+# batching of jobs and results
+max_batch_pages = 100           # pages
+max_batch_size = 1024 * 1024    # characters
+large_page_size = 64 * 1024     # characters of a page that is sent alone
+
+class JobBatcher(object):
+    """
+    Groups the jobs of small pages into batches, so that each costs one
+    put() to the jobs queue, one pickling and one put() of the results.
+    A batch is sent when it has max_pages pages or max_batch_size
+    characters. max_pages adapts: it doubles, up to max_batch_pages, while
+    the workers have batches waiting, and halves when they run out of them.
+    Large pages are sent alone, so that they don't delay a batch.
+    """
 
+    def __init__(self, jobs_queue):
+        self.jobs_queue = jobs_queue
+        self.batch = []
+        self.size = 0           # characters in batch
+        self.max_pages = 1
 
-    while True:
-        job = jobs_queue.get()  # job is (id, title, page, page_num)
-        if job:
-            id, revid, title, page, page_num = job
-            try:
-                e = Extractor(*job[:4]) # (id, revid, title, page)
-                page = None              # free memory
-                e.extract(out)
-                text = out.getvalue()
-            except:
-                text = ''
-                logging.exception('Processing page: %s %s', id, title)
-
-            output_queue.put((page_num, text))
-            out.truncate(0)
-            out.seek(0)
+    def add(self, job, size):
+        """Add a job for a page of size characters."""
+        if size >= large_page_size:
+            self.jobs_queue.put([job])
+            return
+        self.batch.append(job)
+        self.size += size
+        if len(self.batch) >= self.max_pages or self.size >= max_batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send the batch."""
+        if not self.batch:
+            return
+        if self.jobs_queue.empty():
+            self.max_pages = max(1, self.max_pages // 2)
         else:
-            logging.debug('Quit extractor')
-            break
-    out.close()
+            self.max_pages = min(max_batch_pages, self.max_pages * 2)
+        self.jobs_queue.put(self.batch) # goes to any available extract_process
+        self.batch = []
+        self.size = 0
 
 
-report_period = 10000           # progress report period
-def reduce_process(opts, output_queue, spool_length,
-                   out_file=None, file_size=0, file_compress=True):
-    """Pull finished article text, write series of files (or stdout)
+def map_pages(pages, jobs_queue, flow, stats=None, range_index=None):
+    """
+    Dispatch the pages to keep to the workers, numbered in order, in batches.
+    :param pages: the pages of the dump, as from pages_from().
+    :param flow: the FlowControl of the pages in flight.
+    :param stats: the PipelineStats to update, or None.
+    :param range_index: the index of the byte range of the pages, which is
+    the high part of their numbers, if the dump is read by range readers.
+    :return: the number of pages dispatched.
+    """
+    page_num = 0
+    first_page = 0
+    if range_index is not None:
+        first_page = range_index << rangeShift
+        if not options.ordered:
+            # no page waits for the ones of a range
+            range_index = None
+    batcher = JobBatcher(jobs_queue)
+    for page_data in pages:
+        if stats:
+            with stats.pages_read.get_lock():
+                stats.pages_read.value += 1
+        id, revid, title, ns, catSet, page = page_data
+        if keepPage(ns, catSet, page):
+            size = sum(len(line) for line in page)
+            if not flow.try_acquire(size, range_index):
+                # the output may be waiting for a page of the batch
+                batcher.flush()
+                # slow down
+                delay = flow.acquire(size, range_index)
+                if delay > 1:
+                    logging.debug('Delay %.1fs', delay)
+            job = (id, revid, title, page, first_page + page_num, size)
+            batcher.add(job, size)
+            page_num += 1
+        page = None             # free memory
+    batcher.flush()
+    return page_num
+
+
+def process_dump(input_file, template_file, out_file, file_size, file_compress,
+                 process_count, opts=None, index_file=None, stats=None):
+    """
+    :param input_file: name of the wikipedia dump file; '-' to read from stdin
+    :param template_file: optional file with template definitions.
+    :param out_file: directory where to store extracted data, or '-' for stdout
+    :param file_size: max size of each extracted file, or None for no max (one file)
+    :param file_compress: whether to compress files with bzip.
+    :param process_count: number of extraction processes to spawn.
+    :param opts: options to use instead of the global options, which are
+    restored at the end.
+    :param index_file: the index of a multistream dump; by default the one
+    next to input_file, if any.
+    :param stats: a PipelineStats, to report the throughput of the stages.
+    """
+    global options
+    if opts is not None:
+        saved_options = options
+        options = opts
+        try:
+            return process_dump(input_file, template_file, out_file, file_size,
+                                file_compress, process_count,
+                                index_file=index_file, stats=stats)
+        finally:
+            options = saved_options
+
+    process_count = max(1, process_count)
+    index_file = index_file or multistream_index(input_file)
+    ranges = dump_ranges(input_file, template_file, index_file)
+    if ranges is None:
+        pages = dump_pages(input_file, template_file, process_count, index_file)
+    with shared_templates():
+
+        # process pages
+        logging.info("Starting page extraction from %s.", input_file)
+        extract_start = default_timer()
+
+        # Parallel Map/Reduce:
+        # - pages to be processed are dispatched to workers
+        # - a reduce process collects the results, sort them and print them.
+
+        maxsize = 10 * process_count
+        # output queue
+        output_queue = Queue(maxsize=maxsize)
+
+        if out_file == '-':
+            out_file = None
+
+        worker_count = process_count
+
+        # load balancing
+        flow = flow_control(options)
+
+        if stats:
+            stats.start(worker_count)
+
+        # reduce job that sorts and prints output
+        reduce = Process(target=reduce_process,
+                         args=(options, output_queue, flow,
+                               out_file, file_size, file_compress, stats))
+        reduce.start()
+
+        cache_counts = Array('l', 6)
+        if ranges:
+            # range readers, with their jobs queues and worker processes
+            readers = RangeReaders(input_file, ranges, worker_count)
+            readers.start(output_queue, flow, stats=stats, cache_counts=cache_counts)
+            jobs_queue = readers.jobs_queues
+        else:
+            # initialize jobs queue
+            jobs_queue = Queue(maxsize=maxsize)
+
+            # start worker processes
+            workers = start_workers(worker_count, jobs_queue, output_queue,
+                                    stats=stats, cache_counts=cache_counts)
+
+        with reporting(stats, jobs_queue=jobs_queue, output_queue=output_queue,
+                       **flow.queues()):
+            if ranges:
+                page_num = readers.join()
+            else:
+                # Mapper process
+                page_num = map_pages(pages, jobs_queue, flow, stats)
+
+                stop_workers(workers, jobs_queue)
+
+            # signal end of work to reduce process
+            output_queue.put(None)
+            # wait for it to finish
+            reduce.join()
+
+    log_template_cache(cache_counts)
+    extract_duration = default_timer() - extract_start
+    extract_rate = page_num / extract_duration
+    logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)",
+                 process_count, page_num, extract_duration, extract_rate)
+    if ranges is None:
+        # counted by the range readers otherwise
+        logging.info("total of page: %d, total of articl page: %d; "
+                     "total of used articl page: %d",
+                     g_page_total, g_page_articl_total, g_page_articl_used_total)
+
+
+def extract_dump(input_file, opts=None, template_file=None, process_count=1,
+                 index_file=None, stats=None, profile=None,
+                 template_profile=None):
+    """
+    Extract the articles of a dump, for use as a library.
+    The dump is read and the articles are extracted in child processes, so
+    neither the global options nor the templates of the calling process are
+    modified, and separate calls do not share any state.
+    :param input_file: name of the wikipedia dump file.
+    :param opts: the options, as returned by extraction_options(); the
+    default ones if None.
+    :param template_file: optional file with template definitions.
+    :param process_count: number of extraction processes to spawn.
+    :param index_file: the index of a multistream dump; by default the one
+    next to input_file, if any.
+    :param stats: a PipelineStats, to report the throughput of the stages.
+    The articles are not written here: the caller can update
+    stats.articles_written and stats.bytes_written.
+    :param profile: with opts.profile_stages, a StageProfile where to merge
+    the timings of the stages of the extract processes, once the iteration
+    is over.
+    :param template_profile: with opts.profile_templates, a TemplateProfile
+    where to merge the counts of the templates, likewise.
+    :return: an iterator over (id, revid, title, text) of the articles, in the
+    order of the dump unless opts.ordered is False, where text is the
+    extracted text, as in the json output.
+    """
+    if opts is None:
+        opts = extraction_options(quiet=True)
+    process_count = max(1, process_count)
+    jobs_queue = Queue(maxsize=10 * process_count)
+    output_queue = Queue(maxsize=10 * process_count)
+    flow = flow_control(opts)
+    if stats:
+        stats.start(process_count)
+    mapper = Process(target=map_process,
+                     args=(opts, input_file, template_file, process_count,
+                           jobs_queue, output_queue, flow,
+                           index_file or multistream_index(input_file), stats))
+    mapper.start()
+    with reporting(stats, jobs_queue=jobs_queue, output_queue=output_queue,
+                   **flow.queues()):
+        try:
+            spool = ReorderBuffer(opts.ordered)
+            while True:
+                # mapper puts None to signal finish
+                results = output_queue.get()
+                if not results:
+                    break
+                if isinstance(results, StageProfile):
+                    if profile is not None:
+                        profile.merge(results)
+                    continue
+                if isinstance(results, TemplateProfile):
+                    if template_profile is not None:
+                        template_profile.merge(results)
+                    continue
+                for page_num, record, size in results:
+                    if size is None:
+                        ready = spool.end_range(page_num)
+                    else:
+                        ready = spool.push(page_num, (record, size),
+                                           len(record[3]) if record else 0)
+                    for record, size in ready:
+                        flow.release(size)
+                        flow.update_spool(spool)
+                        if record:
+                            yield record
+                flow.update_spool(spool)
+            mapper.join()
+            if mapper.exitcode:
+                raise RuntimeError('Extraction of %s failed with exit code %d'
+                                   % (input_file, mapper.exitcode))
+        finally:
+            # the consumer stopped early or failed
+            if mapper.is_alive():
+                mapper.terminate()
+                mapper.join()
+
+
+def map_process(opts, input_file, template_file, process_count,
+                jobs_queue, output_queue, flow, index_file=None, stats=None):
+    """Read the dump and dispatch its pages through jobs_queue to worker
+    processes, whose records go to output_queue, followed by None.
+    :param opts: global parameters.
+    :param stats: the PipelineStats to update, or None.
+    """
+    global options
+    options = opts
+
+    createLogger(options.quiet, options.debug, options.log_file)
+
+    ranges = dump_ranges(input_file, template_file, index_file)
+    if ranges is None:
+        pages = dump_pages(input_file, template_file, process_count, index_file)
+
+    with shared_templates() as template_store:
+        cache_counts = Array('l', 6)
+        if ranges:
+            readers = RangeReaders(input_file, ranges, process_count)
+            readers.start(output_queue, flow, records=True, stats=stats,
+                          cache_counts=cache_counts)
+            workers = readers.workers + readers.readers
+        else:
+            workers = start_workers(process_count, jobs_queue, output_queue,
+                                    records=True, stats=stats,
+                                    cache_counts=cache_counts)
+
+        def terminate(signum, frame):
+            # the consumer is gone: don't wait for the queues to be flushed.
+            # The children include the pool that decompresses a .bz2 dump.
+            for child in active_children():
+                child.terminate()
+            if template_store and os.path.exists(template_store):
+                os.remove(template_store)
+            os._exit(1)
+        signal.signal(signal.SIGTERM, terminate)
+
+        if ranges:
+            readers.join()
+        else:
+            map_pages(pages, jobs_queue, flow, stats)
+            stop_workers(workers, jobs_queue)
+    log_template_cache(cache_counts)
+    output_queue.put(None)
+
+
+# ----------------------------------------------------------------------
+# Multistream dumps
+# A multistream dump is a concatenation of bz2 streams: the first one holds
+# the <siteinfo> header and each of the following ones holds 100 pages.
+# Its index file lists the offset of the stream of each page, in lines
+# offset:id:title
+
+
+def multistream_index(input_file):
+    """
+    :return: the name of the index file of a multistream dump, if it exists
+    next to it.
+    """
+    suffix = '-multistream.xml.bz2'
+    if input_file.endswith(suffix):
+        index_file = input_file[:-len('.xml.bz2')] + '-index.txt.bz2'
+        if os.path.exists(index_file):
+            return index_file
+    return None
+
+
+def multistream_ranges(input_file, index_file):
+    """
+    :return: the list of (start, end) byte ranges of the streams of a dump,
+    starting with the one of the header.
+    """
+    offsets = set()
+    index = fileinput.FileInput(index_file, openhook=fileinput.hook_compressed)
+    for line in index:
+        if not isinstance(line, text_type): line = line.decode('utf-8')
+        offsets.add(int(line.split(':', 1)[0]))
+    index.close()
+    offsets = sorted(offsets | {0, os.path.getsize(input_file)})
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def read_stream_data(input_file, start, end):
+    """
+    :return: the decompressed data of the bz2 streams between offsets start
+    and end.
+    """
+    with open(input_file, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    return bz2.decompress(data)
+
+
+def read_stream(input_file, start, end):
+    """
+    :return: the lines of the bz2 streams between offsets start and end.
+    """
+    return read_stream_data(input_file, start, end).decode('utf-8').splitlines(True)
+
+
+def stream_pages(input_file, start, end, reader='lines'):
+    """
+    :return: the list of pages in the streams between offsets start and end,
+    as from pages_from().
+    :param reader: the reader to use, as options.reader.
+    """
+    if reader == 'buffers':
+        return list(buffer_pages_from([read_stream_data(input_file, start, end)]))
+    return list(pages_from(read_stream(input_file, start, end)))
+
+
+def parallel_map(function, args_list, process_count):
+    """
+    Call function with each tuple of arguments in a pool of processes.
+    :return: an iterator over the results, in order. At most twice as many
+    results as processes are computed ahead of the consumer.
+    """
+    # the processes must not inherit the handler of map_process()
+    pool = Pool(process_count, signal.signal, (signal.SIGTERM, signal.SIG_DFL))
+    try:
+        pending = deque()
+        for args in args_list:
+            pending.append(pool.apply_async(function, args))
+            if len(pending) > 2 * process_count:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def multistream_lines(input_file, streams, process_count):
+    """
+    :return: the lines of the streams of a dump, decompressed in process_count
+    processes.
+    """
+    args_list = ((input_file, start, end) for start, end in streams)
+    for lines in parallel_map(read_stream, args_list, process_count):
+        for line in lines:
+            yield line
+
+
+def multistream_blocks(input_file, streams, process_count):
+    """
+    :return: the decompressed data of each of the streams of a dump, for the
+    buffer reader, decompressed in process_count processes.
+    """
+    args_list = ((input_file, start, end) for start, end in streams)
+    return parallel_map(read_stream_data, args_list, process_count)
+
+
+def multistream_pages(input_file, streams, process_count):
+    """
+    :return: the pages of the streams of a dump, as from pages_from(),
+    decompressed and parsed in process_count processes.
+    """
+    args_list = ((input_file, start, end, options.reader) for start, end in streams)
+    for pages in parallel_map(stream_pages, args_list, process_count):
+        for page_data in pages:
+            yield page_data
+
+
+# ----------------------------------------------------------------------
+# Byte ranges of uncompressed dumps
+# An uncompressed dump is split in byte ranges, each starting with a <page>
+# tag, which are read in parallel by range readers with the buffer reader.
+# Each reader takes the next range in turn and dispatches its pages to its own
+# extract processes. The pages are numbered within their range, whose index is
+# the high part of their number, and the output is told the end of each range,
+# so that it can still output them in order.
+
+# Bits of the numbers of the pages within their range
+rangeShift = 40
+# Size of the byte ranges, of which there are at least as many as readers
+readRangeSize = 64 * 1024 * 1024
+
+
+def dump_ranges(input_file, template_file, index_file=None):
+    """
+    When an uncompressed dump is read by options.range_readers processes,
+    read its <siteinfo> header into options and load the templates.
+    :param index_file: the index of a multistream dump, or None.
+    :return: the byte ranges of its pages, or None if the dump is read in
+    one process, by dump_pages().
+    """
+    if options.range_readers <= 1 or index_file or input_file == '-' or \
+       input_file.endswith(('.bz2', '.gz')):
+        return None
+    input = open_pages(input_file)
+    try:
+        preload_templates(input, input_file, template_file)
+    finally:
+        input.close()
+    size = os.path.getsize(input_file)
+    ranges = page_ranges(input_file, max(options.range_readers,
+                                         (size + readRangeSize - 1) // readRangeSize))
+    logging.info("Reading %d byte ranges of %s.", len(ranges), input_file)
+    return ranges
+
+
+def page_ranges(input_file, count):
+    """
+    :return: about count (start, end) byte ranges of the pages of an
+    uncompressed dump, each starting with a <page> tag.
+    """
+    size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as file:
+        offsets = {page_offset(file, size * k // count) for k in range(count)}
+    offsets = sorted(offsets | {size})
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def page_offset(file, offset):
+    """
+    :return: the offset of the first <page> tag at or after offset in a
+    binary file, or its size.
+    """
+    tag = b'<page>'
+    file.seek(offset)
+    rest = b''
+    while True:
+        data = file.read(readBlockSize)
+        if not data:
+            return offset + len(rest)
+        data = rest + data
+        i = data.find(tag)
+        if i >= 0:
+            return offset + i
+        # the tag may span two blocks
+        rest = data[-(len(tag) - 1):]
+        offset += len(data) - len(rest)
+
+
+def range_blocks(input_file, start, end):
+    """
+    :return: an iterator over the blocks of bytes of a file between offsets
+    start and end.
+    """
+    with open(input_file, 'rb') as file:
+        file.seek(start)
+        while start < end:
+            data = file.read(min(readBlockSize, end - start))
+            if not data:
+                break
+            start += len(data)
+            yield data
+
+
+class RangeReaders(object):
+    """
+    The processes that read the byte ranges of an uncompressed dump, taking
+    the next range in turn, each with its own jobs queue and extract processes,
+    which put the results in a shared output queue.
+    """
+
+    def __init__(self, input_file, ranges, process_count):
+        """
+        :param ranges: the byte ranges, as from page_ranges().
+        :param process_count: number of extract processes, shared among the
+        options.range_readers readers.
+        """
+        self.input_file = input_file
+        self.ranges = ranges
+        self.reader_count = max(1, min(options.range_readers, process_count, len(ranges)))
+        self.process_count = max(process_count, self.reader_count)
+        self.next_range = Value('l', 0)
+        self.page_count = Value('l', 0)
+        self.jobs_queues = []
+        self.worker_groups = []     # the extract processes of each reader
+        self.readers = []
+        self.workers = []
+
+    def start(self, output_queue, flow, records=False, stats=None,
+              cache_counts=None):
+        """
+        Start the readers and the extract processes.
+        :param flow: the FlowControl of the pages in flight.
+        Other parameters as for start_workers().
+        """
+        first = 0
+        for k in range(self.reader_count):
+            count = self.process_count // self.reader_count + \
+                (k < self.process_count % self.reader_count)
+            jobs_queue = Queue(maxsize=10 * count)
+            workers = start_workers(count, jobs_queue, output_queue,
+                                    records, stats, cache_counts, first)
+            self.jobs_queues.append(jobs_queue)
+            self.worker_groups.append(workers)
+            self.workers += workers
+            first += count
+            reader = Process(target=range_reader_process,
+                             args=(options, self.input_file, self.ranges,
+                                   self.next_range, jobs_queue, output_queue,
+                                   flow, self.page_count, stats))
+            reader.start()
+            self.readers.append(reader)
+
+    def join(self):
+        """
+        Wait for the readers to read all ranges, and stop the extract processes.
+        :return: the number of pages dispatched.
+        """
+        for reader in self.readers:
+            reader.join()
+        for jobs_queue, workers in zip(self.jobs_queues, self.worker_groups):
+            stop_workers(workers, jobs_queue)
+        return self.page_count.value
+
+
+def range_reader_process(opts, input_file, ranges, next_range, jobs_queue,
+                         output_queue, flow, page_count, stats=None):
+    """
+    Read the pages of the next byte range of a dump in turn, and dispatch
+    them through jobs_queue to worker processes, followed by the end of the
+    range, through output_queue.
+    :param opts: global parameters.
+    :param next_range: shared index of the next range to read.
+    :param page_count: shared count of the pages dispatched.
+    :param stats: the PipelineStats to update, or None.
+    """
+    global options
+    options = opts
+
+    createLogger(options.quiet, options.debug, options.log_file)
+
+    while True:
+        with next_range.get_lock():
+            range_index = next_range.value
+            next_range.value += 1
+        if range_index >= len(ranges):
+            break
+        pages = buffer_pages_from(range_blocks(input_file, *ranges[range_index]))
+        count = map_pages(pages, jobs_queue, flow, stats, range_index)
+        output_queue.put([((range_index << rangeShift) + count, None, None)])
+        with page_count.get_lock():
+            page_count.value += count
+
+
+# ----------------------------------------------------------------------
+# Parallel bz2 decompression
+# The blocks of a bz2 stream are compressed independently. Each one starts
+# with a 48 bit magic number and its CRC, and the stream ends with another
+# magic number and the combined CRC of the blocks. The blocks are not byte
+# aligned, so we look for the magic numbers at every bit offset, and turn
+# every block into a stream of its own, which can be decompressed in another
+# process.
+
+bz2BlockMagic = 0x314159265359
+bz2EndMagic = 0x177245385090
+bz2ScanSize = 16 * 1024 * 1024  # bytes read at a time when scanning blocks
+
+
+def bz2_magic_keys(magic):
+    """
+    :return: for each bit offset of the magic number in its first byte, a
+    tuple (shift, key, first): the magic starts shift bits into the byte
+    first bytes before where the bytes key are found.
+    """
+    keys = []
+    for shift in range(8):
+        window = (magic << (8 - shift)).to_bytes(7, 'big')
+        first = 0 if shift == 0 else 1
+        keys.append((shift, window[first:6], first))
+    return keys
+
+
+def bz2_markers(file):
+    """
+    :return: an iterator over the (bit offset, is end) of the magic numbers
+    of the blocks and ends of streams in a bz2 file, in order.
+    """
+    keys = [(magic, key) for magic in (bz2BlockMagic, bz2EndMagic)
+            for key in bz2_magic_keys(magic)]
+    offset = 0                  # file offset of data
+    data = b''
+    while True:
+        chunk = file.read(bz2ScanSize)
+        data += chunk
+        # the 7 bytes of a window must be in data, unless at the end
+        limit = len(data) - 6 if chunk else len(data)
+        markers = []
+        for magic, (shift, key, first) in keys:
+            pos = data.find(key)
+            while pos != -1:
+                start = pos - first
+                if 0 <= start < limit:
+                    window = int.from_bytes(data[start:start + 7].ljust(7, b'\0'), 'big')
+                    if (window >> (8 - shift)) & 0xffffffffffff == magic:
+                        markers.append((8 * (offset + start) + shift, magic == bz2EndMagic))
+                pos = data.find(key, pos + 1)
+        for marker in sorted(markers):
+            yield marker
+        if not chunk:
+            break
+        data = data[limit:]
+        offset += limit
+
+
+def bz2_segments(input_file):
+    """
+    :return: an iterator over the (start, end, is block) bit offsets of the
+    segments of a bz2 file between magic numbers. A segment is a block if it
+    starts with the magic number of a block, otherwise it holds the end of a
+    stream and the header of the next one.
+    """
+    with open(input_file, 'rb') as file:
+        start = None
+        for bit, is_end in bz2_markers(file):
+            if start is not None:
+                yield start, bit, is_block
+            start = bit
+            is_block = not is_end
+
+
+def decompress_segment(input_file, start, end, is_block):
+    """
+    :return: the decompressed data of a segment of a bz2 file, between bit
+    offsets start and end, or None if the bits are not valid blocks.
+    """
+    if not is_block:
+        return b''
+    with open(input_file, 'rb') as file:
+        file.seek(start // 8)
+        data = file.read((end + 7) // 8 - start // 8)
+    bits = end - start
+    blocks = int.from_bytes(data, 'big') >> (-end % 8)
+    blocks &= (1 << bits) - 1
+    crc = (blocks >> (bits - 80)) & 0xffffffff
+    # a stream of one block, whose combined CRC is the one of the block
+    stream = (((blocks << 48) | bz2EndMagic) << 32) | crc
+    bits += 80
+    padding = -bits % 8
+    stream = b'BZh9' + (stream << padding).to_bytes((bits + padding) // 8, 'big')
+    try:
+        return bz2.decompress(stream)
+    except (OSError, ValueError, EOFError):
+        return None
+
+
+def bz2_blocks(input_file, process_count):
+    """
+    :return: the decompressed data of the blocks of a bz2 file, which are
+    decompressed in process_count processes.
+    The magic numbers can also occur by chance in compressed data: a block
+    that can't be decompressed is merged with the following segments.
+    """
+    segments, pending = tee(bz2_segments(input_file))
+    args_list = ((input_file,) + segment for segment in segments)
+    results = parallel_map(decompress_segment, args_list, process_count)
+    failed = None               # start of a block that can't be decompressed
+    for (start, end, is_block), data in zip(pending, results):
+        if failed is not None:
+            data = decompress_segment(input_file, failed, end, True)
+            if data is None:
+                continue
+            failed = None
+        elif data is None:
+            failed = start
+            continue
+        yield data
+    if failed is not None:
+        raise IOError('Invalid bz2 data in %s at bit %d' % (input_file, failed))
+
+
+def bz2_lines(input_file, process_count):
+    """
+    :return: the lines of a bz2 file, whose blocks are decompressed in
+    process_count processes.
+    """
+    rest = b''
+    for data in bz2_blocks(input_file, process_count):
+        lines = (rest + data).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8') + '\n'
+    if rest:
+        yield rest.decode('utf-8')
+
+
+# ----------------------------------------------------------------------
+# Template store
+# The templates and redirects are written to a file that the extract
+# processes map in memory, read-only, instead of receiving a copy of them.
+# It also has a table of information about its origin.
+# The file starts with a header: a magic number and, for each table, the
+# number of entries, of slots and the offset of the slots. Then come the
+# records, each a key length, a value length, the key and the value in
+# UTF-8, and the slots of each table: an open addressing hash table of
+# (hash of the key, offset of its record), where offset 0 is a free slot.
+
+storeMagic = b'WXTSTOR1'
+storeHeader = struct.Struct('<8s' + 'QQQ' * 3)
+storeRecord = struct.Struct('<II')
+storeSlot = struct.Struct('<QQ')
+
+
+def store_hash(key):
+    """:return: a 64-bit hash of the bytes key, which is the same in every process."""
+    return struct.unpack('<Q', hashlib.blake2b(key, digest_size=8).digest())[0]
+
+
+def write_template_store(path, templates, redirects, info=None):
+    """
+    Write the templates and the redirects, dicts from title to text, to a
+    template store.
+    :param info: a dict of strings, e.g. the wiki and the date of the dump.
+    """
+    with open(path, 'wb') as f:
+        f.write(b'\0' * storeHeader.size)
+        tables = []
+        for table in (templates, redirects, info or {}):
+            entries = []
+            for key, value in table.items():
+                key = key.encode('utf-8')
+                value = value.encode('utf-8')
+                entries.append((store_hash(key), f.tell()))
+                f.write(storeRecord.pack(len(key), len(value)))
+                f.write(key)
+                f.write(value)
+            tables.append(entries)
+        header = [storeMagic]
+        for entries in tables:
+            # at most half full
+            slot_count = 2 * len(entries) + 1
+            slots = bytearray(slot_count * storeSlot.size)
+            for key_hash, offset in entries:
+                i = key_hash % slot_count
+                while storeSlot.unpack_from(slots, i * storeSlot.size)[1]:
+                    i = (i + 1) % slot_count
+                storeSlot.pack_into(slots, i * storeSlot.size, key_hash, offset)
+            header += [len(entries), slot_count, f.tell()]
+            f.write(slots)
+        f.seek(0)
+        f.write(storeHeader.pack(*header))
+
+
+class MappedDict(object):
+    """
+    A read-only dict from str to str: a table of a template store, mapped in
+    memory. Processes that share it only share the name of the file: it
+    is mapped again when unpickled.
+    """
+
+    def __init__(self, path, table):
+        """
+        :param path: the template store.
+        :param table: 0 for the templates, 1 for the redirects, 2 for the info.
+        """
+        self.path = path
+        self.table = table
+        self.open()
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = storeHeader.unpack_from(self.map)
+        if header[0] != storeMagic:
+            raise ValueError('Not a template store: %s' % self.path)
+        self.count, self.slot_count, self.slots = header[1 + 3 * self.table:4 + 3 * self.table]
+
+    def close(self):
+        self.map.close()
+
+    def __getstate__(self):
+        return (self.path, self.table)
+
+    def __setstate__(self, state):
+        self.path, self.table = state
+        self.open()
+
+    def __len__(self):
+        return self.count
+
+    def find(self, key):
+        """
+        :return: the offset of the value of key, and its length, or None.
+        """
+        key = key.encode('utf-8')
+        key_hash = store_hash(key)
+        i = key_hash % self.slot_count
+        while True:
+            slot_hash, offset = storeSlot.unpack_from(self.map, self.slots + i * storeSlot.size)
+            if not offset:
+                return None
+            if slot_hash == key_hash:
+                key_length, value_length = storeRecord.unpack_from(self.map, offset)
+                start = offset + storeRecord.size
+                if self.map[start:start + key_length] == key:
+                    return start + key_length, value_length
+            i = (i + 1) % self.slot_count
+
+    def get(self, key, default=None):
+        found = self.find(key)
+        if found is None:
+            return default
+        start, length = found
+        return self.map[start:start + length].decode('utf-8')
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def items(self):
+        for i in range(self.slot_count):
+            _, offset = storeSlot.unpack_from(self.map, self.slots + i * storeSlot.size)
+            if offset:
+                key_length, value_length = storeRecord.unpack_from(self.map, offset)
+                start = offset + storeRecord.size
+                end = start + key_length
+                yield (self.map[start:end].decode('utf-8'),
+                       self.map[end:end + value_length].decode('utf-8'))
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+
+def open_template_store(path):
+    """
+    :return: the templates and the redirects of a template store, as MappedDicts.
+    """
+    return MappedDict(path, 0), MappedDict(path, 1)
+
+
+def template_store_info(path):
+    """
+    :return: the info of a template store, as a dict.
+    """
+    info = MappedDict(path, 2)
+    try:
+        return dict(info.items())
+    finally:
+        info.close()
+
+
+@contextmanager
+def shared_templates():
+    """
+    In the context, the templates and redirects of options are replaced with
+    a template store in a temporary file, so that the extract processes
+    started in it map them instead of copying them.
+    :return: the name of the temporary template store, or None if there are
+    no templates or they are already in a template store.
+    """
+    if (not options.templates and not options.redirects) or \
+       isinstance(options.templates, MappedDict):
+        yield None
+        return
+    fd, path = tempfile.mkstemp(suffix='.templates')
+    os.close(fd)
+    try:
+        write_template_store(path, options.templates, options.redirects)
+        options.templates, options.redirects = open_template_store(path)
+        yield path
+    finally:
+        if isinstance(options.templates, MappedDict):
+            options.templates.close()
+            options.redirects.close()
+        options.templates = {}
+        options.redirects = {}
+        os.remove(path)
+
+
+# ----------------------------------------------------------------------
+# Template snapshots
+# A snapshot is the template store of the preprocessed templates of a dump,
+# named after the wiki and the date of the dump, e.g. enwiki-20200101.templates,
+# which later extractions of the dump map instead of preprocessing the
+# templates again. The file is portable across machines.
+
+dumpNameRE = re.compile(r'(\w+?)-(\d{8})-')   # e.g. enwiki-20200101-pages-articles.xml.bz2
+
+
+def template_snapshot(input_file):
+    """
+    :return: the name of the snapshot of the templates of a dump in
+    options.template_snapshots, or None if there is no directory of snapshots
+    or the date of the dump is unknown.
+    """
+    if not options.template_snapshots:
+        return None
+    m = dumpNameRE.match(os.path.basename(input_file))
+    if not m:
+        logging.warning("Unknown date of dump %s: no template snapshot", input_file)
+        return None
+    return os.path.join(options.template_snapshots,
+                        '%s-%s.templates' % (options.dbname or m.group(1), m.group(2)))
+
+
+def template_snapshot_options():
+    """
+    :return: the options and the version that the templates of a snapshot
+    depend on, as saved in its info.
+    """
+    return {
+        'templateNamespace': options.templateNamespace,
+        'moduleNamespace': options.moduleNamespace,
+        'version': version,
+    }
+
+
+def template_snapshot_current(snapshot):
+    """
+    :return: whether a snapshot can be used with the current options and
+    version, or must be created again.
+    """
+    try:
+        info = template_store_info(snapshot)
+    except (ValueError, OSError, struct.error):
+        logging.warning("Invalid template snapshot %s: creating it again", snapshot)
+        return False
+    for key, value in template_snapshot_options().items():
+        if info.get(key) != value:
+            logging.info("Template snapshot %s has %s %r instead of %r: creating it again",
+                         snapshot, key, info.get(key), value)
+            return False
+    return True
+
+
+def save_template_snapshot(snapshot):
+    """
+    Save the templates and redirects of options to a snapshot, which they
+    are then mapped from.
+    """
+    directory = os.path.dirname(snapshot)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = os.path.basename(snapshot)
+    info = {
+        'dbname': name[:name.rfind('-')],
+        'date': name[name.rfind('-') + 1:-len('.templates')],
+    }
+    info.update(template_snapshot_options())
+    # other processes only see complete snapshots
+    tmp = '%s.%d.tmp' % (snapshot, os.getpid())
+    write_template_store(tmp, options.templates, options.redirects, info)
+    os.replace(tmp, snapshot)
+    options.templates, options.redirects = open_template_store(snapshot)
+
+
+# ----------------------------------------------------------------------
+# Pipeline statistics
+
+
+def log_stats(snapshot):
+    logging.info('Stats: %s', json.dumps(snapshot, sort_keys=True))
+
+
+def queue_depth(queue):
+    """
+    :return: the number of items in a queue, or a list of queues, or the
+    value of a shared counter, or None if the platform can't tell (qsize() is not implemented
+    on macOS).
+    """
+    if hasattr(queue, 'value'):
+        return queue.value
+    if isinstance(queue, list):
+        depths = [queue_depth(q) for q in queue]
+        return None if None in depths else sum(depths)
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return None
+
+
+class PipelineStats(object):
+    """
+    Throughput of the stages of an extraction: the reader, the extract
+    processes and the output. A thread of the process that owns the queues
+    passes a snapshot, a dict that can be serialized to JSON, to a callback
+    every interval seconds, and a last one at the end.
+    The counters are in shared memory and each is updated by a single
+    process, so they need no locks, except pages_read, which the range
+    readers update together.
+    """
+
+    def __init__(self, callback=log_stats, interval=10):
+        """
+        :param callback: function called with each snapshot.
+        :param interval: seconds between snapshots.
+        """
+        self.callback = callback
+        self.interval = interval
+
+    def __getstate__(self):
+        # the processes of the pipeline only update the counters
+        state = self.__dict__.copy()
+        for name in ('callback', 'queues', 'thread', 'stopped', 'last'):
+            state.pop(name, None)
+        return state
+
+    def start(self, process_count):
+        """
+        Allocate the counters, before the processes of the pipeline are started.
+        :param process_count: number of extract processes.
+        """
+        self.start_time = default_timer()
+        self.pages_read = Value('l', 0)                     # by the mapper
+        self.articles_written = Value('l', 0, lock=False)   # by the output
+        self.bytes_written = Value('l', 0, lock=False)
+        # by each extract process
+        self.extracted = Array('l', process_count, lock=False)
+        self.busy_time = Array('d', process_count, lock=False)
+        self.blocked_time = Array('d', process_count, lock=False)
+
+    def report(self, queues):
+        """
+        Start reporting snapshots.
+        :param queues: map from name to the queues or shared counters whose
+        depth to report.
+        """
+        self.queues = queues
+        self.last = self.counts()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.report_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def report_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.report_snapshot()
+
+    def report_snapshot(self, final=False):
+        try:
+            self.callback(self.snapshot(final))
+        except Exception:
+            logging.exception('Reporting stats')
+
+    def stop(self):
+        """Stop reporting, after a last snapshot."""
+        self.stopped.set()
+        self.thread.join()
+        self.report_snapshot(final=True)
+
+    def counts(self):
+        return (default_timer(), self.pages_read.value, sum(self.extracted),
+                self.bytes_written.value, list(self.busy_time))
+
+    def snapshot(self, final=False):
+        """
+        :return: the counters, and the rates since the previous snapshot.
+        """
+        last = self.last
+        self.last = now = self.counts()
+        elapsed = max(now[0] - last[0], 1e-9)
+        workers = []
+        for i in range(len(self.extracted)):
+            workers.append({
+                'articles': self.extracted[i],
+                'busy_seconds': round(self.busy_time[i], 3),
+                'blocked_seconds': round(self.blocked_time[i], 3),
+                # fraction of the interval spent extracting
+                'busy': round((now[4][i] - last[4][i]) / elapsed, 3),
+            })
+        return {
+            'final': final,
+            'seconds': round(now[0] - self.start_time, 3),
+            'pages_read': now[1],
+            'pages_per_second': round((now[1] - last[1]) / elapsed, 1),
+            'articles_extracted': now[2],
+            'articles_per_second': round((now[2] - last[2]) / elapsed, 1),
+            'articles_written': self.articles_written.value,
+            'bytes_written': now[3],
+            'bytes_per_second': round((now[3] - last[3]) / elapsed, 1),
+            'queues': dict((name, queue_depth(queue))
+                           for name, queue in self.queues.items()),
+            'workers': workers,
+        }
+
+
+@contextmanager
+def reporting(stats, **queues):
+    """
+    Report stats, if not None, while in the context.
+    :param queues: the queues whose depth to report, by name.
+    """
+    if stats is None:
+        yield
+        return
+    stats.report(queues)
+    try:
+        yield
+    finally:
+        stats.stop()
+
+
+class StageProfile(object):
+    """
+    Timings of the stages of the extraction of the articles, with
+    options.profile_stages: for each stage, the total seconds, a histogram of
+    the seconds per article and the slowest articles.
+    Each extract process fills its own profile and queues it at the end with
+    its output, where they are merged.
+    """
+
+    stages = ('transform', 'wiki2text', 'clean', 'compact')
+    # upper bound of the first bucket of the histograms, in seconds: each of
+    # the following ones doubles it, and the last one takes the rest
+    firstBucket = 1e-5
+    bucketCount = 24
+    # number of the slowest articles to keep for each stage
+    slowestCount = 5
+
+    def __init__(self):
+        self.totals = dict((stage, 0.0) for stage in self.stages)
+        self.histograms = dict((stage, [0] * self.bucketCount)
+                               for stage in self.stages)
+        # heaps of the (seconds, id) of the slowest articles
+        self.slowest = dict((stage, []) for stage in self.stages)
+
+    def add(self, stage, seconds, id):
+        """
+        :param stage: name of the stage.
+        :param seconds: time spent in the stage by the article.
+        :param id: id of the article.
+        """
+        self.totals[stage] += seconds
+        bucket = 0
+        bound = self.firstBucket
+        while seconds > bound and bucket < self.bucketCount - 1:
+            bucket += 1
+            bound *= 2
+        self.histograms[stage][bucket] += 1
+        self.keep_slowest(stage, seconds, id)
+
+    def keep_slowest(self, stage, seconds, id):
+        slowest = self.slowest[stage]
+        if len(slowest) < self.slowestCount:
+            heapq.heappush(slowest, (seconds, id))
+        elif seconds > slowest[0][0]:
+            heapq.heapreplace(slowest, (seconds, id))
+
+    def merge(self, other):
+        """
+        Add the timings of another profile.
+        """
+        for stage in self.stages:
+            self.totals[stage] += other.totals[stage]
+            histogram = self.histograms[stage]
+            for bucket, count in enumerate(other.histograms[stage]):
+                histogram[bucket] += count
+            for seconds, id in other.slowest[stage]:
+                self.keep_slowest(stage, seconds, id)
+
+    def percentile(self, stage, fraction):
+        """
+        :return: the upper bound of the bucket of the histogram of stage
+        within which fraction of the articles fall, in seconds.
+        """
+        histogram = self.histograms[stage]
+        rank = fraction * sum(histogram)
+        count = 0
+        for bucket, n in enumerate(histogram):
+            count += n
+            if n and count >= rank:
+                return self.firstBucket * 2 ** bucket
+        return 0.0
+
+    def report(self):
+        """
+        :return: a dict from each stage to its totals, percentiles and slowest
+        articles, which can be serialized to JSON.
+        """
+        report = {}
+        for stage in self.stages:
+            report[stage] = {
+                'articles': sum(self.histograms[stage]),
+                'seconds': round(self.totals[stage], 3),
+                'p50': self.percentile(stage, 0.5),
+                'p99': self.percentile(stage, 0.99),
+                'slowest': [(id, round(seconds, 3)) for seconds, id
+                            in sorted(self.slowest[stage], reverse=True)],
+            }
+        return report
+
+
+class TemplateProfile(object):
+    """
+    Cost of each template and parser function, with
+    options.profile_templates: the number of calls, the inclusive seconds of
+    their expansions, the hits of the recursion limits while expanding them
+    and the hits of the expansion cache.
+    The seconds of recursive calls are counted once, in the outermost one.
+    Each extract process fills its own profile and queues it at the end with
+    its output, where they are merged.
+    """
+
+    # number of the costliest templates to log
+    logCount = 20
+
+    def __init__(self):
+        # [calls, seconds, recursion hits, cache hits] by name
+        self.counts = {}
+        # calls in progress by name
+        self.active = {}
+
+    def __getstate__(self):
+        return {'counts': self.counts, 'active': {}}
+
+    def entry(self, name):
+        counts = self.counts.get(name)
+        if counts is None:
+            counts = self.counts[name] = [0, 0.0, 0, 0]
+        return counts
+
+    def enter(self, name):
+        self.entry(name)[0] += 1
+        self.active[name] = self.active.get(name, 0) + 1
+
+    def exit(self, name, seconds):
+        active = self.active[name] - 1
+        self.active[name] = active
+        if not active:
+            self.counts[name][1] += seconds
+
+    def recursion(self, name):
+        self.entry(name)[2] += 1
+
+    def hit(self, name):
+        self.entry(name)[3] += 1
+
+    def merge(self, other):
+        """
+        Add the counts of another profile.
+        """
+        for name, counts in other.counts.items():
+            entry = self.entry(name)
+            for k, count in enumerate(counts):
+                entry[k] += count
+
+    def report(self):
+        """
+        :return: a list of dicts with the counts of each template, costliest
+        first, which can be serialized to JSON.
+        """
+        report = [{'name': name, 'calls': calls, 'seconds': round(seconds, 6),
+                   'recursion_hits': recursion, 'cache_hits': hits}
+                  for name, (calls, seconds, recursion, hits) in self.counts.items()]
+        report.sort(key=lambda counts: (-counts['seconds'], counts['name']))
+        return report
+
+
+def log_template_profile(profile, file_name=None):
+    """
+    Log the costliest templates of a TemplateProfile as a table.
+    :param file_name: file where to write the whole report as JSON, if any.
+    """
+    report = profile.report()
+    logging.info("%10s %8s %10s %10s  %s", 'seconds', 'calls', 'recursion',
+                 'cache hits', 'template')
+    for counts in report[:profile.logCount]:
+        logging.info("%10.3f %8d %10d %10d  %s", counts['seconds'], counts['calls'],
+                     counts['recursion_hits'], counts['cache_hits'], counts['name'])
+    if file_name:
+        with open(file_name, 'w') as f:
+            json.dump(report, f, indent=1)
+        logging.info("Template profile of %d templates written to %s",
+                     len(report), file_name)
+
+
+def log_stage_profile(profile):
+    """
+    Log the report of a StageProfile, one line per stage.
+    """
+    for stage, report in sorted(profile.report().items(),
+                                key=lambda item: -item[1]['seconds']):
+        logging.info("Stage %s: %d articles in %.3fs, p50 %.2fms, p99 %.2fms, slowest: %s",
+                     stage, report['articles'], report['seconds'],
+                     1000 * report['p50'], 1000 * report['p99'],
+                     ', '.join('%s (%.3fs)' % slow for slow in report['slowest']))
+
+
+# ----------------------------------------------------------------------
+# Multiprocess support
+
+
+def extract_process(opts, i, jobs_queue, output_queue, records=False,
+                    stats=None, cache_counts=None):
+    """Pull batches of tuples of raw page content, do CPU/regex-heavy fixup,
+    push batches of finished text
+    :param i: process id.
+    :param jobs_queue: where to get jobs.
+    :param output_queue: where to queue extracted text for output, as lists of
+    (page_num, text, size), one per job of a batch.
+    :param records: whether to queue (id, revid, title, text) records, or None
+    for pages that are skipped, instead of formatted text.
+    :param stats: the PipelineStats to update, or None.
+    :param cache_counts: shared array where to add the hits, misses and
+    evictions of the template and expansion caches, or None.
+    With options.profile_stages and options.profile_templates, the
+    StageProfile and the TemplateProfile of the process are queued last on
+    output_queue.
+    """
+
+    global options
+    options = opts
+    # each process has its own caches
+    options.templateCache = TemplateCache(options.template_cache_size)
+    options.expansionCache = TemplateCache(options.expansion_cache_size)
+    options.stageProfile = StageProfile() if options.profile_stages else None
+    options.templateProfile = TemplateProfile() if options.profile_templates else None
+
+    createLogger(options.quiet, options.debug, options.log_file)
+
+    out = StringIO()                 # memory buffer
+
+
+    while True:
+        jobs = jobs_queue.get()  # a list of (id, revid, title, page, page_num, size)
+        if jobs:
+            start = default_timer()
+            results = []
+            for j, job in enumerate(jobs):
+                id, revid, title, page, page_num, size = job
+                jobs[j] = None               # free memory
+                try:
+                    e = Extractor(*job[:4]) # (id, revid, title, page)
+                    job = page = None        # free memory
+                    if records:
+                        text = e.extract_text()
+                        text = (id, revid, title, '\n'.join(text)) if text else None
+                    else:
+                        e.extract(out)
+                        text = out.getvalue()
+                except:
+                    text = None if records else ''
+                    logging.exception('Processing page: %s %s', id, title)
+                results.append((page_num, text, size))
+                out.truncate(0)
+                out.seek(0)
+
+            if stats:
+                put_start = default_timer()
+                stats.busy_time[i] += put_start - start
+                output_queue.put(results)
+                stats.blocked_time[i] += default_timer() - put_start
+                stats.extracted[i] += len(results)
+            else:
+                output_queue.put(results)
+        else:
+            logging.debug('Quit extractor')
+            break
+    out.close()
+    if cache_counts is not None:
+        with cache_counts.get_lock():
+            counts = options.templateCache.counts() + options.expansionCache.counts()
+            for k, count in enumerate(counts):
+                cache_counts[k] += count
+    if options.stageProfile is not None:
+        output_queue.put(options.stageProfile)
+    if options.templateProfile is not None:
+        output_queue.put(options.templateProfile)
+
+
+class ReorderBuffer(object):
+    """
+    Puts the results of the extract processes back in the order of the
+    pages: a heap of the results that arrived before the ones of earlier
+    pages, keeping count of the characters they hold.
+    The pages of the byte ranges of a dump are numbered within their range,
+    whose index is the high part of their number, and the end of each range
+    is marked with end_range().
+    With ordered=False, results are released as they arrive.
+    """
+
+    # marks the end of a range in the heap
+    end_mark = object()
+
+    def __init__(self, ordered=True):
+        self.ordered = ordered
+        self.heap = []
+        self.next_page = 0    # sequence number of the next page to release
+        self.size = 0         # characters in the heap
+        self.released = 0     # number of results released
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, page_num, result, size=0):
+        """
+        :param page_num: sequence number of the page of result.
+        :param size: characters in result.
+        :return: the list of results that can be output now, in order.
+        """
+        if not self.ordered:
+            self.next_page += 1
+            self.released += 1
+            return [result]
+        heapq.heappush(self.heap, (page_num, size, result))
+        self.size += size
+        return self.pop_ready()
+
+    def end_range(self, page_num):
+        """
+        Mark the end of a byte range.
+        :param page_num: the number following the one of the last page of
+        the range.
+        :return: the list of results that can be output now, in order.
+        """
+        if not self.ordered:
+            return []
+        heapq.heappush(self.heap, (page_num, 0, self.end_mark))
+        return self.pop_ready()
+
+    def pop_ready(self):
+        ready = []
+        while self.heap and self.heap[0][0] == self.next_page:
+            _, size, result = heapq.heappop(self.heap)
+            if result is self.end_mark:
+                # the first page of the next range
+                self.next_page = ((self.next_page >> rangeShift) + 1) << rangeShift
+                continue
+            self.size -= size
+            self.next_page += 1
+            ready.append(result)
+        self.released += len(ready)
+        return ready
+
+
+report_period = 10000           # progress report period
+def reduce_process(opts, output_queue, flow,
+                   out_file=None, file_size=0, file_compress=True, stats=None):
+    """Pull finished article text, write series of files (or stdout)
     :param opts: global parameters.
     :param output_queue: text to be output.
-    :param spool_length: spool length.
+    :param flow: the FlowControl of the pages in flight, released once output.
     :param out_file: filename where to print.
     :param file_size: max file size.
     :param file_compress: whether to compress output.
+    :param stats: the PipelineStats to update, or None.
     """
 
     global options
@@ -3069,37 +5371,51 @@ def reduce_process(opts, output_queue, spool_length,
             logging.warn("writing to stdout, so no output compression (use an external tool)")
 
     interval_start = default_timer()
-    # FIXME: use a heap
-    spool = {}        # collected pages
-    next_page = 0     # sequence numbering of page
+    spool = ReorderBuffer(options.ordered)      # collected pages
+    profile = StageProfile()
+    template_profile = TemplateProfile()
     while True:
-        if next_page in spool:
-            output.write(spool.pop(next_page).encode('utf-8'))
-            next_page += 1
-            # tell mapper our load:
-            spool_length.value = len(spool)
-            # progress report
-            if next_page % report_period == 0:
-                interval_rate = report_period / (default_timer() - interval_start)
-                logging.info("Extracted %d articles (%.1f art/s)",
-                             next_page, interval_rate)
-                interval_start = default_timer()
-        else:
-            # mapper puts None to signal finish
-            pair = output_queue.get()
-            if not pair:
-                break
-            page_num, text = pair
-            spool[page_num] = text
-            # tell mapper our load:
-            spool_length.value = len(spool)
-            # FIXME: if an extractor dies, process stalls; the other processes
-            # continue to produce pairs, filling up memory.
-            if len(spool) > 200:
-                logging.debug('Collected %d, waiting: %d, %d', len(spool),
-                              next_page, next_page == page_num)
+        # mapper puts None to signal finish
+        results = output_queue.get()
+        if not results:
+            break
+        if isinstance(results, StageProfile):
+            profile.merge(results)
+            continue
+        if isinstance(results, TemplateProfile):
+            template_profile.merge(results)
+            continue
+        for page_num, text, size in results:
+            if size is None:
+                ready = spool.end_range(page_num)
+            else:
+                ready = spool.push(page_num, (text, size), len(text))
+            for text, size in ready:
+                data = text.encode('utf-8')
+                output.write(data)
+                if stats and data:
+                    stats.articles_written.value += 1
+                    stats.bytes_written.value += len(data)
+                # progress report
+                if spool.released % report_period == 0:
+                    interval_rate = report_period / (default_timer() - interval_start)
+                    logging.info("Extracted %d articles (%.1f art/s)",
+                                 spool.released, interval_rate)
+                    interval_start = default_timer()
+                # let the mapper dispatch another page
+                flow.release(size)
+        flow.update_spool(spool)
+        # FIXME: if an extractor dies, process stalls, once the other
+        # processes have extracted the pages in flight.
+        if len(spool) > 200:
+            logging.debug('Collected %d (%d characters), waiting: %d', len(spool),
+                          spool.size, spool.next_page)
     if output != sys.stdout:
         output.close()
+    if options.profile_stages:
+        log_stage_profile(profile)
+    if options.profile_templates:
+        log_template_profile(template_profile, options.template_profile_file)
 
 
 # ----------------------------------------------------------------------
@@ -3124,6 +5440,9 @@ def main():
                         help="compress output files using bzip")
     groupO.add_argument("--json", action="store_true",
                         help="write output in json format instead of the default one")
+    groupO.add_argument("--unordered", dest="ordered", action="store_false",
+                        help="write each article as soon as it is extracted, "
+                        "instead of in the order of the dump")
 
 
     groupP = parser.add_argument_group('Processing')
@@ -3139,8 +5458,26 @@ def main():
                         help="accepted namespaces in links")
     groupP.add_argument("--templates",
                         help="use or create file containing templates")
+    groupP.add_argument("--template_snapshots", metavar="DIR",
+                        help="use or create a snapshot of the preprocessed templates of the dump "
+                        "in DIR, named after the wiki and the date of the dump")
+    groupP.add_argument("--multistream_index",
+                        help="index file of a multistream input dump, whose streams are "
+                        "decompressed in parallel (default: the one next to the input, if any)")
     groupP.add_argument("--no_templates", action="store_false",
                         help="Do not expand templates")
+    groupP.add_argument("--allowed_templates", default="", metavar="Infobox,Lang",
+                        help="comma separated list of the only templates to expand in the text "
+                        "of the articles, with the ones they use; the others are dropped")
+    groupP.add_argument("--denied_templates", default="", metavar="Navbox,#invoke",
+                        help="comma separated list of templates and parser functions never "
+                        "expanded")
+    groupP.add_argument("--expansion_budget", type=int, default=0, metavar="N",
+                        help="maximum expansions of templates and parser functions per article, "
+                        "after which the remaining ones are dropped (default: no limit)")
+    groupP.add_argument("--expansion_time_budget", type=float, default=0, metavar="SECONDS",
+                        help="maximum seconds of expansion of templates per article, after "
+                        "which the remaining ones are dropped (default: no limit)")
     groupP.add_argument("-r", "--revision", action="store_true", default=options.print_revision,
                         help="Include the document revision id (default=%(default)s)")
     groupP.add_argument("--min_text_length", type=int, default=options.min_text_length,
@@ -3156,6 +5493,40 @@ def main():
     default_process_count = max(1, cpu_count() - 1)
     parser.add_argument("--processes", type=int, default=default_process_count,
                         help="Number of processes to use (default %(default)s)")
+    parser.add_argument("--no_parallel_bz2", dest="parallel_bz2", action="store_false",
+                        help="Decompress a .bz2 input in one process, "
+                        "instead of its blocks in parallel")
+    parser.add_argument("--decompress_processes", type=int,
+                        default=options.decompress_processes, metavar="N",
+                        help="Number of processes that decompress a .bz2 input, "
+                        "0 for as many as --processes (default %(default)s)")
+    parser.add_argument("--reader", choices=('lines', 'buffers'), default=options.reader,
+                        help="Read the pages parsing each line, or searching for their tags in "
+                        "large buffers, which is faster (default %(default)s)")
+    parser.add_argument("--range_readers", type=int, default=options.range_readers, metavar="N",
+                        help="Read an uncompressed dump in byte ranges, in N processes that share "
+                        "the extract processes among them (default %(default)s)")
+    parser.add_argument("--max_in_flight_pages", type=int, default=options.max_in_flight_pages,
+                        help="Maximum number of pages read but not output yet "
+                        "(default %(default)s)")
+    parser.add_argument("--max_in_flight_size", default="100M",
+                        help="Maximum characters of the pages read but not output yet "
+                        "(default %(default)s)",
+                        metavar="n[KMG]")
+    parser.add_argument("--template_cache_size", default="32M",
+                        help="Maximum characters of the parsed templates cached by each process "
+                        "(default %(default)s)",
+                        metavar="n[KMG]")
+    parser.add_argument("--no_memoize", dest="memoize_expansions", action="store_false",
+                        help="Do not memoize the expansions of templates and parser functions "
+                        "that do not depend on the page")
+    parser.add_argument("--expansion_cache_size", default="16M",
+                        help="Maximum characters of the expansions memoized by each process "
+                        "(default %(default)s)",
+                        metavar="n[KMG]")
+    parser.add_argument("--fused_cleaner", action="store_true",
+                        help="Remove comments, tags and discarded elements in a single scan of "
+                        "the text, instead of one per tag")
 
     groupS = parser.add_argument_group('Special')
     groupS.add_argument("-q", "--quiet", action="store_true",
@@ -3166,6 +5537,18 @@ def main():
                         help="analyze a file containing a single article (debug option)")
     groupS.add_argument("--log_file",
                         help="path to save the log info")
+    groupS.add_argument("--stats_interval", type=float, default=0, metavar="SECONDS",
+                        help="log the throughput of each stage and the queue depths as JSON "
+                        "every SECONDS (default: never)")
+    groupS.add_argument("--profile_stages", action="store_true",
+                        help="log the time spent by the articles in each stage of the extraction, "
+                        "with percentiles and the slowest articles, at the end")
+    groupS.add_argument("--profile_templates", action="store_true",
+                        help="log the calls, time, recursion limit hits and cache hits of the "
+                        "costliest templates and parser functions, at the end")
+    groupS.add_argument("--template_profile_file", metavar="FILE",
+                        help="write the counts of all the templates as JSON to FILE "
+                        "(implies --profile_templates)")
     groupS.add_argument("-v", "--version", action="version",
                         version='%(prog)s ' + version,
                         help="print program version")
@@ -3181,10 +5564,22 @@ def main():
     options.write_json = args.json
     options.print_revision = args.revision
     options.min_text_length = args.min_text_length
+    options.parallel_bz2 = args.parallel_bz2
+    options.decompress_processes = args.decompress_processes
+    options.reader = args.reader
+    options.range_readers = args.range_readers
+    options.ordered = args.ordered
+    options.template_snapshots = args.template_snapshots
     if args.html:
         options.keepLinks = True
 
     options.expand_templates = args.no_templates
+    if args.allowed_templates:
+        options.allowed_templates = expansionNames(args.allowed_templates.split(','))
+    if args.denied_templates:
+        options.denied_templates = expansionNames(args.denied_templates.split(','))
+    options.expansion_budget = args.expansion_budget
+    options.expansion_time_budget = args.expansion_time_budget
     options.filter_disambig_pages = args.filter_disambig_pages
     options.keep_tables = args.keep_tables
 
@@ -3197,6 +5592,33 @@ def main():
         logging.error('Insufficient or invalid size: %s', args.bytes)
         return
 
+    options.max_in_flight_pages = args.max_in_flight_pages
+    try:
+        power = 'kmg'.find(args.max_in_flight_size[-1].lower()) + 1
+        options.max_in_flight_size = int(args.max_in_flight_size[:-1]) * 1024 ** power
+    except ValueError:
+        logging.error('Invalid size: %s', args.max_in_flight_size)
+        return
+    try:
+        power = 'kmg'.find(args.template_cache_size[-1].lower()) + 1
+        options.template_cache_size = int(args.template_cache_size[:-1]) * 1024 ** power
+    except ValueError:
+        logging.error('Invalid size: %s', args.template_cache_size)
+        return
+    options.templateCache = TemplateCache(options.template_cache_size)
+    options.memoize_expansions = args.memoize_expansions
+    try:
+        power = 'kmg'.find(args.expansion_cache_size[-1].lower()) + 1
+        options.expansion_cache_size = int(args.expansion_cache_size[:-1]) * 1024 ** power
+    except ValueError:
+        logging.error('Invalid size: %s', args.expansion_cache_size)
+        return
+    options.expansionCache = TemplateCache(options.expansion_cache_size)
+    options.fused_cleaner = args.fused_cleaner
+    options.profile_stages = args.profile_stages
+    options.profile_templates = args.profile_templates or bool(args.template_profile_file)
+    options.template_profile_file = args.template_profile_file
+
     if args.namespaces:
         options.acceptedNamespaces = set(args.namespaces.split(','))
 
@@ -3204,12 +5626,7 @@ def main():
     if args.ignored_tags:
         ignoredTags = set(args.ignored_tags.split(','))
     else:
-        ignoredTags = [
-            'abbr', 'b', 'big', 'blockquote', 'center', 'cite', 'em',
-            'font', 'h1', 'h2', 'h3', 'h4', 'hiero', 'i', 'kbd',
-            'p', 'plaintext', 's', 'span', 'strike', 'strong',
-            'tt', 'u', 'var'
-        ]
+        ignoredTags = defaultIgnoredTags
 
     # 'a' tag is handled separately
     for tag in ignoredTags:
@@ -3278,8 +5695,13 @@ def main():
             logging.info("Including categories:")
             logging.info(str(len(options.filter_category_include)))
 
+    stats = None
+    if args.stats_interval > 0:
+        stats = PipelineStats(interval=args.stats_interval)
+
     process_dump(input_file, args.templates, output_path, file_size,
-                 args.compress, args.processes)
+                 args.compress, args.processes,
+                 index_file=args.multistream_index, stats=stats)
 
 def createLogger(quiet, debug, log_file):
     logger = logging.getLogger()
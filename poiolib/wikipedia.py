@@ -1,25 +1,76 @@
 import os
 import sys
-import subprocess
 import urllib
 import re
-import glob
 import shutil
 import json
 import tempfile
+import glob
+import hashlib
+import time
+import typing
+import threading
+import contextlib
+import collections
+import concurrent.futures
 
 import requests
-from bs4 import BeautifulSoup
 
+from . import WikiExtractor
 from .langinfo import LangInfo
 
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Size of the chunks we read from the network and write to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# How often we try to resume a download after a connection error
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 60
+# Size of the byte ranges of a segmented download
+DOWNLOAD_SEGMENT_SIZE = 64 * 1024 * 1024
+# Maximum number of parallel connections to one host, across all downloads
+MAX_CONNECTIONS_PER_HOST = 4
+
+# Minimum number of characters of an article in the text output
+MIN_ARTICLE_LENGTH = 200
+# One in this many extraction processes decompresses the blocks of a .bz2 dump
+DECOMPRESS_SHARE = 4
+# Maximum size of the JSONL files of WikiExtractor
+WIKIEXTRACTOR_FILE_SIZE = 100 * 1024 * 1024
+# Base URL of the Wikimedia dumps
+DUMPS_URL = "https://dumps.wikimedia.org/"
+# Where and for how long (in seconds) we cache the index of the latest dumps
+DUMP_INDEX_CACHE = os.path.join(
+    tempfile.gettempdir(), "poio-corpus-data", "dump-index.json"
+)
+DUMP_INDEX_TTL = 6 * 60 * 60
+# Number of concurrent requests when resolving wikis that are not in the index
+DUMP_INDEX_WORKERS = 8
+# Number of dumps that `extract_many` downloads at the same time
+MAX_PARALLEL_DOWNLOADS = 2
+# Seconds between the snapshots of the throughput of downloads and extractions
+STATS_INTERVAL = 10
+
+_RETRY_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+_host_slots = {}
+_host_slots_lock = threading.Lock()
 
 
-def extract_to_txt(iso_639_3: str, output_filename: str):
+def extract_to_txt(
+    iso_639_3: str,
+    output_filename: str,
+    stats: typing.Callable[[dict], None] = None,
+) -> dict:
     """
     Download and extract a Wikipedia to the given text file.
 
+    We keep a manifest with the dump and the options of the extraction next
+    to the text file, with the extension ".json". If the text file was
+    extracted from the same dump with the same options before, we don't
+    download or extract anything.
+
     Parameters
     ----------
     iso_639_3 : str
@@ -27,30 +78,54 @@ def extract_to_txt(iso_639_3: str, output_filename: str):
     output_filename : str
         The path to the text file to output the Wikipedia data. We will write
         one article per line.
+    stats : callable (Optional, default: `None`)
+        A function that is called with a snapshot of the throughput of the
+        download and of the extraction every `STATS_INTERVAL` seconds, see
+        `_download_stats` and `_extraction_stats`.
+
+    Returns
+    -------
+    dict
+        The manifest.
     """
+    manifest = _dump_manifest(iso_639_3, "txt")
+    manifest_file = os.path.splitext(output_filename)[0] + ".json"
+    if manifest_file == output_filename:
+        manifest_file += ".json"
+    base_path = os.path.dirname(os.path.abspath(manifest_file))
+    manifest["outputs"] = _file_sizes([output_filename], base_path)
+    previous = _read_manifest(manifest_file)
+    if _is_up_to_date(previous, manifest):
+        return previous
     tmp_dir = os.path.join(tempfile.gettempdir(), "poio-corpus-data", iso_639_3)
-    extract_to(iso_639_3, tmp_dir)
-    re_emptyspace = re.compile(r"[\t\n]+")
-    re_xmltag = re.compile(r"</?[A-Za-z]*>")
-    with open(output_filename, "w", encoding="utf-8") as output:
-        for wiki_file in glob.glob(os.path.join(tmp_dir, "**", "wiki_*")):
-            with open(wiki_file, "r", encoding="utf-8") as f:
-                for line in f.readlines():
-                    article_data = json.loads(line)
-                    article_text = article_data["text"]
-                    article_text = re_emptyspace.sub(" ", article_text)
-                    article_text = re_xmltag.sub(" ", article_text)
-                    if len(article_text) > 200:
-                        output.write(article_text)
-                        output.write("\n")
+    file_path = download_dump(
+        manifest["url"],
+        tmp_dir,
+        sha1=manifest["sha1"],
+        progress=_download_stats(stats, iso_639_3=iso_639_3),
+    )
+    manifest["articles"] = dump_to_txt(
+        file_path,
+        output_filename,
+        stats=_extraction_stats(stats, iso_639_3=iso_639_3),
+    )
+    manifest["outputs"] = _file_sizes([output_filename], base_path)
+    _write_manifest(manifest_file, manifest)
     shutil.rmtree(tmp_dir)
+    return manifest
 
 
-def extract_to(iso_639_3: str, output_path: str):
+def extract_to(
+    iso_639_3: str, output_path: str, stats: typing.Callable[[dict], None] = None
+) -> dict:
     """
     Download and extract a Wikipedia to the given path.
 
-    The download folder will be created if it does not exist.
+    The download folder will be created if it does not exist. We keep a
+    manifest of the dump and the options of the extraction in the file
+    `<iso_639_3>.json` in the folder. The dump is only downloaded if it is
+    not there yet, and only extracted if it was not extracted with the same
+    options before; the dump files of older dumps are removed.
 
     Parameters
     ----------
@@ -60,43 +135,797 @@ def extract_to(iso_639_3: str, output_path: str):
         The path to store the extracted data. We use Wikiextractor the the output
         will be organized in sub-directories, where each sub-directory contains a
         list of JSONL files.
+    stats : callable (Optional, default: `None`)
+        A function that is called with a snapshot of the throughput of the
+        download and of the extraction every `STATS_INTERVAL` seconds, see
+        `_download_stats` and `_extraction_stats`.
+
+    Returns
+    -------
+    dict
+        The manifest.
+    """
+    manifest = _dump_manifest(iso_639_3, "json")
+    manifest_file = os.path.join(output_path, iso_639_3 + ".json")
+    manifest["outputs"] = _file_sizes(_extracted_files(output_path), output_path)
+    previous = _read_manifest(manifest_file)
+    if _is_up_to_date(previous, manifest):
+        return previous
+    if previous.get("dump_file") and previous["sha1"] != manifest["sha1"]:
+        old_dump = os.path.join(output_path, previous["dump_file"])
+        if os.path.exists(old_dump):
+            os.remove(old_dump)
+    file_path = download_dump(
+        manifest["url"],
+        output_path,
+        sha1=manifest["sha1"],
+        progress=_download_stats(stats, iso_639_3=iso_639_3),
+    )
+    manifest["dump_file"] = os.path.basename(file_path)
+    for extracted_file in _extracted_files(output_path):
+        os.remove(extracted_file)
+    wikipedia_extractor(
+        file_path,
+        output_path,
+        stats=_extraction_stats(stats, iso_639_3=iso_639_3),
+    )
+    manifest["outputs"] = _file_sizes(_extracted_files(output_path), output_path)
+    _write_manifest(manifest_file, manifest)
+    return manifest
+
+
+def download_to(iso_639_3: str, output_path: str) -> str:
     """
-    langinfo = LangInfo()
-    iso_639_1 = langinfo.iso_639_1_for_3(iso_639_3)
+    Download the latest dump of a Wikipedia to the given path.
+
+    The download folder will be created if it does not exist.
+
+    Parameters
+    ----------
+    iso_639_3 : str
+        The ISO code of the Wikiepedia to download
+    output_path : str
+        The path to store the dump file.
+
+    Returns
+    -------
+    str
+        The path the the downloaded dump file.
+    """
+    manifest = _dump_manifest(iso_639_3)
+    return download_dump(manifest["url"], output_path, sha1=manifest["sha1"])
+
+
+def _download_stats(
+    stats: typing.Callable[[dict], None], **fields
+) -> typing.Callable[[int, int], None]:
+    """
+    A `progress` function for `download_dump` that calls `stats` every
+    `STATS_INTERVAL` seconds and at the end of the download.
+
+    The snapshot has the given fields, the `stage` "download", the `seconds`
+    since the download started, `bytes_downloaded`, `bytes_total` (or
+    `None` if unknown) and the `bytes_per_second` since the last snapshot.
+    """
+    if stats is None:
+        return None
+    start = time.monotonic()
+    last = {"time": start, "bytes": 0}
+
+    def progress(downloaded, total):
+        now = time.monotonic()
+        if now - last["time"] < STATS_INTERVAL and downloaded != total:
+            return
+        stats(
+            dict(
+                fields,
+                stage="download",
+                seconds=round(now - start, 3),
+                bytes_downloaded=downloaded,
+                bytes_total=total,
+                bytes_per_second=round(
+                    (downloaded - last["bytes"]) / max(now - last["time"], 1e-9), 1
+                ),
+            )
+        )
+        last.update(time=now, bytes=downloaded)
+
+    return progress
+
+
+def _extraction_stats(
+    stats: typing.Callable[[dict], None], **fields
+) -> WikiExtractor.PipelineStats:
+    """
+    The `WikiExtractor.PipelineStats` of an extraction, that calls `stats`
+    every `STATS_INTERVAL` seconds and at the end of the extraction.
+
+    The snapshot has the given fields, the `stage` "extract" and the
+    counters, rates and queue depths of `WikiExtractor.PipelineStats`.
+    """
+    if stats is None:
+        return None
+    return WikiExtractor.PipelineStats(
+        lambda snapshot: stats(dict(snapshot, stage="extract", **fields)),
+        STATS_INTERVAL,
+    )
+
+
+def _wikipedia_code(iso_639_3: str) -> str:
+    """
+    The code of the Wikipedia of a language: its ISO 639-1 code if it has one,
+    otherwise the ISO 639-3 code.
+    """
+    try:
+        iso_639_1 = LangInfo().iso_639_1_for_3(iso_639_3)
+    except KeyError:
+        return iso_639_3
     if iso_639_1 == "":
-        iso_639_1 = iso_639_3
-    wiki_date, dump_link = get_dump_link(iso_639_1)
-    file_path = download_dump(dump_link, output_path)
-    wikipedia_extractor(file_path, output_path)
+        return iso_639_3
+    return iso_639_1
 
 
-def _dump_link_from_lang_page(wiki_name: str, page: str) -> (str, str):
+def _dump_manifest(
+    iso_639_3: str, output_format: str = None, dump_info: dict = None
+) -> dict:
     """
-    Get the link to the Wikipedia dump from the language page.
+    The manifest of the extraction of the latest dump of a Wikipedia to a
+    format, before the extraction.
+    """
+    wikipedia_code = _wikipedia_code(iso_639_3)
+    if dump_info is None:
+        dump_info = get_dump_info(wikipedia_code)
+    if dump_info is None:
+        raise ValueError("There is no Wikipedia dump for " + iso_639_3)
+    manifest = {
+        "iso_639_3": iso_639_3,
+        "wikipedia": wikipedia_code,
+        "date": dump_info["date"],
+        "url": dump_info["url"],
+        "sha1": dump_info["sha1"],
+        "dump_size": dump_info["size"] or 0,
+    }
+    if output_format is not None:
+        manifest["options"] = _extraction_options(output_format)
+    return manifest
+
+
+def _extraction_options(output_format: str) -> dict:
+    """The settings that determine the output of an extraction."""
+    options = {"format": output_format, "wikiextractor": WikiExtractor.version}
+    if output_format == "txt":
+        options["min_article_length"] = MIN_ARTICLE_LENGTH
+    else:
+        options["file_size"] = WIKIEXTRACTOR_FILE_SIZE
+    return options
+
+
+def _extracted_files(output_path: str) -> typing.List[str]:
+    """The JSONL files that WikiExtractor wrote to a folder."""
+    return sorted(glob.glob(os.path.join(output_path, "[A-Z][A-Z]", "wiki_[0-9][0-9]")))
+
+
+def _is_up_to_date(previous: dict, manifest: dict) -> bool:
+    """
+    Whether the previous extraction, described by the manifest `previous`,
+    had the same dump and options as `manifest`, and its output files were
+    not changed since.
+    """
+    return "error" not in previous and all(
+        previous.get(key) == manifest[key]
+        for key in ("url", "sha1", "options", "outputs")
+    )
+
+
+def _file_sizes(file_paths: typing.Iterable[str], base_path: str) -> dict:
+    """The sizes of the existing files, by path relative to `base_path`."""
+    return {
+        os.path.relpath(file_path, base_path): os.path.getsize(file_path)
+        for file_path in file_paths
+        if os.path.exists(file_path)
+    }
+
+
+def _read_manifest(manifest_file: str) -> dict:
+    """The manifest in a file, or an empty one if there is none."""
+    try:
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifest(manifest_file: str, manifest: dict):
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def extract_many(
+    iso_codes: typing.Iterable[str],
+    output_path: str,
+    processes: int = None,
+    downloads: int = MAX_PARALLEL_DOWNLOADS,
+    stats: typing.Callable[[dict], None] = None,
+) -> dict:
+    """
+    Download and extract the Wikipedias of several languages to text files.
+
+    The dumps are downloaded in parallel, largest first, while the dumps that
+    are already downloaded are extracted. All extractions share a budget of
+    `processes` worker processes, of which each gets a share proportional to
+    the size of its dump. For every language we write the text file
+    `<iso>.txt`, with one article per line, and the manifest `<iso>.json`
+    with the dump, the timings of the stages and the sizes of the files, to
+    `output_path`. A language that fails does not stop the others; its
+    manifest has the error message. Languages whose text file was extracted
+    from the same dump with the same options before are skipped.
 
     Parameters
     ----------
-    wiki_name : str
-        The wiki name at Wikipedia of the language to get the link for, i.e.
-        "dewiki".
-    page : str
-        The URL of the language page with the dump link.
+    iso_codes : iterable of str
+        The ISO 639-3 codes of the Wikipedias to extract.
+    output_path : str
+        The path to store the text files and manifests. It will be created if
+        it does not exist. The dumps are downloaded to the sub-directories
+        `<iso>.download`, which are removed after the extraction.
+    processes : int
+        The total number of extraction processes, including those that
+        decompress the .bz2 dumps, by default one less than the number of CPUs.
+    downloads : int
+        The number of dumps to download at the same time.
+    stats : callable (Optional, default: `None`)
+        A function that is called, from several threads, with snapshots of
+        the throughput of each download and extraction every
+        `STATS_INTERVAL` seconds, see `_download_stats` and
+        `_extraction_stats`. The snapshots have the field `iso_639_3`.
 
     Returns
     -------
-    (str, str)
-        A tuple with the date of the Wikipedia dump and the link to the dump.
+    dict
+        A map from ISO code to manifest.
+    """
+    if processes is None:
+        processes = max(1, os.cpu_count() - 1)
+    os.makedirs(output_path, exist_ok=True)
+    iso_codes = list(iso_codes)
+    wikipedia_codes = {iso: _wikipedia_code(iso) for iso in iso_codes}
+    dump_infos = get_dump_infos(set(wikipedia_codes.values()))
+
+    def manifest_file(iso):
+        return os.path.join(output_path, iso + ".json")
+
+    def txt_file(iso):
+        return os.path.join(output_path, iso + ".txt")
+
+    manifests = {}
+    jobs = []
+    for iso in iso_codes:
+        dump_info = dump_infos[wikipedia_codes[iso]]
+        if dump_info is None:
+            manifests[iso] = {
+                "iso_639_3": iso,
+                "wikipedia": wikipedia_codes[iso],
+                "error": "There is no Wikipedia dump for " + iso,
+            }
+            _write_manifest(manifest_file(iso), manifests[iso])
+            continue
+        manifest = _dump_manifest(iso, "txt", dump_info)
+        manifest["outputs"] = _file_sizes([txt_file(iso)], output_path)
+        previous = _read_manifest(manifest_file(iso))
+        if _is_up_to_date(previous, manifest):
+            manifests[iso] = previous
+            continue
+        manifests[iso] = manifest
+        jobs.append(iso)
+    jobs.sort(key=lambda iso: manifests[iso]["dump_size"], reverse=True)
+    total_size = sum(manifests[iso]["dump_size"] for iso in jobs) or 1
+    budget = _ProcessBudget(processes)
+
+    def download(iso):
+        manifest = manifests[iso]
+        start = time.time()
+        file_path = download_dump(
+            manifest["url"],
+            os.path.join(output_path, iso + ".download"),
+            sha1=manifest["sha1"],
+            progress=_download_stats(stats, iso_639_3=iso),
+        )
+        manifest["download_seconds"] = time.time() - start
+        return file_path
+
+    def extract(iso, file_path):
+        manifest = manifests[iso]
+        share = round(processes * manifest["dump_size"] / total_size)
+        start = time.time()
+        try:
+            with budget.take(max(1, share)) as count:
+                extract_start = time.time()
+                manifest["processes"] = count
+                manifest["wait_seconds"] = extract_start - start
+                manifest["articles"] = dump_to_txt(
+                    file_path,
+                    txt_file(iso),
+                    count,
+                    _extraction_stats(stats, iso_639_3=iso),
+                )
+                manifest["extract_seconds"] = time.time() - extract_start
+            manifest["txt_size"] = os.path.getsize(txt_file(iso))
+            manifest["outputs"] = _file_sizes([txt_file(iso)], output_path)
+            shutil.rmtree(os.path.dirname(file_path))
+        except Exception as e:
+            manifest["error"] = str(e)
+        _write_manifest(manifest_file(iso), manifest)
+
+    # The extractions fork worker processes, which must not happen from the
+    # threads of an executor: the children would try to join them at exit.
+    extractions = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=downloads) as executor:
+        download_futures = {executor.submit(download, iso): iso for iso in jobs}
+        for future in concurrent.futures.as_completed(download_futures):
+            iso = download_futures[future]
+            try:
+                file_path = future.result()
+            except Exception as e:
+                manifests[iso]["error"] = str(e)
+                _write_manifest(manifest_file(iso), manifests[iso])
+            else:
+                extraction = threading.Thread(target=extract, args=(iso, file_path))
+                extraction.start()
+                extractions.append(extraction)
+    for extraction in extractions:
+        extraction.join()
+    return manifests
+
+
+class _ProcessBudget:
+    """
+    A number of worker processes that are shared by extractions, handed out
+    first come, first served.
+    """
+
+    def __init__(self, processes: int):
+        self.processes = processes
+        self.available = processes
+        self._condition = threading.Condition()
+        self._waiting = collections.deque()
+
+    @contextlib.contextmanager
+    def take(self, count: int) -> typing.Iterator[int]:
+        """Wait for `count` processes, or all of them if there are fewer."""
+        count = min(count, self.processes)
+        ticket = object()
+        with self._condition:
+            self._waiting.append(ticket)
+            self._condition.wait_for(
+                lambda: self._waiting[0] is ticket and self.available >= count
+            )
+            self._waiting.popleft()
+            self.available -= count
+            self._condition.notify_all()
+        try:
+            yield count
+        finally:
+            with self._condition:
+                self.available += count
+                self._condition.notify_all()
+
+
+def dump_to_txt(
+    file_path: str,
+    output_filename: str,
+    processes: int = None,
+    stats: WikiExtractor.PipelineStats = None,
+):
+    """
+    Extract the articles of a Wikipedia dump file to a text file.
+
+    The articles are streamed from WikiExtractor, which runs in child
+    processes of this one, straight to the text file, without writing any
+    intermediate files.
+
+    WikiExtractor already drops the articles that cannot reach
+    `MIN_ARTICLE_LENGTH` characters. It counts the characters of the lines
+    of an article, while the line we write has one space for each run of
+    line breaks, so it has at most twice their number plus one.
+
+    Parameters
+    ----------
+    file_path : str
+        The path to the dump file.
+    output_filename : str
+        The path to the text file to output the Wikipedia data. We will write
+        one article per line.
+    processes : int
+        The number of extraction processes, including those that decompress
+        a .bz2 dump, by default one less than the number of CPUs.
+    stats : WikiExtractor.PipelineStats (Optional, default: `None`)
+        The statistics of the extraction, to which we add the articles and
+        bytes written.
+
+    Returns
+    -------
+    int
+        The number of articles written.
     """
-    html_page = requests.get(page)
-    soup = BeautifulSoup(html_page.content, features="html.parser")
-    all_links = soup("a")
-    for l in all_links:
-        match = re.match(wiki_name + "-(\\d{8})-pages-articles.xml.bz2", l.string)
-        if match:
-            wiki_date = match.group(1)
-            dump_link = urllib.parse.urljoin(page, l["href"])
-            return wiki_date, dump_link
-    return None, None
+    articles = 0
+    with open(output_filename, "wb") as output:
+        for article_text in extract_articles(
+            file_path, processes, stats, (MIN_ARTICLE_LENGTH + 1) // 2
+        ):
+            article_text = _article_line(article_text)
+            if article_text is not None:
+                line = (article_text + "\n").encode("utf-8")
+                output.write(line)
+                articles += 1
+                if stats:
+                    stats.articles_written.value += 1
+                    stats.bytes_written.value += len(line)
+    return articles
+
+
+def extract_articles(
+    file_path: str,
+    processes: int = None,
+    stats: WikiExtractor.PipelineStats = None,
+    min_text_length: int = 0,
+) -> typing.Iterator[str]:
+    """
+    Extract the texts of the articles of a Wikipedia dump file.
+
+    Parameters
+    ----------
+    file_path : str
+        The path to the dump file.
+    processes : int
+        The number of extraction processes, including those that decompress
+        a .bz2 dump, by default one less than the number of CPUs.
+    stats : WikiExtractor.PipelineStats (Optional, default: `None`)
+        The statistics of the extraction.
+    min_text_length : int (Optional, default: 0)
+        The minimum number of characters of the lines of an article, below
+        which WikiExtractor drops it.
+
+    Returns
+    -------
+    Iterator[str]
+        The texts of the articles, in the order of the dump, as in the JSON
+        output of WikiExtractor.
+    """
+    if processes is None:
+        processes = max(1, os.cpu_count() - 1)
+    processes, decompress = _split_processes(file_path, processes)
+    options = WikiExtractor.extraction_options(
+        quiet=True, min_text_length=min_text_length, decompress_processes=decompress
+    )
+    for _, _, _, text in WikiExtractor.extract_dump(
+        file_path, options, process_count=processes, stats=stats
+    ):
+        yield text
+
+
+def _split_processes(file_path: str, processes: int) -> typing.Tuple[int, int]:
+    """
+    Split the processes of an extraction between the extraction of the
+    articles and the decompression of a .bz2 dump, so that they don't run
+    more processes than `processes`.
+
+    Returns
+    -------
+    (int, int)
+        The numbers of extraction and decompression processes. With one
+        decompression process the blocks are decompressed by the process that
+        reads the dump, not by a process of its own.
+    """
+    decompress = processes // DECOMPRESS_SHARE if file_path.endswith(".bz2") else 1
+    if decompress < 2:
+        return processes, 1
+    return processes - decompress, decompress
+
+
+_re_emptyspace = re.compile(r"[\t\n]+")
+_re_xmltag = re.compile(r"</?[A-Za-z]*>")
+
+
+def _article_line(article_text: str) -> str:
+    """
+    Turn the text of an article into a single line of text.
+
+    Returns
+    -------
+    str
+        The line, or `None` if the article has no more than
+        `MIN_ARTICLE_LENGTH` characters.
+    """
+    article_text = _re_emptyspace.sub(" ", article_text)
+    article_text = _re_xmltag.sub(" ", article_text)
+    if len(article_text) > MIN_ARTICLE_LENGTH:
+        return article_text
+    return None
+
+
+class DumpIndex:
+    """
+    An index of the latest finished article dumps of all Wikipedias.
+
+    Wikimedia publishes the status of the latest dump run of all wikis as one
+    JSON file. We fetch it once and keep a map from wiki name to the date of
+    the dump and the URLs, sizes and checksums of its article dump files, in
+    memory and in a cache file that is valid for `ttl` seconds. Wikis whose
+    latest run has not finished the article dump yet are resolved from the
+    `dumpstatus.json` of their previous runs, concurrently over a shared
+    session.
+    """
+
+    def __init__(
+        self,
+        cache_file: str = DUMP_INDEX_CACHE,
+        ttl: int = DUMP_INDEX_TTL,
+        dumps_url: str = DUMPS_URL,
+        session: requests.Session = None,
+    ):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.dumps_url = dumps_url
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=DUMP_INDEX_WORKERS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self._lock = threading.Lock()
+        self._fetched = 0
+        self._wikis = {}
+
+    def dump_info(self, wiki_name: str) -> dict:
+        """
+        Get the information about the latest article dump of a wiki.
+
+        Parameters
+        ----------
+        wiki_name : str
+            The wiki name at Wikipedia, i.e. "dewiki".
+
+        Returns
+        -------
+        dict
+            A dict with the `date` of the dump and a dict `files` that maps the
+            file names without the "<wiki>-<date>-" prefix, i.e.
+            "pages-articles.xml.bz2", to dicts with the `url`, `size`, `sha1`
+            and `md5` of the file. Returns `None` if there is no finished dump.
+        """
+        return self.dump_infos([wiki_name])[wiki_name]
+
+    def dump_infos(self, wiki_names: typing.Iterable[str]) -> dict:
+        """
+        Get the information about the latest article dumps of several wikis.
+
+        Parameters
+        ----------
+        wiki_names : iterable of str
+            The wiki names at Wikipedia, i.e. "dewiki".
+
+        Returns
+        -------
+        dict
+            A map from wiki name to the result of `dump_info`.
+        """
+        wiki_names = list(wiki_names)
+        self._refresh()
+        with self._lock:
+            missing = [w for w in set(wiki_names) if w not in self._wikis]
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(DUMP_INDEX_WORKERS) as executor:
+                infos = list(executor.map(self._fetch_wiki, missing))
+            with self._lock:
+                self._wikis.update(zip(missing, infos))
+                self._save()
+        with self._lock:
+            return {w: self._wikis[w] for w in wiki_names}
+
+    def _refresh(self):
+        with self._lock:
+            now = time.time()
+            if now - self._fetched < self.ttl:
+                return
+            if os.path.exists(self.cache_file) and self._load(now):
+                return
+            r = self.session.get(
+                urllib.parse.urljoin(self.dumps_url, "index.json"),
+                timeout=DOWNLOAD_TIMEOUT,
+            )
+            r.raise_for_status()
+            self._wikis = {}
+            for wiki_name, status in r.json()["wikis"].items():
+                info = self._info_from_status(status)
+                if info:
+                    self._wikis[wiki_name] = info
+            self._fetched = now
+            self._save()
+
+    def _load(self, now: float) -> bool:
+        """
+        Load the cache file, if it is fresh and for the same dumps URL.
+
+        A cache file that cannot be read, e.g. one in an older format, is
+        ignored and replaced by the next save.
+
+        Returns
+        -------
+        bool
+            Whether the cache file was loaded.
+        """
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            if (
+                cache["dumps_url"] != self.dumps_url
+                or now - cache["fetched"] >= self.ttl
+            ):
+                return False
+            fetched, wikis = cache["fetched"], cache["wikis"]
+        except (ValueError, KeyError, TypeError, OSError):
+            return False
+        self._fetched = fetched
+        self._wikis = wikis
+        return True
+
+    def _save(self):
+        cache_dir = os.path.dirname(self.cache_file)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # written to a file of its own and renamed, so that readers never see
+        # a partial cache, even with several processes
+        tmp_file = "{0}.{1}.tmp".format(self.cache_file, os.getpid())
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "dumps_url": self.dumps_url,
+                    "fetched": self._fetched,
+                    "wikis": self._wikis,
+                },
+                f,
+            )
+        os.replace(tmp_file, self.cache_file)
+
+    def _fetch_wiki(self, wiki_name: str) -> dict:
+        """Find the latest finished article dump in the runs of a wiki."""
+        wiki_url = urllib.parse.urljoin(self.dumps_url, wiki_name + "/")
+        r = self.session.get(wiki_url, timeout=DOWNLOAD_TIMEOUT)
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        for date in sorted(set(re.findall(r'href="(\d{8})/"', r.text)), reverse=True):
+            r = self.session.get(
+                urllib.parse.urljoin(wiki_url, date + "/dumpstatus.json"),
+                timeout=DOWNLOAD_TIMEOUT,
+            )
+            if r.status_code == 404:
+                continue
+            r.raise_for_status()
+            info = self._info_from_status(r.json())
+            if info:
+                return info
+        return None
+
+    def _info_from_status(self, status: dict) -> dict:
+        """
+        Parse the article dump files from the dump status of a wiki run.
+
+        Large wikis list only the parts of their dump under `articlesdump`, and
+        the recombined file under `articlesdumprecombine`, which we prefer.
+        """
+        jobs = status.get("jobs", {})
+        if jobs.get("articlesdump", {}).get("status") != "done":
+            return None
+        date = None
+        files = {}
+        for job in (
+            "articlesdump",
+            "articlesdumprecombine",
+            "articlesmultistreamdump",
+            "articlesmultistreamdumprecombine",
+        ):
+            if jobs.get(job, {}).get("status") != "done":
+                continue
+            for file_name, file_info in jobs[job].get("files", {}).items():
+                match = re.match(r"[^-]+-(\d{8})-(.*)$", file_name)
+                if not match or "url" not in file_info:
+                    continue
+                date = match.group(1)
+                files[match.group(2)] = {
+                    "url": urllib.parse.urljoin(self.dumps_url, file_info["url"]),
+                    "size": file_info.get("size"),
+                    "sha1": file_info.get("sha1"),
+                    "md5": file_info.get("md5"),
+                }
+        if "pages-articles.xml.bz2" not in files:
+            return None
+        return {"date": date, "files": files}
+
+
+_dump_index = None
+
+
+def _default_dump_index() -> DumpIndex:
+    global _dump_index
+    if _dump_index is None:
+        _dump_index = DumpIndex()
+    return _dump_index
+
+
+def get_dump_infos(iso_codes: typing.Iterable[str]) -> dict:
+    """
+    Get information about the article dumps of the Wikipedias for ISO codes.
+
+    All Wikipedias are resolved from the shared `DumpIndex`, so this costs at
+    most one request for the whole index, plus a few requests for each
+    Wikipedia whose latest dump is still running.
+
+    Parameters
+    ----------
+    iso_codes : iterable of str
+        The ISO codes of the Wikipedias, i.e. "de" for "dewiki".
+
+    Returns
+    -------
+    dict
+        A map from ISO code to a dict with the `date`, `url`, `size`, `sha1`
+        and `md5` of the "pages-articles.xml.bz2" dump. The value is `None`
+        for Wikipedias without a finished dump.
+    """
+    iso_codes = list(iso_codes)
+    infos = _default_dump_index().dump_infos(iso + "wiki" for iso in iso_codes)
+    result = {}
+    for iso in iso_codes:
+        info = infos[iso + "wiki"]
+        if info is None:
+            result[iso] = None
+        else:
+            result[iso] = dict(
+                info["files"]["pages-articles.xml.bz2"], date=info["date"]
+            )
+    return result
+
+
+def get_dump_info(iso_639_1: str) -> dict:
+    """
+    Get information about the article dump of the Wikipedia for an ISO code.
+
+    Parameters
+    ----------
+    iso_639_1 : str
+        The ISO of the Wikipedia to get the dump information for.
+
+    Returns
+    -------
+    dict
+        A dict with the `date`, `url`, `size`, `sha1` and `md5` of the dump,
+        or `None` if there is no finished dump.
+    """
+    return get_dump_infos([iso_639_1])[iso_639_1]
+
+
+def get_dump_links(iso_codes: typing.Iterable[str]) -> dict:
+    """
+    Get the dump links of the Wikipedias for the given ISO codes.
+
+    Parameters
+    ----------
+    iso_codes : iterable of str
+        The ISO codes of the Wikipedias to get the dump links for.
+
+    Returns
+    -------
+    dict
+        A map from ISO code to a tuple with the date of the Wikipedia dump and
+        the link to the dump. The tuple is `(None, None)` if there is no dump.
+    """
+    return {
+        iso: (info["date"], info["url"]) if info else (None, None)
+        for iso, info in get_dump_infos(iso_codes).items()
+    }
 
 
 def get_dump_link(iso_639_1: str) -> (str, str):
@@ -113,25 +942,39 @@ def get_dump_link(iso_639_1: str) -> (str, str):
     (str, str)
         A tuple with the date of the Wikipedia dump and the link to the dump.
     """
-    url = "https://dumps.wikimedia.org/backup-index.html"
-    wiki_prefix = iso_639_1 + "wiki"
-    html_page = requests.get(url)
-    soup = BeautifulSoup(html_page.content, features="html.parser")
-
-    page = None
-    for link in soup("a"):
-        if link.string == wiki_prefix:
-            page = urllib.parse.urljoin(url, link["href"])
+    return get_dump_links([iso_639_1])[iso_639_1]
 
-    # get the link for the dump file
-    return _dump_link_from_lang_page(wiki_prefix, page)
 
-
-def download_dump(dump_link: str, download_path: str) -> str:
+def download_dump(
+    dump_link: str,
+    download_path: str,
+    sha1: str = None,
+    md5: str = None,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    retries: int = DOWNLOAD_RETRIES,
+    connections: int = 1,
+    progress: typing.Callable[[int, int], None] = None,
+) -> str:
     """
     Download a Wikipedia dump.
 
-    The download folder will be created if it does not exist.
+    The download folder will be created if it does not exist. The dump is
+    streamed in chunks to a `.part` file next to the final file. If the
+    connection drops we resume from the end of the `.part` file with a HTTP
+    Range request, so a previous partial download is never thrown away. The
+    digests are computed while the bytes arrive and the file is only renamed
+    to its final name when they match the expected values. An existing file
+    whose digests do not match, e.g. one truncated by an earlier run, is
+    resumed in the same way.
+
+    With more than one connection the file is split into segments of
+    `DOWNLOAD_SEGMENT_SIZE` bytes that are fetched in parallel into a
+    preallocated `.part` file. Failed segments are retried on their own and
+    finished segments are recorded in a `.part.segments` file, so an
+    interrupted download continues where it stopped. We never open more than
+    `MAX_CONNECTIONS_PER_HOST` connections to the same host, even across
+    concurrent downloads. If the server does not support range requests we fall
+    back to a single stream.
 
     Parameters
     ----------
@@ -139,6 +982,20 @@ def download_dump(dump_link: str, download_path: str) -> str:
         The link to the dump to download
     download_path : str
         A path where to store the downloaded file.
+    sha1 : str (Optional, default: `None`)
+        The expected SHA1 hex digest of the dump file.
+    md5 : str (Optional, default: `None`)
+        The expected MD5 hex digest of the dump file.
+    chunk_size : int (Optional, default: `DOWNLOAD_CHUNK_SIZE`)
+        The number of bytes to read and write at once.
+    retries : int (Optional, default: `DOWNLOAD_RETRIES`)
+        How often to resume the download (or a segment) after a connection
+        error.
+    connections : int (Optional, default: 1)
+        The number of parallel connections to download the file.
+    progress : callable (Optional, default: `None`)
+        A function that is called with the number of downloaded bytes and the
+        total number of bytes (or `None` if unknown) whenever new data arrives.
 
     Returns
     -------
@@ -149,14 +1006,370 @@ def download_dump(dump_link: str, download_path: str) -> str:
     if not os.path.exists(download_path):
         os.makedirs(download_path)
     file_path = os.path.join(download_path, file_name)
-    if not os.path.exists(file_path):
-        r = requests.get(dump_link)
-        with open(file_path, "wb") as f:
-            f.write(r.content)
+    part_path = file_path + ".part"
+    expected = {name: value for name, value in (("sha1", sha1), ("md5", md5)) if value}
+    if os.path.exists(file_path):
+        if not expected:
+            return file_path
+        digests = {name: hashlib.new(name) for name in expected}
+        _hash_file(file_path, digests.values(), chunk_size)
+        if all(
+            digests[name].hexdigest() == value.lower()
+            for name, value in expected.items()
+        ):
+            return file_path
+        # a truncated or corrupt file left by an earlier run: resume it like
+        # a partial download, unless there is one already
+        if os.path.exists(part_path):
+            os.remove(file_path)
+        else:
+            os.replace(file_path, part_path)
+
+    digests = None
+    if connections > 1 or os.path.exists(part_path + ".segments"):
+        if _download_segments(
+            dump_link, part_path, max(1, connections), chunk_size, retries, progress
+        ):
+            digests = {name: hashlib.new(name) for name in expected}
+            _hash_file(part_path, digests.values(), chunk_size)
+    if digests is None:
+        digests = _download_stream(
+            dump_link, part_path, expected, chunk_size, retries, progress
+        )
+
+    for name, value in expected.items():
+        if digests[name].hexdigest() != value.lower():
+            os.remove(part_path)
+            raise IOError(
+                "{0} mismatch for {1}: expected {2}, got {3}".format(
+                    name, dump_link, value, digests[name].hexdigest()
+                )
+            )
+    os.replace(part_path, file_path)
     return file_path
 
 
-def wikipedia_extractor(file_path: str, output_path: str):
+def _download_stream(
+    url: str,
+    part_path: str,
+    expected: dict,
+    chunk_size: int,
+    retries: int,
+    progress: typing.Callable[[int, int], None],
+) -> dict:
+    """
+    Download an URL over a single connection, resuming after errors.
+
+    Returns
+    -------
+    dict
+        A map from digest name to the `hashlib` object of the downloaded file.
+    """
+    digests = {name: hashlib.new(name) for name in expected}
+    offset = 0
+    if os.path.exists(part_path):
+        offset = _hash_file(part_path, digests.values(), chunk_size)
+
+    attempt = 0
+    while True:
+        try:
+            with _host_connection(url):
+                _stream_to_file(url, part_path, offset, digests, chunk_size, progress)
+            return digests
+        except _RETRY_ERRORS:
+            # digests are updated chunk by chunk together with the file, so
+            # we can continue from wherever the connection broke
+            size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            attempt = _next_attempt(attempt, size > offset, retries)
+            offset = size
+
+
+def _stream_to_file(
+    url: str,
+    file_path: str,
+    offset: int,
+    digests: dict,
+    chunk_size: int,
+    progress: typing.Callable[[int, int], None] = None,
+) -> int:
+    """
+    Stream the content of an URL to a file, starting at the given offset.
+
+    Parameters
+    ----------
+    url : str
+        The URL to download.
+    file_path : str
+        The file to append the data to.
+    offset : int
+        The number of bytes already in the file.
+    digests : dict
+        A map from digest name to `hashlib` object. Each object must already
+        contain the first `offset` bytes of the file and will be updated with
+        the new data.
+    chunk_size : int
+        The number of bytes to read and write at once.
+    progress : callable (Optional, default: `None`)
+        A function that is called with the number of bytes in the file and the
+        total number of bytes.
+
+    Returns
+    -------
+    int
+        The size of the file after the download.
+    """
+    headers = {}
+    if offset:
+        headers["Range"] = "bytes={0}-".format(offset)
+    with requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        if offset and r.status_code == 416:
+            # the part file is already complete
+            return offset
+        r.raise_for_status()
+        if offset and r.status_code != 206:
+            # the server ignored the range, start from scratch
+            offset = 0
+            for name in digests:
+                digests[name] = hashlib.new(name)
+        total = None
+        if "Content-Length" in r.headers:
+            total = offset + int(r.headers["Content-Length"])
+        with open(file_path, "ab" if offset else "wb") as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                for digest in digests.values():
+                    digest.update(chunk)
+                offset += len(chunk)
+                if progress:
+                    progress(offset, total)
+    if total is not None and offset < total:
+        raise requests.exceptions.ConnectionError(
+            "Connection closed after {0} of {1} bytes".format(offset, total)
+        )
+    return offset
+
+
+def _download_segments(
+    url: str,
+    part_path: str,
+    connections: int,
+    chunk_size: int,
+    retries: int,
+    progress: typing.Callable[[int, int], None],
+) -> bool:
+    """
+    Download an URL in segments over several pooled connections.
+
+    Returns
+    -------
+    bool
+        `False` if the server does not support range requests and nothing was
+        downloaded, `True` once the `.part` file is complete.
+    """
+    state_path = part_path + ".segments"
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=connections
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    with session:
+        r = session.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+        r.raise_for_status()
+        if (
+            r.headers.get("Accept-Ranges") != "bytes"
+            or "Content-Length" not in r.headers
+        ):
+            # a partial file from an earlier segmented download is useless now
+            for path in (state_path, part_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return False
+        size = int(r.headers["Content-Length"])
+        segments = [
+            (start, min(start + DOWNLOAD_SEGMENT_SIZE, size) - 1)
+            for start in range(0, size, DOWNLOAD_SEGMENT_SIZE)
+        ]
+
+        done = set()
+        if os.path.exists(state_path):
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state["size"] == size and state["segment_size"] == DOWNLOAD_SEGMENT_SIZE:
+                done = set(state["done"])
+        elif os.path.exists(part_path):
+            # continue a single stream download, its prefix is complete
+            prefix = os.path.getsize(part_path)
+            done = {i for i, (start, end) in enumerate(segments) if end < prefix}
+
+        # preallocate the file, segments are written at their position
+        with open(part_path, "r+b" if os.path.exists(part_path) else "wb") as f:
+            f.truncate(size)
+        lock = threading.Lock()
+
+        def save_state():
+            with open(state_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "size": size,
+                        "segment_size": DOWNLOAD_SEGMENT_SIZE,
+                        "done": sorted(done),
+                    },
+                    f,
+                )
+            os.replace(state_path + ".tmp", state_path)
+
+        save_state()
+        downloaded = [sum(segments[i][1] - segments[i][0] + 1 for i in done)]
+
+        def report(n):
+            with lock:
+                downloaded[0] += n
+                if progress:
+                    progress(downloaded[0], size)
+
+        fd = os.open(part_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(connections) as executor:
+                futures = {
+                    executor.submit(
+                        _fetch_segment,
+                        session,
+                        url,
+                        fd,
+                        start,
+                        end,
+                        chunk_size,
+                        retries,
+                        report,
+                        lock,
+                    ): i
+                    for i, (start, end) in enumerate(segments)
+                    if i not in done
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    with lock:
+                        done.add(futures[future])
+                        save_state()
+        finally:
+            os.close(fd)
+    os.remove(state_path)
+    return True
+
+
+def _fetch_segment(
+    session: requests.Session,
+    url: str,
+    fd: int,
+    start: int,
+    end: int,
+    chunk_size: int,
+    retries: int,
+    report: typing.Callable[[int], None],
+    lock: threading.Lock,
+):
+    """
+    Download the byte range `start` to `end` (inclusive) of an URL into the
+    same range of an open file, retrying from the last written byte.
+    """
+    pos = start
+    attempt = 0
+    while pos <= end:
+        last_pos = pos
+        try:
+            with _host_connection(url):
+                with session.get(
+                    url,
+                    headers={"Range": "bytes={0}-{1}".format(pos, end)},
+                    stream=True,
+                    timeout=DOWNLOAD_TIMEOUT,
+                ) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise IOError("Server ignored range request for " + url)
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        chunk = chunk[: end + 1 - pos]
+                        _write_at(fd, chunk, pos, lock)
+                        pos += len(chunk)
+                        report(len(chunk))
+            if pos <= end:
+                raise requests.exceptions.ConnectionError(
+                    "Connection closed at byte {0} of segment {1}-{2}".format(
+                        pos, start, end
+                    )
+                )
+        except _RETRY_ERRORS:
+            attempt = _next_attempt(attempt, pos > last_pos, retries)
+
+
+def _write_at(fd: int, data: bytes, offset: int, lock: threading.Lock):
+    """Write data at a position of a file shared between threads."""
+    data = memoryview(data)
+    if hasattr(os, "pwrite"):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+    else:
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data) :]
+
+
+def _next_attempt(attempt: int, made_progress: bool, retries: int) -> int:
+    """
+    Count a failed download attempt and wait before the next one.
+
+    Attempts that made progress reset the counter and are retried right away.
+    Re-raises the current exception when there are no retries left.
+    """
+    if made_progress:
+        return 0
+    attempt += 1
+    if attempt > retries:
+        raise
+    time.sleep(min(2**attempt, 60))
+    return attempt
+
+
+@contextlib.contextmanager
+def _host_connection(url: str):
+    """Hold one of the `MAX_CONNECTIONS_PER_HOST` slots of the URL's host."""
+    host = urllib.parse.urlsplit(url).netloc
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        slots = _host_slots[host]
+    with slots:
+        yield
+
+
+def _hash_file(file_path: str, digests, chunk_size: int) -> int:
+    """
+    Feed the content of a file into digests.
+
+    Returns
+    -------
+    int
+        The size of the file.
+    """
+    size = 0
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            for digest in digests:
+                digest.update(chunk)
+            size += len(chunk)
+    return size
+
+
+def wikipedia_extractor(
+    file_path: str,
+    output_path: str,
+    processes: int = None,
+    stats: WikiExtractor.PipelineStats = None,
+):
     """
     Extract Wikipedia data (articles) from a dump file.
 
@@ -169,32 +1382,39 @@ def wikipedia_extractor(file_path: str, output_path: str):
         The path to the dump file.
     output_path : str
         The output path for the extracted data. WikiExtractor will create
-        sub-directories with JSONL files in each sub-directory.
+        sub-directories with JSONL files in each sub-directory. The articles
+        are written as soon as they are extracted, not in the order of the
+        dump; each has its `id`.
+    processes : int
+        The number of extraction processes, including those that decompress
+        a .bz2 dump, by default one less than the number of CPUs.
+    stats : WikiExtractor.PipelineStats (Optional, default: `None`)
+        The statistics to report during the extraction.
 
     Returns
     -------
     (str, str)
-        The standard output and error output of the WikiExtractor.
-    """
-    out = None
-    err = None
-
-    proc = subprocess.Popen(
-        [
-            sys.executable,
-            os.path.join(SCRIPT_DIR, "WikiExtractor.py"),
-            file_path,
-            "--json",
-            "-q",
-            "-b",
-            "100M",
-            "-o",
-            output_path,
-        ],
-        stdout=subprocess.PIPE,
+        The standard output and error output of the WikiExtractor, which are
+        empty since it runs in-process and writes its log with `logging`.
+        Kept for the callers that unpack them.
+    """
+    if processes is None:
+        processes = max(1, os.cpu_count() - 1)
+    processes, decompress = _split_processes(file_path, processes)
+    options = WikiExtractor.extraction_options(
+        write_json=True, quiet=True, ordered=False, decompress_processes=decompress
+    )
+    WikiExtractor.process_dump(
+        file_path,
+        None,
+        output_path,
+        WIKIEXTRACTOR_FILE_SIZE,
+        False,
+        processes,
+        opts=options,
+        stats=stats,
     )
-    (out, err) = proc.communicate()
-    return (out, err)
+    return ("", "")
 
 
 if __name__ == "__main__":
@@ -21,7 +21,7 @@ REQUIRES_PYTHON = ">=3.6.0"
 VERSION = "0.1.2"
 
 # What packages are required for this module to be executed?
-REQUIRED = ["requests", "beautifulsoup4", "pressagio", "regex", "syntok"]
+REQUIRED = ["requests", "pressagio", "regex", "syntok"]
 
 # What packages are optional?
 EXTRAS = {
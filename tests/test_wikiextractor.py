@@ -0,0 +1,857 @@
+import unittest
+import os
+import shutil
+import tempfile
+import bz2
+import random
+import re
+import pickle
+import queue
+import subprocess
+import sys
+import threading
+from unittest import mock
+
+from poiolib import WikiExtractor
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+DUMP_FILE = os.path.join(SCRIPT_DIR, "test_data", "xxwiki-20200101-pages-articles.xml")
+
+
+class TestExtractDump(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_extract_dump(self):
+        records = list(WikiExtractor.extract_dump(DUMP_FILE, process_count=2))
+        ids = [record[0] for record in records]
+        self.assertEqual(ids, ["1", "2", "3", "4", "6", "7", "8", "9", "10"])
+        id, revid, title, text = records[0]
+        self.assertEqual(title, "Rhine")
+        self.assertTrue(text.startswith("Rhine\n\nThe Rhine is one of"))
+        self.assertIn("In German it is called , in French .", text)
+
+    def test_extract_dump_with_templates(self):
+        template_file = os.path.join(self.tmp_dir, "templates.xml")
+        records = list(
+            WikiExtractor.extract_dump(DUMP_FILE, template_file=template_file)
+        )
+        self.assertTrue(os.path.exists(template_file))
+        self.assertIn('In German it is called "Rhein" (de)', records[0][3])
+        # the templates of one extraction do not leak into the next one
+        records = list(WikiExtractor.extract_dump(DUMP_FILE))
+        self.assertIn("In German it is called , in French .", records[0][3])
+        self.assertEqual(WikiExtractor.options.templates, {})
+
+    def test_template_snapshot(self):
+        snapshots = os.path.join(self.tmp_dir, "snapshots")
+        options = WikiExtractor.extraction_options(
+            quiet=True, template_snapshots=snapshots
+        )
+        records = list(WikiExtractor.extract_dump(DUMP_FILE, options))
+        self.assertIn('In German it is called "Rhein" (de)', records[0][3])
+        # keyed by the wiki and the date of the dump
+        snapshot = os.path.join(snapshots, "xxwiki-20200101.templates")
+        self.assertEqual(
+            WikiExtractor.template_store_info(snapshot)["dbname"], "xxwiki"
+        )
+        # the snapshot is used instead of the templates of the dump
+        templates, redirects = WikiExtractor.open_template_store(snapshot)
+        templates = dict(templates.items())
+        redirects = dict(redirects.items())
+        templates["Template:Lang"] = "LANG-{{{2}}}"
+        info = WikiExtractor.template_store_info(snapshot)
+        WikiExtractor.write_template_store(snapshot, templates, redirects, info)
+        records = list(WikiExtractor.extract_dump(DUMP_FILE, options, process_count=2))
+        self.assertIn("In German it is called LANG-Rhein,", records[0][3])
+        # a snapshot of another version is created again
+        info["version"] = "0.0"
+        WikiExtractor.write_template_store(snapshot, templates, redirects, info)
+        records = list(WikiExtractor.extract_dump(DUMP_FILE, options))
+        self.assertIn('In German it is called "Rhein" (de)', records[0][3])
+        self.assertEqual(
+            WikiExtractor.template_store_info(snapshot)["version"],
+            WikiExtractor.version,
+        )
+        # and so is an invalid one
+        with open(snapshot, "w") as f:
+            f.write("truncated")
+        records = list(WikiExtractor.extract_dump(DUMP_FILE, options))
+        self.assertIn('In German it is called "Rhein" (de)', records[0][3])
+
+    def test_min_text_length(self):
+        options = WikiExtractor.extraction_options(quiet=True, min_text_length=200)
+        records = list(WikiExtractor.extract_dump(DUMP_FILE, options))
+        self.assertEqual(len(records), 5)
+        for record in records:
+            self.assertGreaterEqual(len(record[3]), 200)
+
+    def test_unordered(self):
+        options = WikiExtractor.extraction_options(quiet=True, ordered=False)
+        records = list(WikiExtractor.extract_dump(DUMP_FILE, options, process_count=3))
+        self.assertEqual(sorted(records), sorted(WikiExtractor.extract_dump(DUMP_FILE)))
+
+    def test_flow_control(self):
+        options = WikiExtractor.extraction_options(
+            quiet=True, max_in_flight_pages=2, max_in_flight_size=100
+        )
+        records = list(WikiExtractor.extract_dump(DUMP_FILE, options, process_count=3))
+        self.assertEqual(records, list(WikiExtractor.extract_dump(DUMP_FILE)))
+
+    def test_stop_early(self):
+        records = WikiExtractor.extract_dump(DUMP_FILE, process_count=2)
+        self.assertEqual(next(records)[2], "Rhine")
+        records.close()
+        self.assertEqual(next(WikiExtractor.extract_dump(DUMP_FILE))[2], "Rhine")
+
+    def test_stats(self):
+        snapshots = []
+        stats = WikiExtractor.PipelineStats(snapshots.append, interval=0.01)
+        records = list(
+            WikiExtractor.extract_dump(DUMP_FILE, process_count=2, stats=stats)
+        )
+        snapshot = snapshots[-1]
+        self.assertTrue(snapshot["final"])
+        self.assertFalse(any(s["final"] for s in snapshots[:-1]))
+        # pages that are not redirects
+        self.assertEqual(snapshot["pages_read"], 19)
+        self.assertEqual(snapshot["articles_extracted"], len(records))
+        self.assertEqual(
+            sorted(snapshot["queues"]),
+            [
+                "in_flight",
+                "in_flight_size",
+                "jobs_queue",
+                "output_queue",
+                "spool",
+                "spool_size",
+            ],
+        )
+        self.assertEqual(len(snapshot["workers"]), 2)
+        self.assertEqual(
+            sum(worker["articles"] for worker in snapshot["workers"]), len(records)
+        )
+        # nothing is written by extract_dump
+        self.assertEqual(snapshot["bytes_written"], 0)
+
+
+def make_multistream(dump_file, output_dir, pages_per_stream=3):
+    """Write a dump as a multistream dump and its index, like Wikimedia does."""
+    with open(dump_file, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    header_end = next(i for i, line in enumerate(lines) if "</siteinfo>" in line) + 1
+    page_starts = [i for i, line in enumerate(lines) if line.strip() == "<page>"]
+    footer_start = max(i for i, line in enumerate(lines) if "</page>" in line) + 1
+    chunks = [lines[:header_end]]
+    for i in range(0, len(page_starts), pages_per_stream):
+        chunk_starts = page_starts[i : i + pages_per_stream + 1]
+        end = (
+            chunk_starts[pages_per_stream]
+            if len(chunk_starts) > pages_per_stream
+            else footer_start
+        )
+        chunks.append(lines[chunk_starts[0] : end])
+    chunks.append(lines[footer_start:])
+    name = os.path.join(output_dir, "xxwiki-20200101-pages-articles-multistream")
+    index = []
+    with open(name + ".xml.bz2", "wb") as f:
+        for chunk in chunks:
+            if chunk is not chunks[0] and chunk is not chunks[-1]:
+                for line in chunk:
+                    if line.strip().startswith("<title>"):
+                        title = line.strip()[len("<title>") : -len("</title>")]
+                        index.append("%d:0:%s\n" % (f.tell(), title))
+            f.write(bz2.compress("".join(chunk).encode("utf-8")))
+    with bz2.open(name + "-index.txt.bz2", "wt", encoding="utf-8") as f:
+        f.writelines(index)
+    return name + ".xml.bz2"
+
+
+class TestMultistream(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dump_file = make_multistream(DUMP_FILE, self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_multistream_ranges(self):
+        ranges = WikiExtractor.multistream_ranges(
+            self.dump_file, WikiExtractor.multistream_index(self.dump_file)
+        )
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.dump_file))
+        # the header, the streams of pages, but not the footer, are indexed
+        self.assertEqual(len(ranges), 1 + 7)
+
+    def test_extract_multistream(self):
+        expected = list(WikiExtractor.extract_dump(DUMP_FILE))
+        records = list(WikiExtractor.extract_dump(self.dump_file, process_count=3))
+        self.assertEqual(records, expected)
+
+    def test_extract_multistream_with_templates(self):
+        expected = list(
+            WikiExtractor.extract_dump(
+                DUMP_FILE, template_file=os.path.join(self.tmp_dir, "t1.xml")
+            )
+        )
+        records = list(
+            WikiExtractor.extract_dump(
+                self.dump_file,
+                template_file=os.path.join(self.tmp_dir, "t2.xml"),
+                process_count=2,
+            )
+        )
+        self.assertEqual(records, expected)
+
+    def test_extract_multistream_buffers(self):
+        expected = list(
+            WikiExtractor.extract_dump(
+                DUMP_FILE, template_file=os.path.join(self.tmp_dir, "t1.xml")
+            )
+        )
+        opts = WikiExtractor.extraction_options(quiet=True, reader="buffers")
+        records = list(
+            WikiExtractor.extract_dump(
+                self.dump_file,
+                opts=opts,
+                template_file=os.path.join(self.tmp_dir, "t2.xml"),
+                process_count=2,
+            )
+        )
+        self.assertEqual(records, expected)
+
+
+class TestParallelBz2(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rand = random.Random(0)
+        words = [
+            "".join(rand.choice("abcdefgh \n") for _ in range(6)) for _ in range(999)
+        ]
+        self.data = "".join(rand.choice(words) for _ in range(60000)).encode("utf-8")
+        self.bz2_file = os.path.join(self.tmp_dir, "data.bz2")
+        with open(self.bz2_file, "wb") as f:
+            # blocks of 100k, and a second stream
+            f.write(bz2.compress(self.data, 1))
+            f.write(bz2.compress(b"second\nstream", 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def lines(self):
+        return "".join(WikiExtractor.bz2_lines(self.bz2_file, 2)).encode("utf-8")
+
+    def test_bz2_lines(self):
+        segments = list(WikiExtractor.bz2_segments(self.bz2_file))
+        self.assertGreater(sum(is_block for _, _, is_block in segments), 3)
+        self.assertEqual(self.lines(), self.data + b"second\nstream")
+
+    def test_false_markers(self):
+        with open(self.bz2_file, "rb") as f:
+            markers = list(WikiExtractor.bz2_markers(f))
+        # magic numbers that occur by chance in the first and second block
+        false_markers = [(markers[0][0] + 1001, False), (markers[1][0] + 999, True)]
+        with mock.patch(
+            "poiolib.WikiExtractor.bz2_markers",
+            return_value=iter(sorted(markers + false_markers)),
+        ):
+            self.assertEqual(self.lines(), self.data + b"second\nstream")
+
+    def test_extract_bz2(self):
+        dump_file = os.path.join(self.tmp_dir, "xxwiki-20200101-pages-articles.xml.bz2")
+        with open(DUMP_FILE, "rb") as f, open(dump_file, "wb") as out:
+            out.write(bz2.compress(f.read()))
+        expected = list(WikiExtractor.extract_dump(DUMP_FILE))
+        records = list(WikiExtractor.extract_dump(dump_file, process_count=2))
+        self.assertEqual(records, expected)
+        opts = WikiExtractor.extraction_options(quiet=True, reader="buffers")
+        records = list(
+            WikiExtractor.extract_dump(dump_file, opts=opts, process_count=2)
+        )
+        self.assertEqual(records, expected)
+
+    def test_stop_early_bz2(self):
+        # many blocks, so that the decompression pool is still busy
+        with open(DUMP_FILE) as f:
+            dump = f.read()
+        start = dump.index("  <page>")
+        end = dump.rindex("</mediawiki>")
+        dump = dump[:start] + dump[start:end] * 300 + dump[end:]
+        dump_file = os.path.join(self.tmp_dir, "xxwiki-20200101-pages-articles.xml.bz2")
+        with open(dump_file, "wb") as out:
+            out.write(bz2.compress(dump.encode("utf-8"), 1))
+        script = (
+            "import sys\n"
+            "from poiolib import WikiExtractor\n"
+            "records = WikiExtractor.extract_dump(sys.argv[1], process_count=2)\n"
+            "print(next(records)[2])\n"
+            "records.close()\n"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", script, dump_file],
+            cwd=os.path.dirname(SCRIPT_DIR),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            timeout=60,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout, "Rhine\n")
+        self.assertNotIn("Traceback", result.stderr)
+
+
+class TestBufferReader(unittest.TestCase):
+    def setUp(self):
+        with open(DUMP_FILE) as f:
+            self.expected = list(WikiExtractor.pages_from(f))
+
+    def test_pages(self):
+        pages = list(
+            WikiExtractor.buffer_pages_from(WikiExtractor.file_blocks(DUMP_FILE))
+        )
+        self.assertEqual(pages, self.expected)
+        self.assertEqual(len(pages), 19)
+
+    def test_small_blocks(self):
+        # the tags are split across blocks
+        with mock.patch("poiolib.WikiExtractor.readBlockSize", 7):
+            pages = list(
+                WikiExtractor.buffer_pages_from(WikiExtractor.file_blocks(DUMP_FILE))
+            )
+        self.assertEqual(pages, self.expected)
+        with open(DUMP_FILE) as f:
+            self.assertEqual(list(WikiExtractor.buffer_pages_from(f)), self.expected)
+
+    def test_split_header(self):
+        with mock.patch("poiolib.WikiExtractor.readBlockSize", 100):
+            header, blocks = WikiExtractor.split_header(
+                WikiExtractor.file_blocks(DUMP_FILE)
+            )
+            self.assertTrue(header[-1].endswith("</siteinfo>"))
+            with open(DUMP_FILE, "rb") as f:
+                self.assertEqual(
+                    "".join(header).encode("utf-8") + b"".join(blocks), f.read()
+                )
+
+    def test_extract_dump(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_file = os.path.join(tmp_dir, "templates.xml")
+            # scanning the templates, then loading them
+            for scanned in (True, False):
+                lines = list(
+                    WikiExtractor.extract_dump(DUMP_FILE, template_file=template_file)
+                )
+                if scanned:
+                    os.remove(template_file)
+                opts = WikiExtractor.extraction_options(quiet=True, reader="buffers")
+                buffers = list(
+                    WikiExtractor.extract_dump(
+                        DUMP_FILE, opts=opts, template_file=template_file
+                    )
+                )
+                self.assertEqual(buffers, lines)
+
+
+class TestRangeReaders(unittest.TestCase):
+    def test_page_ranges(self):
+        ranges = WikiExtractor.page_ranges(DUMP_FILE, 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(ranges[-1][1], os.path.getsize(DUMP_FILE))
+        with open(DUMP_FILE, "rb") as f:
+            data = f.read()
+        for start, end in ranges:
+            self.assertTrue(data.startswith(b"<page>", start))
+        # a range for each page, at most
+        ranges = WikiExtractor.page_ranges(DUMP_FILE, 1000)
+        self.assertEqual(len(ranges), data.count(b"<page>"))
+        pages = [
+            page
+            for start, end in ranges
+            for page in WikiExtractor.buffer_pages_from(
+                WikiExtractor.range_blocks(DUMP_FILE, start, end)
+            )
+        ]
+        with open(DUMP_FILE) as f:
+            self.assertEqual(pages, list(WikiExtractor.pages_from(f)))
+
+    def test_extract_dump(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_file = os.path.join(tmp_dir, "templates.xml")
+            expected = list(
+                WikiExtractor.extract_dump(DUMP_FILE, template_file=template_file)
+            )
+            os.remove(template_file)
+            # ranges of a few pages, and fewer pages in flight
+            opts = WikiExtractor.extraction_options(
+                quiet=True, range_readers=2, max_in_flight_pages=2
+            )
+            with mock.patch("poiolib.WikiExtractor.readRangeSize", 1000):
+                records = list(
+                    WikiExtractor.extract_dump(
+                        DUMP_FILE,
+                        opts=opts,
+                        template_file=template_file,
+                        process_count=3,
+                    )
+                )
+        self.assertEqual(records, expected)
+
+    def test_unordered(self):
+        expected = list(WikiExtractor.extract_dump(DUMP_FILE))
+        opts = WikiExtractor.extraction_options(
+            quiet=True, range_readers=3, ordered=False
+        )
+        records = list(
+            WikiExtractor.extract_dump(DUMP_FILE, opts=opts, process_count=3)
+        )
+        self.assertEqual(sorted(records, key=lambda r: int(r[0])), expected)
+
+
+class TestReorderBuffer(unittest.TestCase):
+    def test_reorder(self):
+        spool = WikiExtractor.ReorderBuffer()
+        self.assertEqual(spool.push(2, "c", 1), [])
+        self.assertEqual(spool.push(1, "b", 10), [])
+        self.assertEqual((len(spool), spool.size), (2, 11))
+        self.assertEqual(spool.push(0, "a", 100), ["a", "b", "c"])
+        self.assertEqual((len(spool), spool.size), (0, 0))
+        self.assertEqual(spool.push(3, "d"), ["d"])
+
+    def test_ranges(self):
+        spool = WikiExtractor.ReorderBuffer()
+        second = 1 << WikiExtractor.rangeShift
+        self.assertEqual(spool.push(second, "c"), [])
+        self.assertEqual(spool.push(0, "a"), ["a"])
+        self.assertEqual(spool.end_range(2 * second + 1), [])
+        self.assertEqual(spool.push(1, "b"), ["b"])
+        self.assertEqual(spool.end_range(2), ["c"])
+        self.assertEqual(spool.end_range(second + 1), [])
+        self.assertEqual(spool.push(2 * second, "d"), ["d"])
+        self.assertEqual(spool.next_page, 3 * second)
+        self.assertEqual(spool.released, 4)
+
+    def test_unordered(self):
+        spool = WikiExtractor.ReorderBuffer(ordered=False)
+        self.assertEqual(spool.push(2, "c", 1), ["c"])
+        self.assertEqual(spool.push(0, "a", 1), ["a"])
+        self.assertEqual((len(spool), spool.size), (0, 0))
+
+
+class TestFlowControl(unittest.TestCase):
+    def test_acquire_waits_for_release(self):
+        flow = WikiExtractor.FlowControl(max_pages=2, max_size=100)
+        self.assertEqual(flow.acquire(60), 0)
+        timer = threading.Timer(0.1, flow.release, (60,))
+        timer.start()
+        # too large until the first page is released
+        self.assertGreater(flow.acquire(50), 0)
+        timer.join()
+        self.assertEqual((flow.pages.value, flow.size.value), (1, 50))
+        self.assertEqual(flow.acquire(10), 0)
+        self.assertFalse(flow.has_room(0))
+
+    def test_large_page(self):
+        flow = WikiExtractor.FlowControl(max_pages=2, max_size=100)
+        # goes alone
+        self.assertEqual(flow.acquire(1000), 0)
+        self.assertFalse(flow.has_room(1))
+
+
+class TestJobBatcher(unittest.TestCase):
+    def test_batches(self):
+        jobs_queue = queue.Queue()
+        batcher = WikiExtractor.JobBatcher(jobs_queue)
+        batcher.add("a", 10)
+        # the workers have batches waiting: the next ones grow
+        batcher.add("b", 10)
+        batcher.add("c", 10)
+        # large pages go alone, without waiting for the batch
+        batcher.add("large", WikiExtractor.large_page_size)
+        batcher.add("d", 10)
+        batcher.add("e", 10)
+        batcher.flush()
+        batches = []
+        while not jobs_queue.empty():
+            batches.append(jobs_queue.get())
+        self.assertEqual(batches, [["a"], ["b"], ["large"], ["c", "d"], ["e"]])
+        self.assertEqual(batcher.max_pages, 8)
+        # the workers ran out of batches: the next ones shrink
+        batcher.add("f", 10)
+        batcher.flush()
+        self.assertEqual(batcher.max_pages, 4)
+
+    def test_batch_size(self):
+        jobs_queue = queue.Queue()
+        batcher = WikiExtractor.JobBatcher(jobs_queue)
+        batcher.max_pages = WikiExtractor.max_batch_pages
+        size = WikiExtractor.large_page_size - 1
+        for i in range(WikiExtractor.max_batch_size // size + 1):
+            batcher.add(i, size)
+        self.assertEqual(len(jobs_queue.get_nowait()), i + 1)
+
+
+class TestTemplateStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "store")
+        self.templates = {"Template:T%d" % i: "body {{{1}}} %d" % i for i in range(100)}
+        self.templates["Template:Ünïcode"] = "Ärger"
+        self.redirects = {"Template:R": "Template:T1"}
+        WikiExtractor.write_template_store(self.path, self.templates, self.redirects)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_template_store(self):
+        templates, redirects = WikiExtractor.open_template_store(self.path)
+        self.assertEqual(len(templates), len(self.templates))
+        self.assertEqual(templates["Template:T42"], "body {{{1}}} 42")
+        self.assertEqual(templates.get("Template:Ünïcode"), "Ärger")
+        self.assertNotIn("Template:T100", templates)
+        self.assertIsNone(templates.get("Template:R"))
+        self.assertEqual(dict(templates.items()), self.templates)
+        self.assertEqual(dict(redirects.items()), self.redirects)
+        # processes share the file, not the content
+        self.assertLess(len(pickle.dumps(templates)), 200)
+        self.assertEqual(
+            dict(pickle.loads(pickle.dumps(redirects)).items()), self.redirects
+        )
+
+    def test_empty_template_store(self):
+        WikiExtractor.write_template_store(self.path, {}, {})
+        templates, redirects = WikiExtractor.open_template_store(self.path)
+        self.assertEqual(len(templates), 0)
+        self.assertNotIn("Template:T1", templates)
+
+
+class TestTemplateCache(unittest.TestCase):
+    def test_lru(self):
+        cache = WikiExtractor.TemplateCache(10)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", "A", 4)
+        cache.put("b", "B", 4)
+        self.assertEqual(cache.get("a"), "A")
+        # "b" is the least recently used
+        cache.put("c", "C", 4)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.get("c"), "C")
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.counts(), (3, 1, 1))
+
+    def test_large_template(self):
+        cache = WikiExtractor.TemplateCache(10)
+        cache.put("a", "A", 4)
+        # the latest template is kept, even if larger than the cache
+        cache.put("b", "B", 20)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get("b"), "B")
+        self.assertEqual(cache.evictions, 1)
+
+    def test_extract_with_small_cache(self):
+        opts = WikiExtractor.extraction_options(quiet=True, template_cache_size=1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_file = os.path.join(tmp_dir, "templates.xml")
+            records = list(
+                WikiExtractor.extract_dump(
+                    DUMP_FILE, opts=opts, template_file=template_file
+                )
+            )
+        self.assertIn('In German it is called "Rhein" (de)', records[0][3])
+
+
+class TestMemoizedExpansion(unittest.TestCase):
+    def setUp(self):
+        self.options = WikiExtractor.extraction_options(
+            templates={
+                "Template:Cn": "[citation needed]",
+                "Template:Box": "{{#if:{{{1|}}}|{{uc:{{{1}}}}}|none}}",
+                "Template:Here": "{{Box|{{PAGENAME}}}}",
+            },
+            templatePrefix="Template:",
+        )
+        patcher = mock.patch.object(WikiExtractor, "options", self.options)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def extract(self, title, text):
+        return WikiExtractor.Extractor("1", "1", title, [text]).extract_text()
+
+    def test_memoized(self):
+        text = "A{{cn}} B{{cn}} {{Box|x}} {{Box|x}} {{Box}}"
+        self.assertEqual(
+            self.extract("P", text)[1], "A[citation needed] B[citation needed] X X none"
+        )
+        hits, misses, _ = self.options.expansionCache.counts()
+        # Template:Cn, Template:Box|x with its #if and uc, Template:Box with its #if
+        self.assertEqual((hits, misses), (2, 6))
+        self.assertEqual(
+            self.extract("Q", text)[1], "A[citation needed] B[citation needed] X X none"
+        )
+        self.assertEqual(self.options.expansionCache.counts()[1], 6)
+
+    def test_page_dependent(self):
+        self.assertEqual(self.extract("Page", "{{Here}}")[1], "PAGE")
+        self.assertEqual(self.extract("Other", "{{Here}}")[1], "OTHER")
+        self.assertNotIn(("{", "Template:Here", ""), self.options.expansionCache)
+
+    def test_disabled(self):
+        self.options.memoize_expansions = False
+        self.assertEqual(
+            self.extract("P", "{{cn}}{{cn}}")[1], "[citation needed][citation needed]"
+        )
+        self.assertEqual(len(self.options.expansionCache), 0)
+
+
+class TestExpansionPolicy(unittest.TestCase):
+    templates = {
+        "Template:Cn": "[citation needed]",
+        "Template:Box": "{{#if:{{{1|}}}|{{uc:{{{1}}}}}|none}}",
+        "Template:Wrap": "<{{Box|{{{1}}}}}>",
+    }
+    text = "A{{cn}} {{Box|x}} {{wrap|y}} {{lc:Q}}"
+
+    def extract(self, text, **kwargs):
+        opts = WikiExtractor.extraction_options(
+            templates=self.templates, templatePrefix="Template:", **kwargs
+        )
+        with mock.patch.object(WikiExtractor, "options", opts):
+            return WikiExtractor.Extractor("1", "1", "P", [text]).extract_text()[1]
+
+    def test_allowed(self):
+        self.assertEqual(self.extract(self.text), "A[citation needed] X <Y> q")
+        # the templates used by Wrap are expanded
+        self.assertEqual(self.extract(self.text, allowed_templates=["wrap"]), "A <Y> q")
+
+    def test_denied(self):
+        self.assertEqual(
+            self.extract(self.text, denied_templates=["Box", "lc"]),
+            "A[citation needed] <> ",
+        )
+        self.assertEqual(
+            self.extract(self.text, denied_templates=["Template:Cn"]), "A X <Y> q"
+        )
+
+    def test_budget(self):
+        # Cn, Box, #if and uc
+        self.assertEqual(
+            self.extract(self.text, expansion_budget=4), "A[citation needed] X "
+        )
+        self.assertEqual(self.extract(self.text, expansion_time_budget=1e-9), "A ")
+
+    def test_budget_not_memoized(self):
+        opts = WikiExtractor.extraction_options(
+            templates=self.templates, templatePrefix="Template:", expansion_budget=2
+        )
+        with mock.patch.object(WikiExtractor, "options", opts):
+            for text, expected in (
+                ("{{wrap|y}}", "<>"),
+                ("{{cn}}{{wrap|y}}", "[citation needed]<>"),
+            ):
+                extractor = WikiExtractor.Extractor("1", "1", "P", [text])
+                self.assertEqual(extractor.extract_text()[1], expected)
+            opts.expansion_budget = 0
+            extractor = WikiExtractor.Extractor("1", "1", "P", ["{{wrap|y}}"])
+            self.assertEqual(extractor.extract_text()[1], "<Y>")
+
+
+class TestMatchingDelimiters(unittest.TestCase):
+    # matches found by the regular expression searches before the single scan
+    braces = [
+        ("{{a|{{b}}|[[c|d]]}}", [(0, 19)], [(0, 19)], []),
+        ("{{{1|{{PAGENAME}}}}}", [(0, 20)], [(0, 20)], [(0, 20)]),
+        ("{{{{{subst|}}}CURRENTYEAR}}", [(0, 27)], [(0, 27)], []),
+        ("{{{{ }}}}", [(0, 9)], [(0, 9)], [(0, 9)]),
+        ("{{{{{ }}}}}", [(0, 11)], [(0, 11)], [(0, 11)]),
+        ("{{{!}} {{!}}}", [], [(7, 12)], []),
+        (
+            "{{{link|{{ucfirst:{{{1}}}}}} interchange}}}",
+            [(0, 43)],
+            [(0, 43)],
+            [(0, 43)],
+        ),
+        ("{{#if: a | [[b|}}]] }} }}", [(0, 15)], [(0, 17)], []),
+        ("[[a]] ]] {{b}} {{c", [(0, 5), (9, 14)], [(9, 14)], []),
+        ("{{x}}}", [(0, 5)], [(0, 5)], []),
+    ]
+    links = [
+        ("[[a|b]] [[c|[[d]] e]]s", [(0, 7), (8, 21)], "b [[d]] es"),
+        ("[[[a]]] ]] [[b", [(0, 6)], "[a] ]] [[b"),
+        ("[[File:x.png|thumb|a [[b|c]] d]]", [(0, 32)], ""),
+    ]
+
+    def test_matching_braces(self):
+        for text, *matches in self.braces:
+            for ldelim, expected in zip((0, 2, 3), matches):
+                self.assertEqual(
+                    list(WikiExtractor.findMatchingBraces(text, ldelim)),
+                    expected,
+                    (text, ldelim),
+                )
+
+    @staticmethod
+    def balanced_links(text):
+        # the search of the delimiters one at a time, before the single scan
+        depth = cur = start = 0
+        while True:
+            m = re.compile(r"\[\[|]]" if depth else r"\[\[").search(text, cur)
+            if not m:
+                return
+            if m.group() == "[[":
+                if not depth:
+                    start = m.start()
+                depth += 1
+            else:
+                depth -= 1
+                if not depth:
+                    yield start, m.end()
+            cur = m.end()
+
+    def test_balanced_links(self):
+        for text, expected, replaced in self.links:
+            self.assertEqual(list(self.balanced_links(text)), expected)
+            self.assertEqual(list(WikiExtractor.findBalancedLinks(text)), expected)
+            self.assertEqual(WikiExtractor.replaceInternalLinks(text), replaced)
+
+    def test_random(self):
+        rng = random.Random(0)
+        for _ in range(2000):
+            text = "".join(rng.choice("{{}}[[]]|a") for _ in range(rng.randrange(30)))
+            self.assertEqual(
+                list(WikiExtractor.findBalancedLinks(text)),
+                list(self.balanced_links(text)),
+                text,
+            )
+
+
+class TestFusedCleaner(unittest.TestCase):
+    def clean(self, text, **kwargs):
+        opts = WikiExtractor.extraction_options(**kwargs)
+        with mock.patch.object(WikiExtractor, "options", opts):
+            return WikiExtractor.Extractor("1", "1", "T", []).clean(text)
+
+    def test_clean(self):
+        text = (
+            "A<!-- note <div> -->B<br/> <b>C</b> <ref name=x/>D"
+            "<table><tr><td><div>E</div></td></tr></table>F"
+            "<div class='a'><div>G</div>H</div>I<gallery>J K"
+        )
+        expected = self.clean(text)
+        self.assertEqual(expected, "AB C DFI<gallery>J K")
+        self.assertEqual(self.clean(text, fused_cleaner=True), expected)
+
+    def test_unbalanced(self):
+        for text in (
+            "A<div>B<div>C</div>D",
+            "A</div>B<div>C",
+            "A<div>B</div>C</div>D<ul><li>E</ul>F</li>",
+            "A<small>B<sup>C</small>D</sup>E",
+        ):
+            self.assertEqual(self.clean(text, fused_cleaner=True), self.clean(text))
+
+    def test_extract_dump(self):
+        opts = WikiExtractor.extraction_options(quiet=True, fused_cleaner=True)
+        self.assertEqual(
+            list(WikiExtractor.extract_dump(DUMP_FILE, opts=opts)),
+            list(WikiExtractor.extract_dump(DUMP_FILE)),
+        )
+
+
+class TestStageProfile(unittest.TestCase):
+    def test_report(self):
+        profile = WikiExtractor.StageProfile()
+        for k in range(100):
+            profile.add("transform", 0.001 if k < 98 else 1.0, str(k))
+        other = WikiExtractor.StageProfile()
+        other.add("transform", 2.0, "100")
+        other.add("clean", 0.5, "100")
+        profile.merge(pickle.loads(pickle.dumps(other)))
+        report = profile.report()
+        self.assertEqual(report["transform"]["articles"], 101)
+        self.assertAlmostEqual(report["transform"]["seconds"], 4.098)
+        self.assertTrue(0.001 <= report["transform"]["p50"] < 0.002)
+        self.assertTrue(1.0 <= report["transform"]["p99"] < 2.0)
+        self.assertEqual(
+            [id for id, _ in report["transform"]["slowest"]][:3], ["100", "99", "98"]
+        )
+        self.assertEqual(report["clean"]["slowest"], [("100", 0.5)])
+        self.assertEqual(report["wiki2text"]["articles"], 0)
+        self.assertEqual(report["wiki2text"]["p99"], 0.0)
+
+    def test_extract_dump(self):
+        opts = WikiExtractor.extraction_options(quiet=True, profile_stages=True)
+        profile = WikiExtractor.StageProfile()
+        records = list(
+            WikiExtractor.extract_dump(
+                DUMP_FILE, opts=opts, process_count=2, profile=profile
+            )
+        )
+        self.assertEqual(records, list(WikiExtractor.extract_dump(DUMP_FILE)))
+        report = profile.report()
+        self.assertEqual(set(report), set(WikiExtractor.StageProfile.stages))
+        for stage in report.values():
+            self.assertEqual(stage["articles"], len(records))
+            self.assertEqual(len(stage["slowest"]), 5)
+
+
+class TestTemplateProfile(unittest.TestCase):
+    def setUp(self):
+        self.options = WikiExtractor.extraction_options(
+            templates={
+                "Template:Cn": "[citation needed]",
+                "Template:Box": "{{#if:{{{1|}}}|{{uc:{{{1}}}}}|none}}",
+                "Template:Loop": "{{Loop}}",
+            },
+            templatePrefix="Template:",
+        )
+        self.options.templateProfile = WikiExtractor.TemplateProfile()
+        patcher = mock.patch.object(WikiExtractor, "options", self.options)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_counts(self):
+        text = "A{{cn}} B{{cn}} {{Box|x}} {{Box|x}} {{Loop}}"
+        WikiExtractor.Extractor("1", "1", "P", [text]).extract_text()
+        profile = pickle.loads(pickle.dumps(self.options.templateProfile))
+        profile.merge(self.options.templateProfile)
+        report = dict((counts["name"], counts) for counts in profile.report())
+        self.assertEqual(report["Template:Cn"]["calls"], 4)
+        self.assertEqual(report["Template:Cn"]["cache_hits"], 2)
+        self.assertEqual(report["Template:Box"]["cache_hits"], 2)
+        self.assertEqual(report["#if"]["calls"], 2)
+        self.assertEqual(report["uc"]["calls"], 2)
+        self.assertEqual(report["Template:Loop"]["recursion_hits"], 2)
+        self.assertEqual(
+            report["Template:Loop"]["calls"],
+            2 * WikiExtractor.Extractor.maxTemplateRecursionLevels,
+        )
+        self.assertEqual(self.options.templateProfile.active["Template:Loop"], 0)
+
+    def test_extract_dump(self):
+        opts = WikiExtractor.extraction_options(quiet=True, profile_templates=True)
+        profile = WikiExtractor.TemplateProfile()
+        records = list(
+            WikiExtractor.extract_dump(DUMP_FILE, opts=opts, template_profile=profile)
+        )
+        self.assertEqual(records, list(WikiExtractor.extract_dump(DUMP_FILE)))
+        self.assertIn("#expr", [counts["name"] for counts in profile.report()])
+
+
+class TestOptions(unittest.TestCase):
+    def test_extraction_options(self):
+        options = WikiExtractor.extraction_options(keepLinks=True)
+        self.assertTrue(options.keepLinks)
+        self.assertEqual(
+            len(options.ignored_tag_patterns), len(WikiExtractor.defaultIgnoredTags)
+        )
+        options = WikiExtractor.extraction_options(ignored_tags=["b"])
+        # 'b' and 'a'
+        self.assertEqual(len(options.ignored_tag_patterns), 2)
+        self.assertIsNot(
+            WikiExtractor.default_options().templates,
+            WikiExtractor.default_options().templates,
+        )
@@ -3,9 +3,484 @@ import os
 import shutil
 import tempfile
 import glob
+import hashlib
+import bz2
+import threading
+import http.server
+import functools
+import json
+from unittest import mock
 
 import poiolib.wikipedia
 
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+DUMP_FILE = os.path.join(SCRIPT_DIR, "test_data", "xxwiki-20200101-pages-articles.xml")
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serve files from a directory with support for single HTTP ranges."""
+
+    # set by the tests to make the server drop the connection after n bytes
+    max_bytes = None
+    # number of concurrent GET requests
+    active = 0
+    max_active = 0
+    # paths of served files
+    requested = []
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        path = self.translate_path(self.path)
+        self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+
+    def do_GET(self):
+        cls = RangeRequestHandler
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        try:
+            self.send_range()
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def send_range(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            super().do_GET()
+            return
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self.requested.append(self.path)
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        if range_header:
+            first, last = range_header.split("=")[1].split("-")
+            start = int(first)
+            if last:
+                end = min(int(last), size - 1)
+            if start >= size:
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+        if self.max_bytes is not None:
+            data = data[: self.max_bytes]
+        self.wfile.write(data)
+
+
+class TestDumpToTxt(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dump_to_txt(self):
+        output_file = os.path.join(self.tmp_dir, "xx.txt")
+        poiolib.wikipedia.dump_to_txt(DUMP_FILE, output_file)
+        with open(output_file, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[0].startswith("Rhine The Rhine is one of"))
+        for line in lines:
+            self.assertGreater(len(line), poiolib.wikipedia.MIN_ARTICLE_LENGTH)
+        self.assertEqual(os.listdir(self.tmp_dir), ["xx.txt"])
+        # WikiExtractor drops no article that the final filter keeps
+        expected = [
+            poiolib.wikipedia._article_line(text)
+            for text in poiolib.wikipedia.extract_articles(DUMP_FILE, 1)
+        ]
+        self.assertEqual(lines, [line for line in expected if line is not None])
+
+    def test_dump_to_txt_stats(self):
+        output_file = os.path.join(self.tmp_dir, "xx.txt")
+        snapshots = []
+        stats = poiolib.wikipedia.WikiExtractor.PipelineStats(snapshots.append)
+        articles = poiolib.wikipedia.dump_to_txt(DUMP_FILE, output_file, 1, stats)
+        self.assertEqual(len(snapshots), 1)
+        self.assertEqual(snapshots[0]["articles_written"], articles)
+        self.assertEqual(snapshots[0]["bytes_written"], os.path.getsize(output_file))
+
+    def test_bz2_processes(self):
+        dump_file = os.path.join(self.tmp_dir, "xxwiki-20200101-pages-articles.xml.bz2")
+        with open(DUMP_FILE, "rb") as f, open(dump_file, "wb") as out:
+            out.write(bz2.compress(f.read()))
+        extract_dump = poiolib.wikipedia.WikiExtractor.extract_dump
+        with mock.patch(
+            "poiolib.wikipedia.WikiExtractor.extract_dump", side_effect=extract_dump
+        ) as extract:
+            texts = list(poiolib.wikipedia.extract_articles(dump_file, 8))
+        options = extract.call_args[0][1]
+        # the decompression processes are part of the 8
+        self.assertEqual(options.decompress_processes, 2)
+        self.assertEqual(extract.call_args[1]["process_count"], 6)
+        self.assertEqual(texts, list(poiolib.wikipedia.extract_articles(DUMP_FILE, 1)))
+        self.assertEqual(poiolib.wikipedia._split_processes(dump_file, 7), (7, 1))
+        self.assertEqual(poiolib.wikipedia._split_processes(DUMP_FILE, 8), (8, 1))
+
+    def test_wikipedia_extractor(self):
+        (out, err) = poiolib.wikipedia.wikipedia_extractor(DUMP_FILE, self.tmp_dir, 1)
+        self.assertEqual((out, err), ("", ""))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, "AA", "wiki_00")))
+
+
+def article_jobs(wiki_name, date, status="done", split=False):
+    def job(status, *names):
+        files = {}
+        for name in names:
+            file_name = "%s-%s-%s" % (wiki_name, date, name)
+            files[file_name] = {
+                "url": "/%s/%s/%s" % (wiki_name, date, file_name),
+                "size": 1234,
+                "sha1": "a" * 40,
+                "md5": "b" * 32,
+            }
+        return {"status": status, "files": files}
+
+    if not split:
+        return {"jobs": {"articlesdump": job(status, "pages-articles.xml.bz2")}}
+    # large wikis dump their articles in parts, which are then recombined
+    return {
+        "jobs": {
+            "articlesdump": job(
+                status,
+                "pages-articles1.xml-p1p1000.bz2",
+                "pages-articles2.xml-p1001p2000.bz2",
+            ),
+            "articlesdumprecombine": job(status, "pages-articles.xml.bz2"),
+        }
+    }
+
+
+class TestDumpIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.serve_dir = os.path.join(self.tmp_dir, "serve")
+        index = {
+            "wikis": {
+                "crwiki": article_jobs("crwiki", "20200101"),
+                "dewiki": article_jobs("dewiki", "20200101"),
+                "enwiki": article_jobs("enwiki", "20200101", split=True),
+                "xxwiki": article_jobs("xxwiki", "20200101", "in-progress"),
+            }
+        }
+        self.write("index.json", index)
+        self.write(
+            "xxwiki/20191201/dumpstatus.json", article_jobs("xxwiki", "20191201")
+        )
+        self.write("xxwiki/20200101/dumpstatus.json", index["wikis"]["xxwiki"])
+        handler = functools.partial(RangeRequestHandler, directory=self.serve_dir)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_port
+        self.cache_file = os.path.join(self.tmp_dir, "cache", "index.json")
+        RangeRequestHandler.requested = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, path, data):
+        path = os.path.join(self.serve_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def test_dump_infos_from_index(self):
+        index = poiolib.wikipedia.DumpIndex(self.cache_file, dumps_url=self.url)
+        infos = index.dump_infos(["crwiki", "dewiki"])
+        self.assertEqual(infos["crwiki"]["date"], "20200101")
+        info = infos["dewiki"]["files"]["pages-articles.xml.bz2"]
+        self.assertEqual(
+            info["url"],
+            self.url + "dewiki/20200101/dewiki-20200101-pages-articles.xml.bz2",
+        )
+        self.assertEqual(info["size"], 1234)
+        self.assertEqual(info["sha1"], "a" * 40)
+        self.assertEqual(RangeRequestHandler.requested, ["/index.json"])
+
+        # a new index answers from the cache file
+        index = poiolib.wikipedia.DumpIndex(self.cache_file, dumps_url=self.url)
+        self.assertEqual(index.dump_info("crwiki")["date"], "20200101")
+        self.assertEqual(RangeRequestHandler.requested, ["/index.json"])
+
+    def test_dump_info_of_split_dump(self):
+        index = poiolib.wikipedia.DumpIndex(self.cache_file, dumps_url=self.url)
+        files = index.dump_info("enwiki")["files"]
+        self.assertEqual(
+            files["pages-articles.xml.bz2"]["url"],
+            self.url + "enwiki/20200101/enwiki-20200101-pages-articles.xml.bz2",
+        )
+        self.assertIn("pages-articles1.xml-p1p1000.bz2", files)
+
+    def test_dump_info_of_running_dump(self):
+        index = poiolib.wikipedia.DumpIndex(self.cache_file, dumps_url=self.url)
+        self.assertEqual(index.dump_info("xxwiki")["date"], "20191201")
+        self.assertIsNone(index.dump_info("yywiki"))
+        index = poiolib.wikipedia.DumpIndex(self.cache_file, dumps_url=self.url)
+        self.assertEqual(index.dump_info("xxwiki")["date"], "20191201")
+        self.assertEqual(RangeRequestHandler.requested.count("/index.json"), 1)
+
+    def test_unreadable_cache_file(self):
+        os.makedirs(os.path.dirname(self.cache_file))
+        for cache in ('{"dumps_url": "', '{"wikis": {}}', "[]"):
+            with open(self.cache_file, "w") as f:
+                f.write(cache)
+            index = poiolib.wikipedia.DumpIndex(self.cache_file, dumps_url=self.url)
+            self.assertEqual(index.dump_info("crwiki")["date"], "20200101")
+        self.assertEqual(RangeRequestHandler.requested.count("/index.json"), 3)
+        # the cache file was replaced
+        index = poiolib.wikipedia.DumpIndex(self.cache_file, dumps_url=self.url)
+        self.assertEqual(index.dump_info("crwiki")["date"], "20200101")
+        self.assertEqual(RangeRequestHandler.requested.count("/index.json"), 3)
+        self.assertEqual(os.listdir(os.path.dirname(self.cache_file)), ["index.json"])
+
+
+class TestDownloadDump(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.serve_dir = os.path.join(self.tmp_dir, "serve")
+        self.download_dir = os.path.join(self.tmp_dir, "download")
+        os.makedirs(self.serve_dir)
+        self.data = os.urandom(300 * 1024 + 17)
+        with open(os.path.join(self.serve_dir, "xxwiki-pages.xml.bz2"), "wb") as f:
+            f.write(self.data)
+        handler = functools.partial(RangeRequestHandler, directory=self.serve_dir)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/xxwiki-pages.xml.bz2" % self.server.server_port
+
+    def tearDown(self):
+        RangeRequestHandler.max_bytes = None
+        RangeRequestHandler.max_active = 0
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_download_verifies_digest(self):
+        sha1 = hashlib.sha1(self.data).hexdigest()
+        md5 = hashlib.md5(self.data).hexdigest()
+        file_path = poiolib.wikipedia.download_dump(
+            self.url, self.download_dir, sha1=sha1, md5=md5, chunk_size=4096
+        )
+        with open(file_path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(file_path + ".part"))
+
+    def test_download_resumes_part_file(self):
+        os.makedirs(self.download_dir)
+        part_path = os.path.join(self.download_dir, "xxwiki-pages.xml.bz2.part")
+        with open(part_path, "wb") as f:
+            f.write(self.data[:100000])
+        RangeRequestHandler.max_bytes = 64 * 1024
+        file_path = poiolib.wikipedia.download_dump(
+            self.url,
+            self.download_dir,
+            sha1=hashlib.sha1(self.data).hexdigest(),
+            chunk_size=4096,
+        )
+        with open(file_path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_download_checks_existing_file(self):
+        os.makedirs(self.download_dir)
+        file_path = os.path.join(self.download_dir, "xxwiki-pages.xml.bz2")
+        with open(file_path, "wb") as f:
+            f.write(self.data[:100000])
+        sha1 = hashlib.sha1(self.data).hexdigest()
+        # without digests the file is taken as is
+        poiolib.wikipedia.download_dump(self.url, self.download_dir)
+        self.assertEqual(os.path.getsize(file_path), 100000)
+        requests = len(RangeRequestHandler.requested)
+        self.assertEqual(
+            poiolib.wikipedia.download_dump(self.url, self.download_dir, sha1=sha1),
+            file_path,
+        )
+        with open(file_path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(os.listdir(self.download_dir), ["xxwiki-pages.xml.bz2"])
+        # the rest of the file was requested once, and the complete file is kept
+        self.assertEqual(len(RangeRequestHandler.requested), requests + 1)
+        poiolib.wikipedia.download_dump(self.url, self.download_dir, sha1=sha1)
+        self.assertEqual(len(RangeRequestHandler.requested), requests + 1)
+
+    @mock.patch("poiolib.wikipedia.DOWNLOAD_SEGMENT_SIZE", 16 * 1024)
+    @mock.patch("poiolib.wikipedia.MAX_CONNECTIONS_PER_HOST", 2)
+    def test_segmented_download(self):
+        reports = []
+        file_path = poiolib.wikipedia.download_dump(
+            self.url,
+            self.download_dir,
+            sha1=hashlib.sha1(self.data).hexdigest(),
+            chunk_size=4096,
+            connections=4,
+            progress=lambda done, total: reports.append((done, total)),
+        )
+        with open(file_path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(reports[-1], (len(self.data), len(self.data)))
+        self.assertLessEqual(RangeRequestHandler.max_active, 2)
+        self.assertEqual(os.listdir(self.download_dir), ["xxwiki-pages.xml.bz2"])
+
+    @mock.patch("poiolib.wikipedia.DOWNLOAD_SEGMENT_SIZE", 128 * 1024)
+    def test_segmented_download_retries_segments(self):
+        RangeRequestHandler.max_bytes = 50 * 1024
+        file_path = poiolib.wikipedia.download_dump(
+            self.url,
+            self.download_dir,
+            md5=hashlib.md5(self.data).hexdigest(),
+            chunk_size=4096,
+            connections=3,
+        )
+        with open(file_path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_download_digest_mismatch(self):
+        with self.assertRaises(IOError):
+            poiolib.wikipedia.download_dump(self.url, self.download_dir, sha1="0" * 40)
+        self.assertEqual(os.listdir(self.download_dir), [])
+
+
+class TestExtractMany(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.serve_dir = os.path.join(self.tmp_dir, "serve")
+        self.output_dir = os.path.join(self.tmp_dir, "output")
+        os.makedirs(self.serve_dir)
+        with open(DUMP_FILE, "rb") as f:
+            self.data = bz2.compress(f.read())
+        for name in ["dewiki.xml.bz2", "ndswiki.xml.bz2"]:
+            with open(os.path.join(self.serve_dir, name), "wb") as f:
+                f.write(self.data)
+        handler = functools.partial(RangeRequestHandler, directory=self.serve_dir)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        RangeRequestHandler.requested = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def dump_info(self, name, size):
+        return {
+            "url": "http://127.0.0.1:%d/%s" % (self.server.server_port, name),
+            "size": size,
+            "sha1": hashlib.sha1(self.data).hexdigest(),
+            "md5": None,
+            "date": "20200101",
+        }
+
+    def test_extract_many(self):
+        dump_infos = {
+            "de": self.dump_info("dewiki.xml.bz2", 1000),
+            "nds": self.dump_info("ndswiki.xml.bz2", 10),
+            "hsb": None,
+        }
+        with mock.patch("poiolib.wikipedia.get_dump_infos", return_value=dump_infos):
+            manifests = poiolib.wikipedia.extract_many(
+                ["nds", "deu", "hsb"], self.output_dir, processes=2, downloads=1
+            )
+        # the largest dump first
+        self.assertEqual(
+            RangeRequestHandler.requested, ["/dewiki.xml.bz2", "/ndswiki.xml.bz2"]
+        )
+        self.assertEqual(manifests["deu"]["processes"], 2)
+        self.assertEqual(manifests["nds"]["processes"], 1)
+        self.assertIn("error", manifests["hsb"])
+        self.assertEqual(
+            sorted(os.listdir(self.output_dir)),
+            ["deu.json", "deu.txt", "hsb.json", "nds.json", "nds.txt"],
+        )
+        with open(os.path.join(self.output_dir, "deu.json")) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest, manifests["deu"])
+        self.assertEqual(manifest["articles"], 5)
+        self.assertEqual(
+            manifest["txt_size"],
+            os.path.getsize(os.path.join(self.output_dir, "deu.txt")),
+        )
+        self.assertEqual(manifest["dump_size"], 1000)
+        self.assertNotIn("error", manifest)
+
+    def test_extract_many_stats(self):
+        dump_infos = {"de": self.dump_info("dewiki.xml.bz2", 1000)}
+        snapshots = []
+        with mock.patch("poiolib.wikipedia.get_dump_infos", return_value=dump_infos):
+            poiolib.wikipedia.extract_many(
+                ["deu"], self.output_dir, stats=snapshots.append
+            )
+        download, extract = snapshots
+        self.assertEqual(download["stage"], "download")
+        self.assertEqual(download["iso_639_3"], "deu")
+        self.assertEqual(download["bytes_downloaded"], len(self.data))
+        self.assertEqual(extract["stage"], "extract")
+        self.assertEqual(extract["iso_639_3"], "deu")
+        self.assertEqual(extract["articles_written"], 5)
+
+    def test_extract_many_skips_unchanged_dumps(self):
+        dump_infos = {
+            "de": self.dump_info("dewiki.xml.bz2", 1000),
+            "nds": self.dump_info("ndswiki.xml.bz2", 10),
+        }
+        with mock.patch("poiolib.wikipedia.get_dump_infos", return_value=dump_infos):
+            first = poiolib.wikipedia.extract_many(["deu", "nds"], self.output_dir)
+            # a text file that was changed is extracted again
+            with open(os.path.join(self.output_dir, "nds.txt"), "a") as f:
+                f.write("changed\n")
+            RangeRequestHandler.requested = []
+            second = poiolib.wikipedia.extract_many(["deu", "nds"], self.output_dir)
+        self.assertEqual(RangeRequestHandler.requested, ["/ndswiki.xml.bz2"])
+        self.assertEqual(second["deu"], first["deu"])
+        self.assertEqual(second["nds"]["outputs"], first["nds"]["outputs"])
+
+    def test_extract_to_skips_unchanged_dump(self):
+        dump_info = self.dump_info("dewiki.xml.bz2", 1000)
+        with mock.patch("poiolib.wikipedia.get_dump_info", return_value=dump_info):
+            manifest = poiolib.wikipedia.extract_to("deu", self.output_dir)
+            self.assertEqual(list(manifest["outputs"]), [os.path.join("AA", "wiki_00")])
+            RangeRequestHandler.requested = []
+            self.assertEqual(
+                poiolib.wikipedia.extract_to("deu", self.output_dir), manifest
+            )
+            self.assertEqual(RangeRequestHandler.requested, [])
+        # a new dump replaces the old one
+        with open(os.path.join(self.serve_dir, "dewiki-new.xml.bz2"), "wb") as f:
+            f.write(bz2.compress(b"<mediawiki></mediawiki>"))
+        dump_info = self.dump_info("dewiki-new.xml.bz2", 1000)
+        dump_info["sha1"] = None
+        with mock.patch("poiolib.wikipedia.get_dump_info", return_value=dump_info):
+            manifest = poiolib.wikipedia.extract_to("deu", self.output_dir)
+        self.assertEqual(manifest["outputs"], {os.path.join("AA", "wiki_00"): 0})
+        self.assertEqual(
+            sorted(os.listdir(self.output_dir)),
+            ["AA", "deu.json", "dewiki-new.xml.bz2"],
+        )
+
 
 class TestWikipedia(unittest.TestCase):
     def setUp(self):